@@ -1,14 +1,34 @@
 """HTTP helpers for retrieving AOE2 profile, match, and replay data."""
 
 import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
 import requests
-import json
+import threading
 import zipfile
+import zlib
 import errno
 import argparse
+import copy
+import math
+import random
+import shutil
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from string import Template
 from urllib.parse import urlparse, parse_qs
 
+from aoe2api import broker, player_index
+from shared import codec, profiling
+
 # Default configuration values. These can be modified as needed.
 
 defaults = {
@@ -19,6 +39,20 @@ defaults = {
     "unzip": False,                         #Whether to unzip downloaded replay files.
     "remove_zip": False,                    #Whether to remove the original zip file after unzipping.
     "match_type": 3,
+    "download_retries": 3,                  #Times a resumable replay download is resumed or restarted before giving up.
+    "download_timeout": 30,                 #Seconds to wait for the replay server to connect or send data.
+    "download_chunk_size": 64 * 1024,       #Bytes written to disk per chunk when streaming replays.
+    "quarantine_folder": "quarantine",      #Subfolder of the replay folder where corrupt replay ZIPs are moved.
+    "coalesce_requests": True,              #Share one HTTP call between concurrent identical fetch_endpoint() calls.
+    "hedge_requests": False,                #Send a second identical request when the first is slower than usual. See fetch_endpoint().
+    "hedge_percentile": 95,                 #Per-endpoint latency percentile after which a request is hedged.
+    "hedge_budget": 0.05,                   #Largest fraction of hedge-enabled requests that may send a second request.
+    "hedge_min_samples": 20,                #Latencies recorded for an endpoint before its requests are hedged.
+    "hedge_workers": 16,                    #Threads sending hedged requests.
+    "broker_socket": os.environ.get("AGEKEEPER_BROKER") or None,  #Unix socket of a request broker (see broker.py) to send every fetch_endpoint() request through.
+    "broker_priority": "interactive",       #Queue priority of this process's requests at the broker: "interactive", "normal", or "bulk".
+    "broker_timeout": 300,                  #Seconds to wait for the broker's answer, including time queued behind other requests.
+    "player_index_max_age": 7 * 86400,      #Seconds a player-name index entry answers fetch_player() before a live search refreshes it. None never expires.
     
     "headers": {                           #Headers to include in API requests. These were captured from a request made on the official Age of Empires website, and may not be necessary for successful requests. Modify as needed.
         'user-agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:147.0) Gecko/20100101 Firefox/147.0',
@@ -124,12 +158,15 @@ def save_replay(
 
             # Save the file to the destination path
             file_name = destination_path
-            with open(file_name, 'wb') as f:
-                f.write(response["content"])
+            # Write to a temporary name and rename, so an interrupted write never leaves a truncated .zip behind.
+            with profiling.span("save"):
+                with open(f"{file_name}.tmp", 'wb') as f:
+                    f.write(response["content"])
+                os.replace(f"{file_name}.tmp", file_name)
             if not quiet:
                 print(f" * File '{file_name}' saved successfully.")
             if unzip:
-                with zipfile.ZipFile(file_name, 'r') as zip_ref:
+                with profiling.span("unzip"), zipfile.ZipFile(file_name, 'r') as zip_ref:
                     zip_ref.extractall(destination_folder)
                     if not quiet:
                         print(f"' - {file_name}' unzipped successfully. ", end="")
@@ -166,11 +203,22 @@ def fetch_replay(profile_id=defaults["profile_id"], match_id=defaults["match_id"
     response = fetch_endpoint("replay", profile_id=profile_id, match_id=match_id, quiet=quiet)
     return response
 
-def download_replay(profile_id=defaults["profile_id"], match_id=defaults["match_id"], destination_folder=defaults["destination_folder"], unzip=defaults["unzip"], remove_zip=defaults["remove_zip"], quiet=False):
+def download_replay(profile_id=defaults["profile_id"], match_id=defaults["match_id"], destination_folder=defaults["destination_folder"], unzip=defaults["unzip"], remove_zip=defaults["remove_zip"], quiet=False, resumable=False):
     '''
     Fetches a replay file from the API and saves it to disk. Equivalent to using both fetch_replay() and save_replay() in conjunction.
     Can optionaly unzip the replay file and remove the original zip after extraction.
+
+    :param resumable: Stream the replay to disk and resume interrupted transfers, see download_replay_resumable().
     '''
+    if resumable:
+        return download_replay_resumable(
+            profile_id=profile_id,
+            match_id=match_id,
+            destination_folder=destination_folder,
+            unzip=unzip,
+            remove_zip=remove_zip,
+            quiet=quiet,
+        )
     replay = fetch_replay(profile_id=profile_id, match_id=match_id, quiet=quiet)
     response = save_replay(
         replay,
@@ -182,27 +230,181 @@ def download_replay(profile_id=defaults["profile_id"], match_id=defaults["match_
     )
     return response
 
+def verify_replay_zip(path):
+    '''
+    Checks that a replay ZIP is complete: the central directory must parse and every member's CRC must match.
+
+    :param path: Path to the replay ZIP.
+    :return: Tuple (ok, message). message names the first problem found, or is "OK".
+    '''
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            if not zip_ref.namelist():
+                return False, "Archive is empty"
+            bad_member = zip_ref.testzip()
+            if bad_member is not None:
+                return False, f"CRC mismatch in '{bad_member}'"
+    except zipfile.BadZipFile as e:
+        return False, f"Bad ZIP: {e}"
+    except (OSError, EOFError, zlib.error) as e:
+        return False, f"Unreadable ZIP: {e}"
+    return True, "OK"
+
+def _replay_url(profile_id, match_id):
+    return Template(endpoints["replay"]["endpoint"]).substitute(matchId=match_id, profileId=profile_id)
+
+def _stream_replay(url, part_path, quiet=False):
+    '''
+    Streams a replay into part_path, continuing from its current size with a Range request when possible.
+    Returns (status_code, message, request).
+    '''
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request_headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with profiling.span("fetch"):
+        response = requests.get(url, headers=request_headers, stream=True, timeout=defaults["download_timeout"])
+    with response:
+        if response.status_code == 416 and offset:
+            # Nothing left to send: the partial file already holds the whole replay.
+            return 200, "OK", response.request
+        if response.status_code == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            mode = 'ab'
+            if not quiet:
+                print(f" * Resuming replay download at byte {offset}.")
+        elif response.status_code == 200:
+            # The server ignored the Range header (or there was none): start over.
+            mode = 'wb'
+        else:
+            return response.status_code, response.reason, response.request
+        with profiling.span("save"), open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=defaults["download_chunk_size"]):
+                f.write(chunk)
+        return 200, response.reason, response.request
+
+def probe_replay(match_id=defaults["match_id"], profile_id=defaults["profile_id"]):
+    '''
+    Checks whether a replay exists without downloading it. Only the response headers are read.
+
+    :return: The HTTP status code of the replay endpoint (200 if the replay exists, 404 if not).
+    '''
+    with profiling.span("fetch"):
+        response = requests.get(_replay_url(profile_id, match_id), stream=True, timeout=defaults["download_timeout"])
+    response.close()
+    return response.status_code
+
+def download_replay_resumable(profile_id=defaults["profile_id"], match_id=defaults["match_id"], destination_folder=defaults["destination_folder"], unzip=defaults["unzip"], remove_zip=defaults["remove_zip"], quiet=False, retries=defaults["download_retries"]):
+    '''
+    Downloads a replay to {destination_folder}/{match_id}.zip, streaming it through {match_id}.zip.part.
+    An interrupted transfer is resumed with an HTTP Range request (on a later call too), falling back to a full
+    download when the server does not honour ranges. The finished ZIP is verified with verify_replay_zip()
+    before it is renamed into place; a corrupt download is discarded and fetched again.
+
+    Returns the same fields as download_replay(), with "content" set to None and "path" set to the saved ZIP.
+    '''
+    os.makedirs(destination_folder, exist_ok=True)
+    destination_path = f"{destination_folder}/{match_id}.zip"
+    part_path = f"{destination_path}.part"
+    url = _replay_url(profile_id, match_id)
+    status_code, message, request = 0, "Download not attempted", None
+
+    for attempt in range(retries + 1):
+        try:
+            status_code, message, request = _stream_replay(url, part_path, quiet=quiet)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            status_code, message = 0, f"Download interrupted: {e}"
+            if not quiet:
+                print(f" ! Replay {match_id} download interrupted (attempt {attempt + 1}/{retries + 1}); will resume.")
+            continue
+        except OSError as e:
+            return {"status_code": e.errno, "request": request, "message": e.strerror, "content": None, "path": None}
+        if status_code != 200:
+            break
+        ok, verify_message = verify_replay_zip(part_path)
+        if ok:
+            os.replace(part_path, destination_path)
+            break
+        status_code, message = 422, f"Corrupt replay: {verify_message}"
+        if not quiet:
+            print(f" ! Replay {match_id} failed verification ({verify_message}); downloading again.")
+        os.remove(part_path)
+
+    if status_code != 200:
+        if not quiet:
+            print(f" ! Failed to download replay {match_id}. Status code: {status_code} {message}")
+        return {"status_code": status_code, "request": request, "message": message, "content": None, "path": None}
+
+    if not quiet:
+        print(f" * File '{destination_path}' saved successfully.")
+    if unzip:
+        with profiling.span("unzip"), zipfile.ZipFile(destination_path, 'r') as zip_ref:
+            zip_ref.extractall(destination_folder)
+        if remove_zip:
+            os.remove(destination_path)
+    return {"status_code": 200, "request": request, "message": message, "content": None, "path": destination_path}
+
+def verify_replays(destination_folder=defaults["destination_folder"], workers=None, quarantine=True, requeue=False, profile_id=defaults["profile_id"], quiet=False):
+    '''
+    Verifies every replay ZIP in a folder in parallel on a process pool.
+    Corrupt files are moved to {destination_folder}/quarantine and, with requeue=True, downloaded again.
+
+    :param workers: Number of worker processes. Defaults to the CPU count.
+    :param quarantine: Move corrupt ZIPs to the quarantine folder. If False, they are only reported.
+    :param requeue: Re-download quarantined replays with download_replay_resumable().
+    :return: Dict with "checked", "corrupt" ({file name: problem}), and "requeued" ({match id: status code}).
+    '''
+    if not os.path.isdir(destination_folder):
+        return {"checked": 0, "corrupt": {}, "requeued": {}}
+    paths = sorted(
+        os.path.join(destination_folder, name)
+        for name in os.listdir(destination_folder)
+        if name.endswith(".zip")
+    )
+    corrupt = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, (ok, message) in zip(paths, executor.map(verify_replay_zip, paths, chunksize=16)):
+            if not ok:
+                corrupt[os.path.basename(path)] = message
+                if not quiet:
+                    print(f" ! {path}: {message}")
+
+    requeued = {}
+    if quarantine and corrupt:
+        quarantine_folder = os.path.join(destination_folder, defaults["quarantine_folder"])
+        os.makedirs(quarantine_folder, exist_ok=True)
+        for name in corrupt:
+            shutil.move(os.path.join(destination_folder, name), os.path.join(quarantine_folder, name))
+        if requeue:
+            for name in corrupt:
+                match_id = name[:-len(".zip")]
+                result = download_replay_resumable(profile_id=profile_id, match_id=match_id, destination_folder=destination_folder, quiet=quiet)
+                requeued[match_id] = result["status_code"]
+
+    if not quiet:
+        print(f"Verified {len(paths)} replays: {len(paths) - len(corrupt)} OK, {len(corrupt)} corrupt.")
+    return {"checked": len(paths), "corrupt": corrupt, "requeued": requeued}
+
 ## <------------------------------------- Stat retrieval endpoints -------------------------------------> ##                       
-def fetch_match_details(profile_id=defaults["profile_id"], match_id=defaults["match_id"], quiet=False):
+def fetch_match_details(profile_id=defaults["profile_id"], match_id=defaults["match_id"], quiet=False, hedge=None):
     '''
     Retrieves stats for a given match. Both profile_id and match_id are required. profile_id may be any of the players in the match.
     
     :param profile_id: Profile ID of one of the players in the match.
     :param match_id: Match ID of the match to retrieve stats for.
+    :param hedge: Hedge a slow request, see fetch_endpoint().
     '''
-    payload = f'{{profileId: {profile_id}, "matchId":"{match_id}"}}'
-    response = fetch_endpoint("match_details", data=payload, quiet=quiet)
+    payload = {"profileId": profile_id, "matchId": str(match_id)}
+    response = fetch_endpoint("match_details", data=payload, quiet=quiet, hedge=hedge)
     return response
 
-def fetch_player_stats(profile_id=defaults["profile_id"], match_type=defaults["match_type"], quiet=False):
+def fetch_player_stats(profile_id=defaults["profile_id"], match_type=defaults["match_type"], quiet=False, hedge=None):
     '''
     Retrieves full stats for a given player profile ID. Requires the match type to be specified, as the API endpoint returns different stats based on the match type provided.
     
     :param profile_id: Profile ID of the player to retrieve stats for.
     :param match_type: Match type to retrieve stats for. Use get_match_type_string() for known match types.
+    :param hedge: Hedge a slow request, see fetch_endpoint().
     '''
-    payload = f'{{profileId: {profile_id}, "matchType":"{match_type}"}}'
-    response = fetch_endpoint("player_stats", data=payload, quiet=quiet)
+    payload = {"profileId": profile_id, "matchType": str(match_type)}
+    response = fetch_endpoint("player_stats", data=payload, quiet=quiet, hedge=hedge)
     return response
 
 def fetch_player_campign_stats(profile_id=defaults["profile_id"], quiet=False):
@@ -211,12 +413,12 @@ def fetch_player_campign_stats(profile_id=defaults["profile_id"], quiet=False):
     
     :param profile_id: Profile ID of the player to retrieve campaign stats for.
     '''
-    payload = f'{{profileId: {profile_id}}}'
+    payload = {"profileId": profile_id}
     response = fetch_endpoint("player_campaign_stats", data=payload, quiet=quiet)
     return response
 
 def fetch_global_stats(quiet=False):
-    payload = "{'civid': '4'}"
+    payload = {"civid": "4"}
     response = fetch_endpoint("global_stats", data=payload, quiet=quiet)
     return response
 
@@ -243,7 +445,13 @@ def fetch_player_match_list(profile_id=defaults["profile_id"], game=defaults["ga
     #   * matchType values can be found in the get_match_type_string() helper function. This list is incomplete.
     #     TODO: Investigate matchType values further.
 
-    payload = f'{{"game":"{game}","profileId":"{profile_id}","sortColumn":"{sortColumn}", "sortDirection":"{sort_direction}","matchType":"{match_type}"}}'
+    payload = {
+        "game": game,
+        "profileId": str(profile_id),
+        "sortColumn": sortColumn,
+        "sortDirection": sort_direction,
+        "matchType": str(match_type),
+    }
     response = fetch_endpoint("player_match_list", profile_id=profile_id, data=payload, quiet=quiet)
     return response
 
@@ -251,16 +459,54 @@ def fetch_leaderboard(region="7", match_type="3", console_match_type=15, search_
     '''
     Fetches the leaderboard by region and matchtype. Returns the top 100 players per page. Can also be used for player search by name.
     '''
-    payload = f'{{"region":"{region}","matchType":"{match_type}","consoleMatchType":{console_match_type},"searchPlayer":"{search_player}","page":{page},"count":{count},"sortColumn":"{sort_column}","sortDirection":"{sort_direction}"}}'
+    payload = {
+        "region": str(region),
+        "matchType": str(match_type),
+        "consoleMatchType": console_match_type,
+        "searchPlayer": search_player,
+        "page": page,
+        "count": count,
+        "sortColumn": sort_column,
+        "sortDirection": sort_direction,
+    }
     response = fetch_endpoint("leaderboard", data=payload, quiet=quiet)
     return response
 
-def fetch_player(player_name):
+def fetch_player(player_name, use_index=True, max_age=defaults["player_index_max_age"]):
+    '''
+    Finds a player by name, answering from the local player-name index (see player_index.py) when it
+    knows the name and running a live leaderboard search on a miss. Live results are added to the
+    index, and saved if the index has a file.
+
+    :param use_index: Set to False to always search live.
+    :param max_age: Seconds since an index entry was last seen on a leaderboard after which it is refreshed
+                    by a live search. The old entry is still returned if that search fails. None never expires.
+    :return: {"rlUserId", "userName", "elo", "rank", "seenAt"} of the player whose name matches (an exact-case
+             match first, then a case-insensitive one, else the search's first result), or None. Index hits
+             and live results have the same keys.
+    '''
+    index = player_index.default_index() if use_index else None
+    stale = None
+    if index is not None:
+        found = index.lookup(player_name)
+        if found:
+            entry = {key: value for key, value in found.items() if key not in ("match", "distance")}
+            if max_age is None or time.time() - (entry.get("seenAt") or 0) <= max_age:
+                return entry
+            stale = entry
     response = search_for_player(player_name)
-    first_result = None
-    if response.get("content", None):
-        first_result = response.get("content", {}).get("items", {})[0]
-    return first_result
+    if response.get("status_code") != 200 and stale is not None:
+        return stale
+    items = (response.get("content") or {}).get("items") or []
+    if not items:
+        return None
+    # A refreshed stale entry is saved too, so other processes see its new seenAt.
+    if index is not None and (index.add_items(items) or stale is not None) and index.path and os.path.exists(index.path):
+        index.save()
+    folded = player_index.fold(player_name)
+    matches = [item for item in items if player_index.fold(item.get("userName") or "") == folded]
+    item = next((item for item in matches if item.get("userName") == player_name), matches[0] if matches else items[0])
+    return player_index.to_entry(item)
     
 def search_for_player(player_name):
     response = fetch_leaderboard(search_player=player_name)
@@ -268,7 +514,182 @@ def search_for_player(player_name):
 
 ## <------------------------------------- General purpose endpoint handler -------------------------------------> ##                       
 
-def fetch_endpoint(endpoint_name=None, profile_id=defaults["profile_id"], match_id=defaults["match_id"], headers=defaults["headers"], data=None, quiet=False):
+## Single-flight state: request key -> call in progress. Guarded by _in_flight_lock.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_async_in_flight = {}       # Request key -> [task, number of callers merged into it].
+_coalescing_stats = {"requests": 0, "merged": 0, "async_requests": 0, "async_merged": 0}
+
+class _InFlightCall:
+    __slots__ = ("done", "result", "error", "followers")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+def _copy_response(response):
+    # Callers such as save_replay() update responses in place, and parsed JSON content is nested,
+    # so each caller of a shared response gets its own copy of both.
+    response = dict(response)
+    if isinstance(response.get("content"), (dict, list)):
+        response["content"] = copy.deepcopy(response["content"])
+    return response
+
+def _request_key(endpoint_name, profile_id, match_id, headers, data):
+    '''
+    Identifies a request for coalescing: the endpoint plus the payload with keys sorted,
+    so payloads that differ only in key order or whitespace share a call.
+    '''
+    if not data:
+        data = {"matchId": str(match_id), "profileId": str(profile_id)}
+    if isinstance(data, str):
+        try:
+            data = codec.loads(data)
+        except codec.DecodeError:
+            pass
+    payload = data if isinstance(data, str) else codec.dumps_canonical(data)
+    # Non-default headers can change the response, so they are part of the key.
+    header_key = None if headers is defaults["headers"] else codec.dumps_canonical(headers)
+    return endpoint_name, payload, header_key
+
+def coalescing_stats():
+    '''
+    Counters for request coalescing in fetch_endpoint() and fetch_endpoint_async().
+
+    :return: Dict with "requests" and "merged" (calls that joined another call's request instead of sending
+        their own), the same for the async path, and "in_flight" (requests currently being fetched).
+    '''
+    with _in_flight_lock:
+        return {**_coalescing_stats, "in_flight": len(_in_flight)}
+
+## Hedging state: recent latencies per endpoint and hedge counters. Guarded by _hedge_lock.
+_hedge_lock = threading.Lock()
+_LATENCY_WINDOW = 500
+_attempt_latencies = {}     # Endpoint name -> latencies of single requests, which set the hedge delay.
+_call_latencies = {}        # Endpoint name -> latencies seen by callers, hedged or not.
+_hedge_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0, "cancelled": 0}
+_hedge_pool = None
+
+def _record_latency(latencies, endpoint_name, seconds):
+    with _hedge_lock:
+        window = latencies.get(endpoint_name)
+        if window is None:
+            window = latencies[endpoint_name] = deque(maxlen=_LATENCY_WINDOW)
+        window.append(seconds)
+
+def _percentile(samples, percentile):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
+
+def hedge_delay(endpoint_name):
+    '''Seconds a hedged request to endpoint_name waits before sending its second request, or None while too few latencies are recorded.'''
+    with _hedge_lock:
+        window = _attempt_latencies.get(endpoint_name)
+        if window is None or len(window) < defaults["hedge_min_samples"]:
+            return None
+        samples = list(window)
+    return _percentile(samples, defaults["hedge_percentile"])
+
+def hedging_stats():
+    '''
+    Counters for hedged requests in fetch_endpoint().
+
+    :return: Dict with "requests" (hedge-enabled requests), "hedged" (second requests sent), "hedge_rate",
+        "hedge_wins" (second request answered first), "budget_denied" (slow requests not hedged because the
+        budget was spent), "cancelled" (losing requests abandoned), and "latency": per endpoint, the p50/p95/p99
+        seconds callers waited over the last requests and the current hedge delay.
+    '''
+    with _hedge_lock:
+        stats = dict(_hedge_stats)
+        windows = {name: list(window) for name, window in _call_latencies.items() if window}
+    stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+    stats["latency"] = {
+        name: {
+            "samples": len(samples),
+            "p50": _percentile(samples, 50),
+            "p95": _percentile(samples, 95),
+            "p99": _percentile(samples, 99),
+            "hedge_after": hedge_delay(name),
+        }
+        for name, samples in windows.items()
+    }
+    return stats
+
+def _take_hedge():
+    # A hedge may be sent while hedges stay within hedge_budget of all hedge-enabled requests.
+    with _hedge_lock:
+        if _hedge_stats["hedged"] + 1 > defaults["hedge_budget"] * _hedge_stats["requests"]:
+            _hedge_stats["budget_denied"] += 1
+            return False
+        _hedge_stats["hedged"] += 1
+        return True
+
+def _attempt(method, url, cancelled, kwargs):
+    # Streams the response so a request that lost the race is closed once its headers arrive instead of read in full.
+    started = time.perf_counter()
+    response = requests.request(method, url, stream=True, **kwargs)
+    if cancelled.is_set():
+        response.close()
+        return None, None
+    response.content
+    return response, time.perf_counter() - started
+
+def _hedged_request(endpoint_name, method, url, kwargs):
+    global _hedge_pool
+    with _hedge_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=defaults["hedge_workers"], thread_name_prefix="hedge")
+        _hedge_stats["requests"] += 1
+    delay = hedge_delay(endpoint_name)
+    attempts = {}
+    cancelled = threading.Event()
+    primary_started = time.perf_counter()
+    primary = _hedge_pool.submit(_attempt, method, url, cancelled, kwargs)
+    attempts[primary] = cancelled
+    if delay is None or wait([primary], timeout=delay).done or not _take_hedge():
+        response, elapsed = primary.result()
+        _record_latency(_attempt_latencies, endpoint_name, elapsed)
+        return response
+
+    cancelled = threading.Event()
+    secondary = _hedge_pool.submit(_attempt, method, url, cancelled, kwargs)
+    attempts[secondary] = cancelled
+    pending, error = set(attempts), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response, elapsed = future.result()
+            except Exception as e:
+                error = e  # The other request may still succeed.
+                continue
+            # One sample per request, always the primary's: when the hedge wins, the primary has taken at least
+            # this long. Recording the winner instead would drop every slow sample and pull the hedge delay down.
+            if future is not primary:
+                elapsed = time.perf_counter() - primary_started
+            _record_latency(_attempt_latencies, endpoint_name, elapsed)
+            for loser in pending:
+                attempts[loser].set()
+                loser.cancel()
+            with _hedge_lock:
+                _hedge_stats["cancelled"] += len(pending)
+                _hedge_stats["hedge_wins"] += future is secondary
+            return response
+    raise error
+
+def _send(endpoint_name, method, url, hedge=False, **kwargs):
+    started = time.perf_counter()
+    if hedge:
+        response = _hedged_request(endpoint_name, method, url, kwargs)
+    else:
+        response = requests.request(method, url, **kwargs)
+        _record_latency(_attempt_latencies, endpoint_name, time.perf_counter() - started)
+    _record_latency(_call_latencies, endpoint_name, time.perf_counter() - started)
+    return response
+
+def fetch_endpoint(endpoint_name=None, profile_id=defaults["profile_id"], match_id=defaults["match_id"], headers=defaults["headers"], data=None, quiet=False, coalesce=None, hedge=None):
     '''
     Fetches various stats from the Age of Empires API. Endpoint name must be specified.
     This is the general purpose endpoint handler, which can be used to fetch any endpoint defined in the endpoints dictionary.
@@ -279,8 +700,100 @@ def fetch_endpoint(endpoint_name=None, profile_id=defaults["profile_id"], match_
     :param profile_id: The profile ID to use in the default payload/url if data is not provided. Default is 199325 (Hera's profile ID).
     :param match_id: The match ID to use in the default payload/url if data is not provided. Default is 453704442 (A match ID from Hera's profile, used for testing).
     :param headers: The headers to include in the request. Default is a set of headers captured from a request made on the official Age of Empires website. May not be necessary for successful requests, but included to match the captured request as closely as possible. Modify as needed.
-    :param data: The data to include in the request. For GET requests, this will be used to construct the URL. For POST requests, this will be used as the request body. Must be in the format of a valid JSON string. If not provided, default values will be used based on the profile_id and match_id parameters.
+    :param data: The data to include in the request. For GET requests, this will be used to construct the URL. For POST requests, this will be used as the request body. Either a dict, serialized with the shared JSON codec, or a JSON string sent as is. If not provided, default values will be used based on the profile_id and match_id parameters.
+    :param coalesce: Share the request with identical concurrent calls. Defaults to defaults["coalesce_requests"].
+    :param hedge: Hedge the request if it is slow. Defaults to defaults["hedge_requests"].
+
+    Concurrent identical calls (same endpoint and payload, e.g. from several threads) are coalesced: only the first
+    sends a request, and every caller gets its own copy of the response, including its parsed content. Nothing is cached, so a call that
+    starts after the response arrived sends a new request. See coalescing_stats().
+
+    Hedging is meant for interactive lookups such as fetch_match_details(). A hedged request that has not answered
+    within the endpoint's hedge_percentile latency (tracked over its recent requests) sends a second identical request,
+    and whichever answers first is returned. The other is abandoned: dropped if it has not started, closed once its
+    headers arrive otherwise. At most hedge_budget of hedged requests send a second one. See hedging_stats().
+
+    When defaults["broker_socket"] is set, the request is sent through the local request broker (see broker.py) at
+    defaults["broker_priority"] instead, and hedging is left out; the broker paces, caches, and shares requests itself.
+
+    The response content is decoded according to its Content-Type: JSON is parsed, while binary bodies such as replay ZIPs are returned as bytes.
+    '''
+    if not (defaults["coalesce_requests"] if coalesce is None else coalesce) or endpoint_name not in endpoints:
+        return _fetch_endpoint(endpoint_name, profile_id=profile_id, match_id=match_id, headers=headers, data=data, quiet=quiet, hedge=hedge)
+
+    key = _request_key(endpoint_name, profile_id, match_id, headers, data)
+    with _in_flight_lock:
+        _coalescing_stats["requests"] += 1
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = _in_flight[key] = _InFlightCall()
+        else:
+            call.followers += 1
+            _coalescing_stats["merged"] += 1
+
+    if leader:
+        try:
+            call.result = _fetch_endpoint(endpoint_name, profile_id=profile_id, match_id=match_id, headers=headers, data=data, quiet=quiet, hedge=hedge)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with _in_flight_lock:
+                del _in_flight[key]
+            call.done.set()
+        # No caller joins once the call is out of _in_flight, so followers is final here.
+        return _copy_response(call.result) if call.followers else call.result
+
+    call.done.wait()
+    if call.error is not None:
+        raise call.error
+    return _copy_response(call.result)
+
+def _finish_async_call(key, task):
+    _async_in_flight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # Mark the exception retrieved; callers that were cancelled never await it.
+
+async def fetch_endpoint_async(endpoint_name=None, profile_id=defaults["profile_id"], match_id=defaults["match_id"], headers=defaults["headers"], data=None, quiet=False, coalesce=None, hedge=None):
     '''
+    Async version of fetch_endpoint(). The request runs in a worker thread. Concurrent identical calls on the same
+    event loop await a single task, so merged callers do not occupy threads; they also coalesce with sync callers.
+    Cancelling one caller does not cancel the request for the others.
+    '''
+    fetch = lambda: fetch_endpoint(endpoint_name, profile_id=profile_id, match_id=match_id, headers=headers, data=data, quiet=quiet, coalesce=coalesce, hedge=hedge)
+    if not (defaults["coalesce_requests"] if coalesce is None else coalesce) or endpoint_name not in endpoints:
+        return await asyncio.to_thread(fetch)
+
+    loop = asyncio.get_running_loop()
+    key = (loop,) + _request_key(endpoint_name, profile_id, match_id, headers, data)
+    _coalescing_stats["async_requests"] += 1
+    call = _async_in_flight.get(key)
+    if call is None:
+        task = loop.create_task(asyncio.to_thread(fetch))
+        call = _async_in_flight[key] = [task, 0]
+        task.add_done_callback(lambda finished: _finish_async_call(key, finished))
+        result = await asyncio.shield(task)
+        # Merged callers joined before the task finished, so the count is final once it has.
+        return _copy_response(result) if call[1] else result
+    call[1] += 1
+    _coalescing_stats["async_merged"] += 1
+    return _copy_response(await asyncio.shield(call[0]))
+
+def request_arguments(endpoint_name, headers, data):
+    '''
+    Returns (method, url, keyword arguments) of the HTTP request for an endpoint and its serialized payload.
+    GET endpoints take the payload's values as URL parameters; POST endpoints send it as the body.
+    '''
+    endpoint = endpoints[endpoint_name]
+    if endpoint["method"] == "GET":
+        return "GET", Template(endpoint["endpoint"]).substitute(**codec.loads(data)), {}
+    return endpoint["method"], endpoint["endpoint"], {"headers": headers, "data": data}
+
+def _fetch_endpoint(endpoint_name=None, profile_id=defaults["profile_id"], match_id=defaults["match_id"], headers=defaults["headers"], data=None, quiet=False, hedge=None):
+    '''Sends the request for fetch_endpoint(), without coalescing.'''
+    if hedge is None:
+        hedge = defaults["hedge_requests"]
 
     #Validate the endpoint
     if not endpoint_name or endpoint_name not in endpoints:
@@ -288,24 +801,30 @@ def fetch_endpoint(endpoint_name=None, profile_id=defaults["profile_id"], match_
 
     #Default payload
     if not data:
-        data = f'{{"matchId":"{match_id}", "profileId":"{profile_id}"}}'
+        data = {"matchId": str(match_id), "profileId": str(profile_id)}
+    if not isinstance(data, str):
+        data = codec.dumps(data)
     
     #Fetch the stats from the API
     if not quiet:
         print(f"Fetching stats from endpoint: '{endpoint_name}' with data: {data}")
 
-    if endpoints[endpoint_name]["method"] == "GET":
-        values = json.loads(data)
-        final_endpoint = Template(endpoints[endpoint_name]["endpoint"]).substitute(**values)
-        response = requests.request("GET", final_endpoint)
-    elif endpoints[endpoint_name]["method"] == "POST":
-        response = requests.request("POST", f"{endpoints[endpoint_name]['endpoint']}", headers=headers, data=data)
-    else:
-        return {"status_code": 400, "request": response.request, "message": f"Invalid method for endpoint {endpoint_name}", "content": None}
-    if response.content:
-        content = json.loads(response.content)
-    else:
-        content = None
+    if defaults["broker_socket"]:
+        try:
+            with profiling.span("fetch"):
+                return broker.fetch(endpoint_name, data, headers=None if headers is defaults["headers"] else headers,
+                                    priority=defaults["broker_priority"], socket_path=defaults["broker_socket"],
+                                    timeout=defaults["broker_timeout"])
+        except broker.BrokerError as e:
+            return {"status_code": 503, "request": None, "message": f"Request broker unavailable: {e}", "content": None}
+
+    method, url, request_args = request_arguments(endpoint_name, headers, data)
+    if method not in ("GET", "POST"):
+        return {"status_code": 400, "request": None, "message": f"Invalid method for endpoint {endpoint_name}", "content": None}
+    with profiling.span("fetch"):
+        response = _send(endpoint_name, method, url, hedge=hedge, **request_args)
+    with profiling.span("decode"):
+        content = codec.decode_body(response.content, response.headers.get("Content-Type"))
     return {"status_code": response.status_code, "request": response.request, "message": response.reason, "content": content}
 
 ## <------------------------------------------ Unit Tests ------------------------------------------> ##                       
@@ -372,6 +891,72 @@ def run_endpoint_tests(quiet=False, max_content_bytes=None):
     _print_response(leaderboard, max_content_bytes=max_content_bytes, quiet=quiet)
     print()
 
+def run_hedging_benchmark(requests_count=200, slow_fraction=0.03, slow_delay=0.5, base_delay=0.02, seed=0, quiet=False):
+    '''
+    Measures hedging against a local mock server that answers in about base_delay seconds, except for
+    slow_fraction of requests that take slow_delay. Sends requests_count sequential requests without
+    hedging, then the same number with it, and compares the latency percentiles.
+
+    :return: {"unhedged": {...}, "hedged": {...}} with p50/p95/p99 seconds, plus the hedged run's hedge
+        rate and wins.
+    '''
+    delays = random.Random(seed)
+
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(slow_delay if delays.random() < slow_fraction else base_delay * (0.5 + delays.random()))
+            body = b'{"ok":true}'
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except OSError:
+                pass  # The client closed a hedged request that lost.
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_name = "hedge_benchmark"
+    endpoints[endpoint_name] = {"endpoint": f"http://127.0.0.1:{server.server_address[1]}/", "method": "POST"}
+    results = {}
+    try:
+        for label, hedge in (("unhedged", False), ("hedged", True)):
+            before = hedging_stats()
+            latencies = []
+            for number in range(requests_count):
+                started = time.perf_counter()
+                fetch_endpoint(endpoint_name, headers={"content-type": "application/json"}, data={"request": number}, quiet=True, coalesce=False, hedge=hedge)
+                latencies.append(time.perf_counter() - started)
+            after = hedging_stats()
+            results[label] = {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+                "max": max(latencies),
+            }
+            if hedge:
+                hedged = after["hedged"] - before["hedged"]
+                results[label]["hedge_rate"] = hedged / requests_count
+                results[label]["hedge_wins"] = after["hedge_wins"] - before["hedge_wins"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        del endpoints[endpoint_name]
+        with _hedge_lock:
+            _attempt_latencies.pop(endpoint_name, None)
+            _call_latencies.pop(endpoint_name, None)
+    if not quiet:
+        for label, result in results.items():
+            extra = f", hedge rate {result['hedge_rate']:.1%}, {result['hedge_wins']} hedges won" if "hedge_rate" in result else ""
+            print(f"{label}: p50 {result['p50'] * 1000:.0f} ms, p95 {result['p95'] * 1000:.0f} ms, p99 {result['p99'] * 1000:.0f} ms, max {result['max'] * 1000:.0f} ms{extra}")
+    return results
+
 ## <------------------------------------------ Helper functions ------------------------------------------> ##                       
 def get_usernames_from_ids(ids:list[str]):
     usernames = [
@@ -383,6 +968,7 @@ def get_usernames_from_ids(ids:list[str]):
     return usernames
 
 def get_ids_from_usernames(player_names:list[str]):
+    '''Returns the profile IDs of the named players that were found, via fetch_player() (local index first).'''
     ids = []
     for player_name in player_names:
         player = fetch_player(player_name=player_name)
@@ -411,6 +997,8 @@ def _print_response(response, max_content_bytes=None, quiet=False):
     content = response.get("content")
     if content is None:
         return
+    if not isinstance(content, (bytes, str)):
+        content = codec.dumps_bytes(content)
     if max_content_bytes is not None and len(content) > max_content_bytes:
         print(f"[Content omitted: {len(content)} bytes > {max_content_bytes} bytes]")
         return
@@ -435,6 +1023,8 @@ def _parse_args():
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument("--quiet", action="store_true", help="Suppress CLI output")
     common_parser.add_argument("--max-content-bytes", type=int, default=None, help="Max bytes to print for response content")
+    common_parser.add_argument("--broker", type=str, default=None, help="Send requests through the request broker on this Unix socket (see broker.py)")
+    profiling.add_profiling_args(common_parser)
 
     parser = argparse.ArgumentParser(
         description="AOE2 API CLI for fetching endpoints and downloading replays.",
@@ -447,6 +1037,13 @@ def _parse_args():
     replay_parser.add_argument("-o", "--output", type=str, default=defaults["destination_folder"], help="Destination folder for replay ZIPs")
     replay_parser.add_argument("-u", "--unzip", action="store_true", help="Unzip downloaded replay")
     replay_parser.add_argument("-rm", "--remove-zip", action="store_true", help="Remove ZIP after unzipping")
+    replay_parser.add_argument("--resumable", action="store_true", help="Stream to disk, resume interrupted downloads, and verify the ZIP")
+
+    verify_parser = subparsers.add_parser("verify", help="Verify replay ZIPs in a folder and quarantine corrupt ones", parents=[common_parser])
+    verify_parser.add_argument("-o", "--output", type=str, default=defaults["destination_folder"], help="Replay folder to scan")
+    verify_parser.add_argument("-w", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    verify_parser.add_argument("--no-quarantine", action="store_true", help="Only report corrupt ZIPs, do not move them")
+    verify_parser.add_argument("--requeue", action="store_true", help="Re-download quarantined replays")
 
     match_details_parser = subparsers.add_parser("match-details", help="Fetch match details", parents=[common_parser])
     _add_common_args(match_details_parser)
@@ -481,10 +1078,22 @@ def _parse_args():
     endpoint_parser.add_argument("-m", "--match-id", type=int, default=defaults["match_id"], help="Match ID")
     endpoint_parser.add_argument("-d", "--data", type=str, default=None, help="Raw JSON string payload")
 
+    hedge_parser = subparsers.add_parser("hedge-benchmark", help="Measure request hedging against a local slow mock server", parents=[common_parser])
+    hedge_parser.add_argument("-n", "--requests", type=int, default=200, help="Requests per run")
+    hedge_parser.add_argument("--slow-fraction", type=float, default=0.03, help="Fraction of slow responses")
+    hedge_parser.add_argument("--slow-delay", type=float, default=0.5, help="Seconds a slow response takes")
+    hedge_parser.add_argument("--budget", type=float, default=defaults["hedge_budget"], help="Largest fraction of requests to hedge")
+
     parser.add_argument("--run-tests", action="store_true", help="Run built-in endpoint tests")
 
     args = parser.parse_args()
+    if args.broker:
+        defaults["broker_socket"] = args.broker
+
+    with profiling.profiling_session(args, "aoe2api"):
+        _run_command(args, parser)
 
+def _run_command(args, parser):
     if args.run_tests:
         run_endpoint_tests(quiet=args.quiet, max_content_bytes=args.max_content_bytes)
         return
@@ -497,9 +1106,19 @@ def _parse_args():
             unzip=args.unzip,
             remove_zip=args.remove_zip,
             quiet=args.quiet,
+            resumable=args.resumable,
         )
         _print_status(result, quiet=args.quiet)
         return
+    if args.command == "verify":
+        verify_replays(
+            destination_folder=args.output,
+            workers=args.workers,
+            quarantine=not args.no_quarantine,
+            requeue=args.requeue,
+            quiet=args.quiet,
+        )
+        return
     if args.command == "match-details":
         result = fetch_match_details(profile_id=args.profile_id, match_id=args.match_id, quiet=args.quiet)
         _print_response(result, max_content_bytes=args.max_content_bytes, quiet=args.quiet)
@@ -537,6 +1156,10 @@ def _parse_args():
         )
         _print_response(result, max_content_bytes=args.max_content_bytes, quiet=args.quiet)
         return
+    if args.command == "hedge-benchmark":
+        defaults["hedge_budget"] = args.budget
+        run_hedging_benchmark(requests_count=args.requests, slow_fraction=args.slow_fraction, slow_delay=args.slow_delay)
+        return
     if args.command == "endpoint":
         result = fetch_endpoint(
             args.endpoint_name,
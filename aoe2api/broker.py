@@ -0,0 +1,453 @@
+"""Local request broker that sends the AoE2 API traffic of every AgeKeeper process on a host.
+
+Clients connect over a Unix socket (see fetch()); aoe2api.fetch_endpoint() routes through the broker when
+aoe2api.defaults["broker_socket"] (or the AGEKEEPER_BROKER environment variable) names its socket. The broker
+queues requests by priority, so an interactive lookup is sent ahead of queued bulk work, sends them within one
+rate budget over pooled upstream connections, and answers repeated requests from a shared response cache.
+"""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import heapq
+import itertools
+import socket
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+
+from shared import codec, profiling
+
+defaults = {
+    "socket_path": os.path.join(tempfile.gettempdir(), "agekeeper-broker.sock"),
+    "rate": 2.0,                        # Upstream requests per second, for all clients together.
+    "burst": 4,                         # Requests that may be sent back to back after an idle period.
+    "workers": 8,                       # Upstream requests in flight at once, and pooled upstream connections.
+    "cache_entries": 10000,             # Responses kept in the shared cache.
+    "cache_bytes": 64 * 1024 * 1024,    # Bytes of response bodies kept in the shared cache.
+    "cache_ttl": {                      # Seconds a 200 response is reused, per endpoint. 0 never caches it.
+        "default": 60,
+        "match_details": 24 * 3600,     # Details of a finished match do not change.
+        "player_stats": 300,
+        "player_match_list": 60,
+        "leaderboard": 60,
+        "global_stats": 300,
+        "replay": 0,                    # Large, and saved to disk by the caller anyway.
+    },
+    "backoff": 20,                      # Seconds all upstream requests pause after a 429, doubled per consecutive 429.
+    "max_backoff": 300,
+    "rate_limit_retries": 3,            # Times a request answered with 429 is queued again before the 429 is returned.
+    "timeout": 30,                      # Seconds an upstream request may take.
+}
+
+# Queue priorities, most urgent first.
+PRIORITIES = ("interactive", "normal", "bulk")
+
+# Every message is a frame: header and body lengths, a JSON header, then the body bytes.
+_FRAME = struct.Struct("<II")
+
+
+class BrokerError(OSError):
+    '''The broker could not be reached, or closed the connection before answering.'''
+
+
+def _frame(header, body=b""):
+    header = codec.dumps_bytes(header)
+    return _FRAME.pack(len(header), len(body)) + header + body
+
+
+## ---------------------------- Client ---------------------------- ##
+def _receive_exactly(sock, size):
+    received = bytearray()
+    while len(received) < size:
+        chunk = sock.recv(min(size - len(received), 1 << 20))
+        if not chunk:
+            raise BrokerError("The broker closed the connection")
+        received += chunk
+    return bytes(received)
+
+def _exchange(header, socket_path=None, timeout=None):
+    socket_path = socket_path or defaults["socket_path"]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(_frame(header))
+            header_size, body_size = _FRAME.unpack(_receive_exactly(sock, _FRAME.size))
+            return codec.loads(_receive_exactly(sock, header_size)), _receive_exactly(sock, body_size)
+    except BrokerError:
+        raise
+    except OSError as e:
+        raise BrokerError(f"Broker at {socket_path}: {e}") from e
+
+def fetch(endpoint_name, data, headers=None, priority="normal", socket_path=None, timeout=None):
+    '''
+    Sends one request through the broker.
+
+    :param endpoint_name: Key of aoe2api.endpoints.
+    :param data: The serialized JSON payload, as fetch_endpoint() sends it.
+    :param headers: Request headers, or None for aoe2api's default headers.
+    :param priority: One of PRIORITIES.
+    :param timeout: Seconds to wait for the answer, including time queued behind other requests. None waits indefinitely.
+    :return: A fetch_endpoint() response dict. "request" is None, since the request was sent by the broker.
+    '''
+    header, body = _exchange({"op": "fetch", "endpoint": endpoint_name, "data": data, "headers": headers, "priority": priority}, socket_path, timeout)
+    with profiling.span("decode"):
+        content = codec.decode_body(body, header.get("content_type"))
+    return {"status_code": header["status_code"], "request": None, "message": header.get("message"), "content": content}
+
+def stats(socket_path=None, timeout=5):
+    '''Counters of a running broker. See Broker.stats().'''
+    header, _ = _exchange({"op": "stats"}, socket_path, timeout)
+    return header
+
+
+## ---------------------------- Server ---------------------------- ##
+class _Job:
+    __slots__ = ("key", "endpoint_name", "data", "headers", "rank", "queued_at", "started", "attempts", "future")
+
+    def __init__(self, key, endpoint_name, data, headers, rank, future):
+        self.key = key
+        self.endpoint_name = endpoint_name
+        self.data = data
+        self.headers = headers
+        self.rank = rank
+        self.queued_at = time.monotonic()
+        self.started = False
+        self.attempts = 0
+        self.future = future
+
+
+class Broker:
+    '''
+    The broker server. One dispatcher takes queued requests most urgent first, each once a rate token is free,
+    and sends them on up to `workers` pooled connections. Identical requests share one upstream call and one
+    cached response; a request joined by a more urgent caller is moved up to that caller's priority.
+    A 429 pauses all upstream requests with exponential backoff (or the server's Retry-After) and queues the
+    request again, so clients rarely see it.
+    '''
+
+    def __init__(self, socket_path=defaults["socket_path"], rate=defaults["rate"], burst=defaults["burst"], workers=defaults["workers"],
+                 cache_entries=defaults["cache_entries"], cache_bytes=defaults["cache_bytes"], cache_ttl=None,
+                 backoff=defaults["backoff"], max_backoff=defaults["max_backoff"], timeout=defaults["timeout"], quiet=False):
+        # aoe2api imports this module for its client side, so the server imports it only once started.
+        from aoe2api import aoe2api
+        self._aoe2api = aoe2api
+        self.socket_path = socket_path
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        self.cache_ttl = {**defaults["cache_ttl"], **(cache_ttl or {})}
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.quiet = quiet
+        self._queue = []            # Heap of (rank, sequence, job); jobs moved up to a better rank leave stale entries behind.
+        self._sequence = itertools.count()
+        self._queue_ready = asyncio.Event()
+        self._in_flight = {}        # Request key -> queued or running _Job.
+        self._running = set()
+        self._cache = OrderedDict() # Request key -> (expires_at, header, body), least recently used first.
+        self._cache_size = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._rate_limited_in_a_row = 0
+        self._counters = {"cache_hits": 0, "merged": 0, "promoted": 0, "upstream": 0, "rate_limited": 0, "errors": 0}
+        self._priority_counters = {priority: {"requests": 0, "wait_seconds": 0.0, "queue_seconds": 0.0, "sent": 0} for priority in PRIORITIES}
+
+    ## Cache
+    def _cache_get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._cache_drop(key)
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def _cache_drop(self, key):
+        _, _, body = self._cache.pop(key)
+        self._cache_size -= len(body)
+
+    def _cache_put(self, key, endpoint_name, header, body):
+        ttl = self.cache_ttl.get(endpoint_name, self.cache_ttl["default"])
+        if header["status_code"] != 200 or ttl <= 0 or len(body) > self.cache_bytes:
+            return
+        if key in self._cache:
+            self._cache_drop(key)
+        self._cache[key] = (time.monotonic() + ttl, header, body)
+        self._cache_size += len(body)
+        while len(self._cache) > self.cache_entries or self._cache_size > self.cache_bytes:
+            self._cache_drop(next(iter(self._cache)))
+
+    ## Queue
+    def _enqueue(self, job):
+        heapq.heappush(self._queue, (job.rank, next(self._sequence), job))
+        self._queue_ready.set()
+
+    def _drop_stale(self):
+        while self._queue and (self._queue[0][2].started or self._queue[0][0] != self._queue[0][2].rank):
+            heapq.heappop(self._queue)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _dispatch(self, session):
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            await slots.acquire()
+            self._drop_stale()
+            while not self._queue:
+                self._queue_ready.clear()
+                await self._queue_ready.wait()
+                self._drop_stale()
+            # The job is picked only once a token is free, so requests queued meanwhile compete on priority.
+            await self._take_token()
+            self._drop_stale()
+            if not self._queue:
+                self._tokens += 1
+                slots.release()
+                continue
+            _, _, job = heapq.heappop(self._queue)
+            job.started = True
+            task = asyncio.create_task(self._send(session, job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _send(self, session, job):
+        try:
+            await self._request(session, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Whatever went wrong, answer every waiting client and free the key for later requests.
+            self._counters["errors"] += 1
+            self._finish(job, {"status_code": 500, "message": f"Broker error: {e!r}", "content_type": None}, b"")
+
+    async def _request(self, session, job):
+        counters = self._priority_counters[PRIORITIES[job.rank]]
+        counters["sent"] += 1
+        counters["queue_seconds"] += time.monotonic() - job.queued_at
+        self._counters["upstream"] += 1
+        job.attempts += 1
+        headers = self._aoe2api.defaults["headers"] if job.headers is None else job.headers
+        try:
+            method, url, request_args = self._aoe2api.request_arguments(job.endpoint_name, headers, job.data)
+        except (KeyError, ValueError) as e:
+            # A GET payload missing a URL parameter, or a payload that is not JSON.
+            self._finish(job, {"status_code": 400, "message": f"Invalid payload for endpoint {job.endpoint_name}: {e!r}", "content_type": None}, b"")
+            return
+        if request_args.get("headers"):
+            # The captured headers carry a fixed content-length and encodings aiohttp may not decode; aiohttp sets both itself.
+            request_args["headers"] = {name: value for name, value in request_args["headers"].items() if name.lower() not in ("content-length", "accept-encoding")}
+        try:
+            async with session.request(method, url, **request_args) as response:
+                body = await response.read()
+                header = {"status_code": response.status, "message": response.reason, "content_type": response.headers.get("Content-Type")}
+                retry_after = response.headers.get("Retry-After")
+        except Exception as e:
+            self._counters["errors"] += 1
+            self._finish(job, {"status_code": 502, "message": f"Broker upstream error: {e!r}", "content_type": None}, b"")
+            return
+
+        if header["status_code"] == 429:
+            self._counters["rate_limited"] += 1
+            self._rate_limited_in_a_row += 1
+            pause = min(self.max_backoff, self.backoff * 2 ** (self._rate_limited_in_a_row - 1))
+            if retry_after and retry_after.isdigit():
+                pause = min(self.max_backoff, max(pause, int(retry_after)))
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            if not self.quiet:
+                print(f" ! Rate limited by the API; pausing all requests for {pause}s")
+            if job.attempts <= defaults["rate_limit_retries"]:
+                job.started = False
+                job.queued_at = time.monotonic()
+                self._enqueue(job)
+                return
+        else:
+            self._rate_limited_in_a_row = 0
+        self._cache_put(job.key, job.endpoint_name, header, body)
+        self._finish(job, header, body)
+
+    def _finish(self, job, header, body):
+        self._in_flight.pop(job.key, None)
+        if not job.future.done():
+            job.future.set_result((header, body))
+
+    ## Clients
+    def _request_key(self, endpoint_name, data, headers):
+        try:
+            data = codec.dumps_canonical(codec.loads(data))
+        except (codec.DecodeError, TypeError):
+            pass
+        return endpoint_name, data, None if headers is None else codec.dumps_canonical(headers)
+
+    async def _fetch(self, request):
+        endpoint_name, data, headers = request.get("endpoint"), request.get("data"), request.get("headers")
+        if endpoint_name not in self._aoe2api.endpoints or not isinstance(data, str):
+            return {"status_code": 400, "message": f"Invalid endpoint or payload. Valid endpoints are: {list(self._aoe2api.endpoints)}", "content_type": None}, b""
+        priority = request.get("priority") if request.get("priority") in PRIORITIES else "normal"
+        rank = PRIORITIES.index(priority)
+        counters = self._priority_counters[priority]
+        counters["requests"] += 1
+        started = time.monotonic()
+        key = self._request_key(endpoint_name, data, headers)
+
+        cached = self._cache_get(key)
+        if cached is not None:
+            self._counters["cache_hits"] += 1
+            return {**cached[1], "cached": True}, cached[2]
+
+        job = self._in_flight.get(key)
+        if job is None:
+            job = self._in_flight[key] = _Job(key, endpoint_name, data, headers, rank, asyncio.get_running_loop().create_future())
+            self._enqueue(job)
+        else:
+            self._counters["merged"] += 1
+            if rank < job.rank and not job.started:
+                self._counters["promoted"] += 1
+                job.rank = rank
+                self._enqueue(job)
+        # Shielded, so a client that disconnects does not cancel the request for others.
+        header, body = await asyncio.shield(job.future)
+        counters["wait_seconds"] += time.monotonic() - started
+        return header, body
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header_size, body_size = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                    request = codec.loads(await reader.readexactly(header_size))
+                    await reader.readexactly(body_size)
+                except asyncio.IncompleteReadError:
+                    return
+                if request.get("op") == "stats":
+                    writer.write(_frame(self.stats()))
+                else:
+                    writer.write(_frame(*await self._fetch(request)))
+                await writer.drain()
+        except (ConnectionError, codec.DecodeError):
+            pass
+        finally:
+            writer.close()
+
+    def stats(self):
+        '''
+        :return: Dict with "queued" and "sent" (upstream requests) per priority, "in_flight" (requests queued or running),
+            "cache" ({"entries", "bytes", "hits"}), "merged" (requests that joined an identical one), "promoted"
+            (queued requests moved up by a more urgent caller), "rate_limited" (429 responses), "errors", "paused_for"
+            (seconds left of a 429 pause), and per priority the "requests" and "mean_wait" (seconds clients waited,
+            cache hits included) and "mean_queued" (seconds requests waited for the dispatcher).
+        '''
+        queued = {priority: 0 for priority in PRIORITIES}
+        for rank, _, job in self._queue:
+            if not job.started and rank == job.rank:
+                queued[PRIORITIES[rank]] += 1
+        priorities = {}
+        for priority, counters in self._priority_counters.items():
+            priorities[priority] = {
+                "requests": counters["requests"],
+                "sent": counters["sent"],
+                "mean_wait": counters["wait_seconds"] / counters["requests"] if counters["requests"] else 0.0,
+                "mean_queued": counters["queue_seconds"] / counters["sent"] if counters["sent"] else 0.0,
+            }
+        return {
+            "queued": queued,
+            "in_flight": len(self._in_flight),
+            "cache": {"entries": len(self._cache), "bytes": self._cache_size, "hits": self._counters["cache_hits"]},
+            "merged": self._counters["merged"],
+            "promoted": self._counters["promoted"],
+            "upstream": self._counters["upstream"],
+            "rate_limited": self._counters["rate_limited"],
+            "errors": self._counters["errors"],
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "priorities": priorities,
+        }
+
+    async def serve(self, stop=None):
+        '''
+        Serves clients until stop (an asyncio.Event) is set, or forever.
+        Refuses to start if another broker answers on the socket; a stale socket file is replaced.
+        '''
+        import aiohttp
+
+        if os.path.exists(self.socket_path):
+            try:
+                stats(self.socket_path, timeout=1)
+            except BrokerError:
+                os.unlink(self.socket_path)
+            else:
+                raise OSError(f"A broker is already serving {self.socket_path}")
+        connector = aiohttp.TCPConnector(limit=self.workers)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+            dispatcher = asyncio.create_task(self._dispatch(session))
+            if not self.quiet:
+                print(f" * Broker serving {self.socket_path}: {self.rate}/s, burst {self.burst}, {self.workers} connections")
+            try:
+                async with server:
+                    if stop is None:
+                        await server.serve_forever()
+                    else:
+                        await stop.wait()
+            finally:
+                dispatcher.cancel()
+                for task in list(self._running):
+                    task.cancel()
+                await asyncio.gather(dispatcher, *self._running, return_exceptions=True)
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+
+
+def main(args):
+    if args.stats:
+        print(codec.dumps(stats(args.socket)))
+        return
+    broker = Broker(socket_path=args.socket, rate=args.rate, burst=args.burst, workers=args.workers,
+                    cache_entries=args.cache_entries, cache_bytes=args.cache_mb * 1024 * 1024, quiet=args.quiet)
+    try:
+        asyncio.run(broker.serve())
+    except KeyboardInterrupt:
+        pass
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Run the local AoE2 API request broker, or print the counters of a running one.")
+    parser.add_argument("-s", "--socket", type=str, default=defaults["socket_path"], help="Unix socket to serve on")
+    parser.add_argument("--rate", type=float, default=defaults["rate"], help="Upstream requests per second")
+    parser.add_argument("--burst", type=int, default=defaults["burst"], help="Requests sent back to back after an idle period")
+    parser.add_argument("-w", "--workers", type=int, default=defaults["workers"], help="Concurrent upstream requests")
+    parser.add_argument("--cache-entries", type=int, default=defaults["cache_entries"], help="Responses kept in the cache")
+    parser.add_argument("--cache-mb", type=int, default=defaults["cache_bytes"] // (1024 * 1024), help="Megabytes of responses kept in the cache")
+    parser.add_argument("--stats", action="store_true", help="Print the counters of the broker on --socket and exit")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Don't print status messages")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "broker"):
+        main(args)
@@ -0,0 +1,387 @@
+"""Leaderboard snapshots stored as typed arrays, with sorted-merge diffs and rating analytics."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2api import aoe2api
+from shared import codec, profiling
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import cached_property
+from itertools import compress
+from operator import itemgetter, or_, sub
+import argparse
+import math
+import time
+
+defaults = {
+    "region": 7,
+    "match_type": 3,
+    "count": 100,                       # Players per leaderboard page.
+    "pages": 0,                         # Pages to fetch. 0 fetches the whole leaderboard.
+    "request_interval": 1,              # Delay between page requests in seconds.
+    "snapshot_folder": "leaderboard_snapshots",
+    "histogram_bin_width": 100,
+}
+
+# Snapshot columns, all int64 and sorted by profile ID, with the leaderboard item keys they are read from.
+COLUMNS = ("profile_ids", "ranks", "ratings", "wins", "losses")
+_ITEM_KEYS = {
+    "profile_ids": ("rlUserId",),
+    "ranks": ("rank",),
+    "ratings": ("elo", "rating", "eloRating"),
+    "wins": ("wins",),
+    "losses": ("losses",),
+}
+_FORMAT = 1
+
+
+def _item_value(item, keys):
+    for key in keys:
+        value = item.get(key)
+        if value is not None:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class LeaderboardSnapshot:
+    '''
+    One leaderboard at one point in time, as int64 arrays (see COLUMNS) sorted by profile ID.
+    A player listed twice, as can happen when the leaderboard shifts between page requests, keeps their best rank.
+    '''
+
+    def __init__(self, profile_ids, ranks, ratings, wins, losses, taken_at=None, region=None, match_type=None):
+        self.taken_at = int(time.time()) if taken_at is None else int(taken_at)
+        self.region = region
+        self.match_type = match_type
+        columns = [array("q", values) for values in (profile_ids, ranks, ratings, wins, losses)]
+        if len({len(values) for values in columns}) > 1:
+            raise ValueError("Snapshot columns must have the same length")
+        ids = columns[0]
+        if any(ids[index] >= ids[index + 1] for index in range(len(ids) - 1)):
+            order = sorted(range(len(ids)), key=lambda index: (ids[index], columns[1][index]))
+            keep = [index for position, index in enumerate(order) if position == 0 or ids[index] != ids[order[position - 1]]]
+            columns = [array("q", (values[index] for index in keep)) for values in columns]
+        self.profile_ids, self.ranks, self.ratings, self.wins, self.losses = columns
+        self._sorted_ratings = None
+
+    @classmethod
+    def from_items(cls, items, taken_at=None, region=None, match_type=None):
+        '''Builds a snapshot from leaderboard items (the "items" of fetch_leaderboard() pages). Items without a profile ID are skipped.'''
+        columns = {name: [] for name in COLUMNS}
+        for item in items:
+            profile_id = _item_value(item, _ITEM_KEYS["profile_ids"])
+            if profile_id is None:
+                continue
+            columns["profile_ids"].append(profile_id)
+            for name in COLUMNS[1:]:
+                value = _item_value(item, _ITEM_KEYS[name])
+                columns[name].append(0 if value is None else value)
+        return cls(*(columns[name] for name in COLUMNS), taken_at=taken_at, region=region, match_type=match_type)
+
+    def __len__(self):
+        return len(self.profile_ids)
+
+    def __contains__(self, profile_id):
+        return self.index_of(profile_id) is not None
+
+    def index_of(self, profile_id):
+        '''Returns the row of a profile ID, or None if the player is not on this leaderboard.'''
+        index = bisect_left(self.profile_ids, int(profile_id))
+        if index < len(self.profile_ids) and self.profile_ids[index] == int(profile_id):
+            return index
+        return None
+
+    def get(self, profile_id):
+        '''Returns {"profile_id", "rank", "rating", "wins", "losses"} for a player, or None.'''
+        index = self.index_of(profile_id)
+        if index is None:
+            return None
+        return {
+            "profile_id": self.profile_ids[index],
+            "rank": self.ranks[index],
+            "rating": self.ratings[index],
+            "wins": self.wins[index],
+            "losses": self.losses[index],
+        }
+
+    ## ---------------------------- Rating analytics ---------------------------- ##
+    def sorted_ratings(self):
+        '''Ratings in ascending order, computed once per snapshot.'''
+        if self._sorted_ratings is None:
+            self._sorted_ratings = array("q", sorted(self.ratings))
+        return self._sorted_ratings
+
+    def percentile(self, rating):
+        '''Percentage of players rated at or below rating.'''
+        ratings = self.sorted_ratings()
+        if not ratings:
+            return 0.0
+        return 100.0 * bisect_right(ratings, rating) / len(ratings)
+
+    def rating_at_percentile(self, percent):
+        '''Lowest rating at or above which `100 - percent` % of players are rated (nearest rank), e.g. 99 for the top 1%.'''
+        ratings = self.sorted_ratings()
+        if not ratings:
+            return None
+        if not 0 <= percent <= 100:
+            raise ValueError(f"percent must be between 0 and 100, not {percent}")
+        return ratings[max(0, math.ceil(percent / 100 * len(ratings)) - 1)]
+
+    def histogram(self, bin_width=defaults["histogram_bin_width"], start=None):
+        '''
+        Counts players per rating bin.
+
+        :param bin_width: Width of each bin in rating points.
+        :param start: Lower edge of the first bin. Defaults to the lowest rating rounded down to bin_width.
+        :return: List of (lower edge, count), covering every rating from start up.
+        '''
+        ratings = self.sorted_ratings()
+        if not ratings:
+            return []
+        if start is None:
+            start = ratings[0] // bin_width * bin_width
+        bins = []
+        lower = start
+        position = bisect_left(ratings, start)
+        while position < len(ratings):
+            end = bisect_left(ratings, lower + bin_width, position)
+            bins.append((lower, end - position))
+            position = end
+            lower += bin_width
+        return bins
+
+    ## ---------------------------- Storage ---------------------------- ##
+    def save(self, path):
+        '''Writes the snapshot as one JSON header line followed by the raw int64 columns.'''
+        header = {
+            "format": _FORMAT,
+            "byteorder": sys.byteorder,
+            "rows": len(self),
+            "taken_at": self.taken_at,
+            "region": self.region,
+            "match_type": self.match_type,
+        }
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(codec.dumps_bytes(header) + b"\n")
+            for name in COLUMNS:
+                getattr(self, name).tofile(file)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        '''Reads a snapshot written by save().'''
+        with open(path, "rb") as file:
+            header = codec.loads(file.readline())
+            if header.get("format") != _FORMAT:
+                raise ValueError(f"{path}: unsupported snapshot format {header.get('format')!r}")
+            columns = []
+            for _ in COLUMNS:
+                values = array("q")
+                values.fromfile(file, header["rows"])
+                if header["byteorder"] != sys.byteorder:
+                    values.byteswap()
+                columns.append(values)
+        return cls(*columns, taken_at=header["taken_at"], region=header["region"], match_type=header["match_type"])
+
+
+def _gather(values, rows):
+    # values[row] for each row, as a list or tuple; itemgetter does the lookups in C.
+    values = values.tolist()
+    if isinstance(rows, range) and len(rows) == len(values):
+        return values
+    if len(rows) < 2:
+        return [values[row] for row in rows]
+    return itemgetter(*rows)(values)
+
+
+class LeaderboardDiff:
+    '''
+    Changes between two snapshots, joined on profile ID.
+
+    profile_ids holds the players on both leaderboards, with rank_deltas, rating_deltas, wins_deltas
+    and losses_deltas aligned to it (new minus old; a negative rank delta is a climb). Each delta array
+    is computed on first access. new_profile_ids and dropped_profile_ids hold the players only on the
+    newer or only on the older snapshot.
+    '''
+
+    def __init__(self, old, new, old_rows, new_rows, new_profile_ids, dropped_profile_ids):
+        self.old = old
+        self.new = new
+        self._old_rows = old_rows
+        self._new_rows = new_rows
+        self.profile_ids = array("q", _gather(new.profile_ids, new_rows))
+        self.new_profile_ids = new_profile_ids
+        self.dropped_profile_ids = dropped_profile_ids
+
+    def _deltas(self, name):
+        before = _gather(getattr(self.old, name), self._old_rows)
+        after = _gather(getattr(self.new, name), self._new_rows)
+        return array("q", map(sub, after, before))
+
+    @cached_property
+    def rank_deltas(self):
+        return self._deltas("ranks")
+
+    @cached_property
+    def rating_deltas(self):
+        return self._deltas("ratings")
+
+    @cached_property
+    def wins_deltas(self):
+        return self._deltas("wins")
+
+    @cached_property
+    def losses_deltas(self):
+        return self._deltas("losses")
+
+    def active_profile_ids(self):
+        '''Players on both leaderboards who played a game between the snapshots.'''
+        return array("q", compress(self.profile_ids, map(or_, self.wins_deltas, self.losses_deltas)))
+
+    def movers(self, limit=10, by="rank"):
+        '''
+        Returns the biggest climbers and fallers as two lists of (profile ID, delta).
+
+        :param by: "rank" (climbers have the most negative delta) or "rating" (climbers have the most positive).
+        '''
+        if by not in ("rank", "rating"):
+            raise ValueError(f"by must be 'rank' or 'rating', not {by!r}")
+        deltas = self.rank_deltas if by == "rank" else self.rating_deltas
+        order = sorted(range(len(deltas)), key=deltas.__getitem__)
+        lowest = [(self.profile_ids[index], deltas[index]) for index in order[:limit] if deltas[index] < 0]
+        highest = [(self.profile_ids[index], deltas[index]) for index in reversed(order[-limit:]) if deltas[index] > 0]
+        return (lowest, highest) if by == "rank" else (highest, lowest)
+
+    def summary(self):
+        '''Counts of kept, new, dropped, and active players, plus the mean rating change of the kept ones.'''
+        kept = len(self.profile_ids)
+        return {
+            "kept": kept,
+            "new": len(self.new_profile_ids),
+            "dropped": len(self.dropped_profile_ids),
+            "active": len(self.active_profile_ids()),
+            "mean_rating_delta": sum(self.rating_deltas) / kept if kept else 0.0,
+        }
+
+
+def diff_snapshots(old, new):
+    '''
+    Diffs two snapshots with one sorted-merge pass over their profile IDs.
+    Two snapshots of the same players (the common case between polls) skip the merge entirely.
+
+    :return: LeaderboardDiff from old to new.
+    '''
+    with profiling.span("diff"):
+        if old.profile_ids == new.profile_ids:
+            rows = range(len(new.profile_ids))
+            return LeaderboardDiff(old, new, rows, rows, array("q"), array("q"))
+        old_ids, new_ids = old.profile_ids.tolist(), new.profile_ids.tolist()
+        old_rows, new_rows, new_only, dropped = [], [], array("q"), array("q")
+        i = j = 0
+        old_count, new_count = len(old_ids), len(new_ids)
+        while i < old_count and j < new_count:
+            old_id = old_ids[i]
+            new_id = new_ids[j]
+            if old_id == new_id:
+                old_rows.append(i)
+                new_rows.append(j)
+                i += 1
+                j += 1
+            elif old_id < new_id:
+                dropped.append(old_id)
+                i += 1
+            else:
+                new_only.append(new_id)
+                j += 1
+        dropped.extend(old_ids[i:])
+        new_only.extend(new_ids[j:])
+        return LeaderboardDiff(old, new, old_rows, new_rows, new_only, dropped)
+
+
+def fetch_snapshot(region=defaults["region"], match_type=defaults["match_type"], pages=defaults["pages"], count=defaults["count"], request_interval=defaults["request_interval"], quiet=False):
+    '''
+    Fetches leaderboard pages and returns them as one snapshot.
+
+    :param pages: Pages to fetch, e.g. 5 for the top 500 at count=100. 0 fetches until a short page.
+    '''
+    items = []
+    page = 1
+    while not pages or page <= pages:
+        response = aoe2api.fetch_leaderboard(region=str(region), match_type=str(match_type), page=page, count=count, quiet=quiet)
+        if response.get("status_code") != 200:
+            if not quiet:
+                print(f" ! Leaderboard page {page}: {response.get('status_code')} {response.get('message')}")
+            break
+        page_items = (response.get("content") or {}).get("items") or []
+        items.extend(page_items)
+        if len(page_items) < count:
+            break
+        page += 1
+        time.sleep(request_interval)
+    return LeaderboardSnapshot.from_items(items, region=region, match_type=match_type)
+
+
+def snapshot_path(snapshot, folder=defaults["snapshot_folder"]):
+    '''Default file name of a snapshot: <region>-<match type>-<taken_at>.lb in folder.'''
+    return os.path.join(folder, f"{snapshot.region}-{snapshot.match_type}-{snapshot.taken_at}.lb")
+
+
+def main(args):
+    aoe2api.defaults["broker_priority"] = "bulk"
+    if args.diff:
+        old, new = (LeaderboardSnapshot.load(path) for path in args.diff)
+        diff = diff_snapshots(old, new)
+        print(diff.summary())
+        climbers, fallers = diff.movers(limit=args.top, by=args.by)
+        for title, movers in (("Climbers", climbers), ("Fallers", fallers)):
+            print(f"{title}:")
+            for profile_id, delta in movers:
+                print(f"  {profile_id}\t{delta:+d}")
+        return
+    if args.load:
+        snapshot = LeaderboardSnapshot.load(args.load)
+    else:
+        snapshot = fetch_snapshot(region=args.region, match_type=args.match_type, pages=args.pages, request_interval=args.request_interval, quiet=args.quiet)
+        path = snapshot_path(snapshot, args.folder)
+        snapshot.save(path)
+        if not args.quiet:
+            print(f" * Saved {len(snapshot)} players to {path}")
+    if args.percentile is not None:
+        print(f"Rating at percentile {args.percentile}: {snapshot.rating_at_percentile(args.percentile)}")
+    if args.histogram:
+        for lower, count in snapshot.histogram(bin_width=args.histogram):
+            print(f"{lower}\t{count}")
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Snapshot the leaderboard, diff two snapshots, or query rating percentiles.")
+    parser.add_argument("-r", "--region", type=int, default=defaults["region"], help="Leaderboard region")
+    parser.add_argument("-mt", "--match-type", type=int, default=defaults["match_type"], help="Leaderboard match type")
+    parser.add_argument("--pages", type=int, default=defaults["pages"], help="Pages of 100 players to fetch (0 = all)")
+    parser.add_argument("--request-interval", type=float, default=defaults["request_interval"], help="Delay between page requests in seconds")
+    parser.add_argument("-f", "--folder", type=str, default=defaults["snapshot_folder"], help="Folder new snapshots are saved to")
+    parser.add_argument("--load", type=str, default=None, help="Query a saved snapshot instead of fetching one")
+    parser.add_argument("--diff", type=str, nargs=2, metavar=("OLD", "NEW"), default=None, help="Diff two saved snapshots")
+    parser.add_argument("--by", choices=("rank", "rating"), default="rank", help="Order movers by rank or rating change")
+    parser.add_argument("--top", type=int, default=10, help="Climbers and fallers to list")
+    parser.add_argument("--percentile", type=float, default=None, help="Print the rating at this percentile")
+    parser.add_argument("--histogram", type=int, default=None, metavar="BIN_WIDTH", help="Print a rating histogram with this bin width")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Don't print request progress")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "leaderboard"):
+        main(args)
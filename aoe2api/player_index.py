@@ -0,0 +1,302 @@
+"""Local player-name index built from leaderboard pages, for name lookups without a live search."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import codec, profiling
+from bisect import bisect_left
+from collections import Counter
+import argparse
+import threading
+import time
+
+defaults = {
+    "index_file": "player_index.json",
+    "region": 7,
+    "match_type": 3,
+    "count": 100,               # Players per leaderboard page.
+    "pages": 0,                 # Pages crawled per refresh. 0 crawls the whole leaderboard.
+    "request_interval": 1,      # Delay between page requests in seconds.
+    "limit": 10,                # Candidates returned by search().
+}
+
+# Leaderboard item keys kept per player, in the shape fetch_leaderboard() returns them.
+_ITEM_KEYS = ("rlUserId", "userName", "elo", "rank")
+_FORMAT = 1
+
+# Match kinds in ranking order.
+EXACT, CASEFOLD, PREFIX, FUZZY = "exact", "casefold", "prefix", "fuzzy"
+_TIERS = {EXACT: 0, CASEFOLD: 1, PREFIX: 2, FUZZY: 3}
+
+
+def to_entry(item, seen_at=None):
+    '''The stored form of a leaderboard item: its _ITEM_KEYS plus "seenAt", in epoch seconds (default now).'''
+    entry = {key: item.get(key) for key in _ITEM_KEYS}
+    entry["seenAt"] = int(time.time()) if seen_at is None else int(seen_at)
+    return entry
+
+def fold(name):
+    '''Case-insensitive form of a player name used as the index key.'''
+    return " ".join(str(name).split()).casefold()
+
+def _trigrams(folded):
+    padded = f"  {folded} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+def _default_max_distance(query):
+    return 0 if len(query) < 3 else 1 if len(query) < 6 else 2
+
+def edit_distance(a, b, limit=None):
+    '''Levenshtein distance between a and b, or limit + 1 once it is known to exceed limit.'''
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class PlayerIndex:
+    '''
+    Players by name, from leaderboard items: {"rlUserId", "userName", "elo", "rank", "seenAt"} per profile ID.
+
+    Names are kept as a sorted array of folded (case-insensitive) keys for exact and prefix lookups,
+    plus a trigram index for fuzzy matching; both are rebuilt on the first lookup after a change.
+    add_items() upserts by profile ID, so re-crawling pages refreshes renamed players in place.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.updated_at = None
+        self._players = {}
+        self._lock = threading.Lock()
+        self._keys = None
+        self._key_ids = None
+        self._trigram_index = None
+
+    def __len__(self):
+        return len(self._players)
+
+    def get(self, profile_id):
+        '''Returns the stored item of a profile ID, or None.'''
+        return self._players.get(str(profile_id))
+
+    def add_items(self, items, seen_at=None):
+        '''
+        Adds or refreshes players from leaderboard items.
+
+        :return: Number of players that were new or changed name.
+        '''
+        seen_at = int(time.time()) if seen_at is None else int(seen_at)
+        changed = 0
+        with self._lock:
+            for item in items:
+                profile_id, name = item.get("rlUserId"), item.get("userName")
+                if profile_id is None or not name:
+                    continue
+                stored = to_entry(item, seen_at)
+                previous = self._players.get(str(profile_id))
+                if previous is None or previous["userName"] != name:
+                    changed += 1
+                self._players[str(profile_id)] = stored
+            if changed:
+                self._keys = self._key_ids = self._trigram_index = None
+            self.updated_at = seen_at
+        return changed
+
+    def _build(self):
+        # Returns (keys, key_ids, trigram index) as of now; add_items() replaces rather than mutates them.
+        with self._lock:
+            if self._keys is not None:
+                return self._keys, self._key_ids, self._trigram_index
+            with profiling.span("name_index"):
+                entries = sorted((fold(player["userName"]), profile_id) for profile_id, player in self._players.items())
+                trigram_index = {}
+                for position, (key, _) in enumerate(entries):
+                    for trigram in _trigrams(key):
+                        trigram_index.setdefault(trigram, []).append(position)
+                self._key_ids = [profile_id for _, profile_id in entries]
+                self._trigram_index = trigram_index
+                self._keys = [key for key, _ in entries]
+            return self._keys, self._key_ids, self._trigram_index
+
+    def _candidate(self, profile_id, match, distance):
+        player = dict(self._players[profile_id])
+        player["match"] = match
+        player["distance"] = distance
+        return player
+
+    def search(self, name, limit=defaults["limit"], fuzzy=True, max_distance=None):
+        '''
+        Finds players by name, best candidates first.
+
+        Candidates are ranked by match kind (exact, then case-insensitive, prefix, and fuzzy), then by
+        edit distance, then by rating, so the more likely of two similar names comes first.
+
+        :param max_distance: Largest edit distance of a fuzzy match. Defaults to 0-2 by name length.
+        :return: Stored items with "match" (kind) and "distance" (edit distance of the folded names) added.
+        '''
+        keys, key_ids, trigram_index = self._build()
+        query = fold(name)
+        if not query:
+            return []
+        found = {}
+        position = bisect_left(keys, query)
+        while position < len(keys) and keys[position].startswith(query):
+            key = keys[position]
+            if key == query:
+                match = EXACT if self._players[key_ids[position]]["userName"] == name else CASEFOLD
+                found[position] = (match, 0)
+            else:
+                found[position] = (PREFIX, len(key) - len(query))
+            position += 1
+        if fuzzy:
+            if max_distance is None:
+                max_distance = _default_max_distance(query)
+            if max_distance:
+                query_trigrams = _trigrams(query)
+                shared = Counter()
+                for trigram in query_trigrams:
+                    shared.update(trigram_index.get(trigram, ()))
+                # Each edit changes at most three trigrams.
+                needed = max(1, len(query_trigrams) - 3 * max_distance)
+                for position, count in shared.items():
+                    if count >= needed and position not in found:
+                        distance = edit_distance(query, keys[position], max_distance)
+                        if distance <= max_distance:
+                            found[position] = (FUZZY, distance)
+        players = self._players
+
+        def rank(position):
+            match, distance = found[position]
+            return _TIERS[match], distance, -(players[key_ids[position]].get("elo") or 0), keys[position]
+
+        return [self._candidate(key_ids[position], *found[position]) for position in sorted(found, key=rank)[:limit]]
+
+    def lookup(self, name):
+        '''
+        Returns the player with exactly this name, or None. An exact-case match wins, then the
+        highest-rated case-insensitive one. Prefix and fuzzy matches are never returned here.
+        '''
+        keys, key_ids, _ = self._build()
+        query = fold(name)
+        position = bisect_left(keys, query)
+        best = None
+        while query and position < len(keys) and keys[position] == query:
+            player = self._players[key_ids[position]]
+            if player["userName"] == name:
+                return self._candidate(key_ids[position], EXACT, 0)
+            if best is None or (player.get("elo") or 0) > (self._players[best].get("elo") or 0):
+                best = key_ids[position]
+            position += 1
+        return None if best is None else self._candidate(best, CASEFOLD, 0)
+
+    ## ---------------------------- Storage ---------------------------- ##
+    def save(self, path=None):
+        '''Writes the index as JSON to path (default: the path it was loaded from).'''
+        path = path or self.path
+        if not path:
+            raise ValueError("No path to save the player index to")
+        with self._lock:
+            document = {"format": _FORMAT, "updatedAt": self.updated_at, "players": list(self._players.values())}
+            data = codec.dumps_bytes(document)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path=defaults["index_file"]):
+        '''Reads an index written by save(). A missing file gives an empty index that saves to path.'''
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        with open(path, "rb") as file:
+            document = codec.loads(file.read())
+        if document.get("format") != _FORMAT:
+            raise ValueError(f"{path}: unsupported player index format {document.get('format')!r}")
+        index._players = {str(player["rlUserId"]): player for player in document.get("players", [])}
+        index.updated_at = document.get("updatedAt")
+        return index
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+def default_index():
+    '''The index at defaults["index_file"], loaded once per process (empty if the file does not exist).'''
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = PlayerIndex.load(defaults["index_file"])
+        return _default_index
+
+
+def crawl(index, fetch_page, pages=defaults["pages"], count=defaults["count"], request_interval=defaults["request_interval"], quiet=False):
+    '''
+    Refreshes an index from leaderboard pages.
+
+    :param fetch_page: Called with (page, count); returns a fetch_leaderboard() response.
+    :param pages: Pages to crawl. 0 crawls until a short page.
+    :return: {"pages": pages crawled, "players": players seen, "changed": new or renamed players}
+    '''
+    counts = {"pages": 0, "players": 0, "changed": 0}
+    page = 1
+    while not pages or page <= pages:
+        response = fetch_page(page, count)
+        if response.get("status_code") != 200:
+            if not quiet:
+                print(f" ! Leaderboard page {page}: {response.get('status_code')} {response.get('message')}")
+            break
+        items = (response.get("content") or {}).get("items") or []
+        counts["pages"] += 1
+        counts["players"] += len(items)
+        counts["changed"] += index.add_items(items)
+        if len(items) < count:
+            break
+        page += 1
+        time.sleep(request_interval)
+    return counts
+
+
+def main(args):
+    index = PlayerIndex.load(args.index)
+    if args.refresh:
+        from aoe2api import aoe2api
+        aoe2api.defaults["broker_priority"] = "bulk"
+        fetch_page = lambda page, count: aoe2api.fetch_leaderboard(region=str(args.region), match_type=str(args.match_type), page=page, count=count, quiet=args.quiet)
+        counts = crawl(index, fetch_page, pages=args.pages, request_interval=args.request_interval, quiet=args.quiet)
+        index.save()
+        print(f" * {counts['players']} players on {counts['pages']} pages, {counts['changed']} new or renamed; {len(index)} indexed")
+    for name in args.search or []:
+        for player in index.search(name, limit=args.limit):
+            print(f"{player['userName']}\t{player['rlUserId']}\t{player.get('elo')}\t{player['match']}")
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Build the local player-name index from leaderboard pages, or search it.")
+    parser.add_argument("-i", "--index", type=str, default=defaults["index_file"], help="Index file")
+    parser.add_argument("--refresh", action="store_true", help="Crawl leaderboard pages into the index")
+    parser.add_argument("-r", "--region", type=int, default=defaults["region"], help="Leaderboard region")
+    parser.add_argument("-mt", "--match-type", type=int, default=defaults["match_type"], help="Leaderboard match type")
+    parser.add_argument("--pages", type=int, default=defaults["pages"], help="Pages of 100 players to crawl (0 = all)")
+    parser.add_argument("--request-interval", type=float, default=defaults["request_interval"], help="Delay between page requests in seconds")
+    parser.add_argument("-s", "--search", type=str, nargs="+", default=None, help="Names to search for")
+    parser.add_argument("--limit", type=int, default=defaults["limit"], help="Candidates to print per search")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Don't print request progress")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "player_index"):
+        main(args)
@@ -0,0 +1,246 @@
+"""Bounded time-series store for lobby activity, fed by MatchBook deltas.
+
+Counters are kept in fixed-interval ring buffers for three tiers (1 minute,
+1 hour, 1 day). Every sample is added to all tiers at once, so coarser tiers
+are exact downsamples of the finer ones. Memory is fixed by the tier sizes and
+the number of series, however long the process runs.
+"""
+
+import asyncio
+import json
+import os
+import struct
+import time
+from array import array
+from pathlib import Path
+from typing import Optional
+
+from lobby.match_book import MatchBook, MatchBookDelta
+
+
+# (name, bucket seconds, buckets kept)
+TIERS = (
+    ("minute", 60, 1440),       # 1 day of minutes
+    ("hour", 3600, 24 * 90),    # 90 days of hours
+    ("day", 86400, 365 * 5),    # 5 years of days
+)
+
+_FILE_MAGIC = b"AKTS"
+_FILE_VERSION = 1
+_FILE_HEADER = struct.Struct("<4sHI")   # magic, version, metadata length
+_EMPTY_BUCKET = -1
+
+
+class _Tier:
+    def __init__(self, name: str, interval: int, capacity: int):
+        self.name = name
+        self.interval = interval
+        self.capacity = capacity
+        # Which absolute bucket number each ring position currently holds.
+        self.buckets = array("q", [_EMPTY_BUCKET]) * capacity
+        self.series: dict[str, array] = {}
+
+    def _position(self, bucket: int) -> int:
+        position = bucket % self.capacity
+        if self.buckets[position] != bucket:
+            # Reusing a slot from an older bucket: zero it across every series.
+            self.buckets[position] = bucket
+            for values in self.series.values():
+                values[position] = 0
+        return position
+
+    def _values(self, series: str) -> array:
+        values = self.series.get(series)
+        if values is None:
+            values = array("q", [0]) * self.capacity
+            self.series[series] = values
+        return values
+
+    def add(self, series: str, timestamp: float, amount: int) -> None:
+        bucket = int(timestamp // self.interval)
+        values = self._values(series)
+        values[self._position(bucket)] += amount
+
+    def maximum(self, series: str, timestamp: float, value: int) -> None:
+        bucket = int(timestamp // self.interval)
+        values = self._values(series)
+        position = self._position(bucket)
+        if value > values[position]:
+            values[position] = value
+
+    def range(self, series: str, start: float, end: float) -> list[tuple[int, int]]:
+        values = self.series.get(series)
+        first = int(start // self.interval)
+        last = int(end // self.interval)
+        first = max(first, last - self.capacity + 1)
+        result = []
+        for bucket in range(first, last + 1):
+            position = bucket % self.capacity
+            value = values[position] if values is not None and self.buckets[position] == bucket else 0
+            result.append((bucket * self.interval, value))
+        return result
+
+
+class ActivityStore:
+    '''
+    Per-minute/hour/day counters of lobby activity.
+
+    Series are named "<context>.<metric>" or "<context>.<metric>.<label>:<value>", e.g.
+    "lobby.created", "lobby.created.map:Arabia", "lobby.created.elotype:3",
+    "lobby.removed", and the gauge "lobby.active" (peak match count per bucket).
+    '''
+
+    def __init__(self, path: Optional[str] = None, tiers=TIERS, max_series: int = 512):
+        '''
+        :param path: Directory for flushed tier files. Existing files are loaded on construction.
+        :param max_series: Cap on distinct series. Once reached, new labelled series (e.g. custom
+            map names) are folded into "<context>.<metric>.<label>:other".
+        '''
+        self.path = path
+        self.max_series = max_series
+        self.tiers = {name: _Tier(name, interval, capacity) for name, interval, capacity in tiers}
+        self._flush_task: Optional[asyncio.Task] = None
+        if path:
+            self.load()
+
+    ## ---------------------------- Ingest ---------------------------- ##
+    def add(self, series: str, amount: int = 1, timestamp: Optional[float] = None) -> None:
+        timestamp = time.time() if timestamp is None else timestamp
+        for tier in self.tiers.values():
+            tier.add(series, timestamp, amount)
+
+    def gauge(self, series: str, value: int, timestamp: Optional[float] = None) -> None:
+        timestamp = time.time() if timestamp is None else timestamp
+        for tier in self.tiers.values():
+            tier.maximum(series, timestamp, value)
+
+    def attach(self, book: MatchBook) -> "ActivityStore":
+        book.add_update_listener(self._on_update)
+        return self
+
+    def detach(self, book: MatchBook) -> None:
+        book.remove_update_listener(self._on_update)
+
+    def _labelled(self, prefix: str, label: str, value) -> str:
+        series = f"{prefix}.{label}:{value}"
+        tier = next(iter(self.tiers.values()))
+        if series in tier.series or len(tier.series) < self.max_series:
+            return series
+        return f"{prefix}.{label}:other"
+
+    def _on_update(self, book: MatchBook, delta: MatchBookDelta) -> None:
+        now = time.time()
+        context = book.subscription_type
+        for match in delta.added:
+            self.add(f"{context}.created", 1, now)
+            map_name = match.get("map_name")
+            if map_name is not None:
+                self.add(self._labelled(f"{context}.created", "map", map_name), 1, now)
+            elotype = match.get("elotype")
+            if elotype is not None:
+                self.add(self._labelled(f"{context}.created", "elotype", elotype), 1, now)
+        if delta.removed:
+            self.add(f"{context}.removed", len(delta.removed), now)
+        self.gauge(f"{context}.active", len(book), now)
+
+    ## ---------------------------- Query ---------------------------- ##
+    def series_names(self, prefix: str = "") -> list[str]:
+        names = set()
+        for tier in self.tiers.values():
+            names.update(name for name in tier.series if name.startswith(prefix))
+        return sorted(names)
+
+    def query(self, series: str, start: float, end: Optional[float] = None, tier: Optional[str] = None) -> list[tuple[int, int]]:
+        '''
+        Return (bucket start timestamp, value) pairs covering [start, end].
+
+        :param tier: "minute", "hour" or "day". Defaults to the finest tier that still holds start.
+        '''
+        end = time.time() if end is None else end
+        if tier is None:
+            tier = next(
+                (t.name for t in self.tiers.values() if start >= end - t.interval * t.capacity),
+                list(self.tiers)[-1],
+            )
+        return self.tiers[tier].range(series, start, end)
+
+    ## ---------------------------- Persistence ---------------------------- ##
+    def _tier_file(self, name: str) -> Path:
+        return Path(self.path) / f"activity_{name}.bin"
+
+    def _serialize(self) -> dict[str, bytes]:
+        blobs = {}
+        for tier in self.tiers.values():
+            series_names = list(tier.series)
+            metadata = json.dumps(
+                {"interval": tier.interval, "capacity": tier.capacity, "series": series_names},
+                separators=(",", ":"),
+            ).encode("utf-8")
+            blobs[tier.name] = b"".join(
+                [_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, len(metadata)), metadata, tier.buckets.tobytes()]
+                + [tier.series[name].tobytes() for name in series_names]
+            )
+        return blobs
+
+    def _write(self, blobs: dict[str, bytes]) -> None:
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        for name, blob in blobs.items():
+            target = self._tier_file(name)
+            temp_path = target.with_name(target.name + ".tmp")
+            with open(temp_path, "wb") as f:
+                f.write(blob)
+            os.replace(temp_path, target)
+
+    def flush(self) -> None:
+        '''Write every tier to "<path>/activity_<tier>.bin" (header, JSON metadata, raw int64 arrays).'''
+        if self.path:
+            self._write(self._serialize())
+
+    def load(self) -> None:
+        for tier in self.tiers.values():
+            target = self._tier_file(tier.name)
+            if not target.exists():
+                continue
+            try:
+                loaded = self._read_tier(tier, target)
+            except (OSError, ValueError, EOFError, KeyError, struct.error) as e:
+                # A truncated or garbled file (e.g. a crash mid-write) starts that tier empty.
+                print(f" ! Ignoring unreadable activity file '{target}': {e}")
+                continue
+            if loaded is not None:
+                tier.buckets, tier.series = loaded
+
+    def _read_tier(self, tier: "_Tier", target: Path) -> Optional[tuple[array, dict[str, array]]]:
+        with open(target, "rb") as f:
+            magic, version, metadata_length = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+            if magic != _FILE_MAGIC or version != _FILE_VERSION:
+                print(f" ! Ignoring unrecognized activity file '{target}'")
+                return None
+            metadata = json.loads(f.read(metadata_length))
+            if metadata["interval"] != tier.interval or metadata["capacity"] != tier.capacity:
+                print(f" ! Ignoring activity file '{target}' written with a different tier layout")
+                return None
+            buckets = array("q")
+            buckets.fromfile(f, tier.capacity)
+            series = {}
+            for name in metadata["series"]:
+                values = array("q")
+                values.fromfile(f, tier.capacity)
+                series[name] = values
+        return buckets, series
+
+    async def _flush_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            # Copy the arrays on the loop thread, write them off-thread.
+            blobs = self._serialize()
+            try:
+                await asyncio.to_thread(self._write, blobs)
+            except OSError as e:
+                print(f" ! Failed to flush activity store to '{self.path}': {e}")
+
+    def start_flushing(self, interval: float = 60.0):
+        '''Start a background task flushing to disk every interval seconds. Needs a running event loop.'''
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop(interval))
+        return self._flush_task
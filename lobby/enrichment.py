@@ -0,0 +1,203 @@
+"""Batched, deduplicated player-stats prefetch for matches entering a MatchBook."""
+
+import asyncio
+import time
+from typing import Callable, Optional
+
+from lobby.match_book import MatchBook, MatchBookDelta
+from lobby.utils import iter_slots
+
+
+defaults = {
+    "match_type": 3,
+    "max_concurrency": 4,       # Simultaneous fetch_player_stats calls.
+    "requests_per_second": 2.0, # Rate budget shared by all fetches of one prefetcher.
+    "ttl": 600.0,               # Seconds a successful result is reused.
+    "failure_ttl": 60.0,        # Seconds before a failed lookup is retried.
+    "stats_key": "player_stats",
+}
+
+
+class _RateLimiter:
+    '''Spaces calls at least 1/rate seconds apart across all waiting tasks.'''
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class StatsPrefetcher:
+    '''
+    Fetches player stats for everyone appearing in a MatchBook, once per player.
+
+    Attach it with attach(book). On every update, profile IDs from added and
+    updated matches are collected, IDs that are cached or already in flight are
+    dropped, and the rest are fetched concurrently under a shared rate budget.
+    Results are kept beside the book, keyed by (subscription type, match ID), and
+    never written into the book's matches, so relays, snapshots, and diffs see the
+    matches exactly as received. Read them with match_stats(), or get a copy of a
+    raw match with them under match["player_stats"] from with_stats().
+
+    Fetches run in worker threads (aoe2api is synchronous), so the book must be
+    updated from a running event loop, as MatchBook.start() does.
+    '''
+
+    def __init__(
+        self,
+        fetch: Optional[Callable] = None,
+        match_type: int = defaults["match_type"],
+        max_concurrency: int = defaults["max_concurrency"],
+        requests_per_second: float = defaults["requests_per_second"],
+        ttl: float = defaults["ttl"],
+        failure_ttl: float = defaults["failure_ttl"],
+        stats_key: str = defaults["stats_key"],
+    ):
+        '''
+        :param fetch: Callable like aoe2api.fetch_player_stats(profile_id=..., match_type=..., quiet=...). Defaults to it.
+        '''
+        if fetch is None:
+            from aoe2api import aoe2api
+            fetch = aoe2api.fetch_player_stats
+        self.fetch = fetch
+        self.match_type = match_type
+        self.max_concurrency = max_concurrency
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.stats_key = stats_key
+        self.requests_per_second = requests_per_second
+        # profile_id -> (expires_at, stats content or None on failure)
+        self._cache: dict[str, tuple[float, Optional[dict]]] = {}
+        # (subscription_type, match_id) -> {profile_id: stats} for matches currently in an attached book
+        self._match_stats: dict[tuple[str, str], dict[str, dict]] = {}
+        self._next_prune_at = 0.0
+        self._in_flight: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._books: list[MatchBook] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._limiter: Optional[_RateLimiter] = None
+        self.stats = {"requested": 0, "cache_hits": 0, "deduplicated": 0, "fetched": 0, "failed": 0}
+
+    def attach(self, book: MatchBook) -> "StatsPrefetcher":
+        self._books.append(book)
+        book.add_update_listener(self._on_update)
+        return self
+
+    def detach(self, book: MatchBook) -> None:
+        book.remove_update_listener(self._on_update)
+        if book in self._books:
+            self._books.remove(book)
+        if not any(other.subscription_type == book.subscription_type for other in self._books):
+            self._match_stats = {key: stats for key, stats in self._match_stats.items() if key[0] != book.subscription_type}
+
+    def cached_stats(self, profile_id) -> Optional[dict]:
+        entry = self._cache.get(str(profile_id))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def stats_for_match(self, match) -> dict:
+        '''Return {profile_id: stats} for every player of the match with cached stats.'''
+        found = {}
+        for slot in iter_slots(match):
+            profile_id = slot.get("profileid")
+            stats = self.cached_stats(profile_id) if profile_id is not None else None
+            if stats is not None:
+                found[str(profile_id)] = stats
+        return found
+
+    def match_stats(self, context: str, match_id) -> dict:
+        '''Return {profile_id: stats} gathered for a match of an attached book, by subscription type and match ID.'''
+        return dict(self._match_stats.get((context, str(match_id)), {}))
+
+    def with_stats(self, context: str, match) -> dict:
+        '''Return a shallow copy of a raw match dict with its stats under stats_key. The book's match is not modified.'''
+        return dict(match, **{self.stats_key: self.match_stats(context, match.get("matchid"))})
+
+    def _attach_stats(self, context: str, match) -> None:
+        found = self.stats_for_match(match)
+        if found:
+            self._match_stats.setdefault((context, str(match.get("matchid"))), {}).update(found)
+
+    def _on_update(self, book: MatchBook, delta: MatchBookDelta) -> None:
+        context = book.subscription_type
+        for match in delta.removed:
+            self._match_stats.pop((context, str(match.get("matchid"))), None)
+        missing = []
+        now = time.monotonic()
+        for match in delta.added + delta.updated:
+            self._attach_stats(context, match)
+            for slot in iter_slots(match):
+                profile_id = slot.get("profileid")
+                if profile_id is None:
+                    continue
+                profile_id = str(profile_id)
+                self.stats["requested"] += 1
+                entry = self._cache.get(profile_id)
+                if entry is not None and entry[0] >= now:
+                    self.stats["cache_hits"] += 1
+                elif profile_id in self._in_flight:
+                    self.stats["deduplicated"] += 1
+                else:
+                    self._in_flight.add(profile_id)
+                    missing.append(profile_id)
+        if missing:
+            self._schedule(missing)
+
+    def _schedule(self, profile_ids: list[str]) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to fetch on; forget the reservations so a later update retries.
+            self._in_flight.difference_update(profile_ids)
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._limiter = _RateLimiter(self.requests_per_second)
+        for profile_id in profile_ids:
+            task = loop.create_task(self._fetch_one(profile_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fetch_one(self, profile_id: str) -> None:
+        try:
+            async with self._semaphore:
+                await self._limiter.wait()
+                response = await asyncio.to_thread(
+                    self.fetch, profile_id=profile_id, match_type=self.match_type, quiet=True
+                )
+            if response.get("status_code") == 200 and response.get("content") is not None:
+                self._cache[profile_id] = (time.monotonic() + self.ttl, response["content"])
+                self.stats["fetched"] += 1
+            else:
+                self._cache[profile_id] = (time.monotonic() + self.failure_ttl, None)
+                self.stats["failed"] += 1
+        except Exception as e:
+            self._cache[profile_id] = (time.monotonic() + self.failure_ttl, None)
+            self.stats["failed"] += 1
+            print(f" ! Failed to fetch stats for player {profile_id}: {e!r}")
+        finally:
+            self._in_flight.discard(profile_id)
+        self._attach_to_books(profile_id)
+        self._prune()
+
+    def _attach_to_books(self, profile_id: str) -> None:
+        for book in self._books:
+            for match in book.matches_for_profile_ids([profile_id]):
+                self._attach_stats(book.subscription_type, match)
+
+    def _prune(self) -> None:
+        # Drop expired entries at most once per failure_ttl so the cache tracks live players only.
+        now = time.monotonic()
+        if now < self._next_prune_at:
+            return
+        self._next_prune_at = now + self.failure_ttl
+        self._cache = {key: entry for key, entry in self._cache.items() if entry[0] >= now}
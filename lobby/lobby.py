@@ -3,12 +3,17 @@
 import argparse
 import asyncio
 import json
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, AsyncIterator, Iterable, Optional, Callable
 
 import aiohttp
 
+from lobby import metrics
+from lobby.utils import iter_slots
+from shared import codec, profiling
+
 
 WS_URL = "wss://data.aoe2lobby.com/ws/"
 global last_match_ids
@@ -25,8 +30,7 @@ class Subscription:
         payload = {"action": "subscribe", "type": self.type, "context": self.context}
         if self.ids:
             payload["ids"] = [str(item) for item in self.ids]
-        json_string = json.dumps(payload, separators=(",", ":"))
-        return json_string
+        return codec.dumps(payload)
 
 ## ---------------------------- Helper functions ---------------------------- ##
 def load_game_data():
@@ -92,13 +96,13 @@ def search_matches_for_player(player_name: str, matches: list[dict]) -> list[str
     
 
 def get_player_slot(player_name: str, match):
-    lobby_slots = match.get("slots", {})
-    player_slot = [lobby_slots[slot] for slot in lobby_slots.keys() if lobby_slots[slot].get("name") == player_name]
-    if len(player_slot) > 0:
-        return player_slot[0]
-    return None
+    return next((slot for slot in iter_slots(match) if slot.get("name") == player_name), None)
 
 def get_response_type(event):
+    # Lazily decoded events know their first key without being parsed.
+    first_key = getattr(event, "first_key", None)
+    if first_key is not None:
+        return first_key
     response_types = list(event.keys())
     response_type = response_types[0]
     return response_type
@@ -153,11 +157,21 @@ def _parse_ids(raw: Optional[str]) -> Optional[Iterable[str]]:
 def _decode_message(message: aiohttp.WSMessage) -> Optional[Any]:
     if message.type == aiohttp.WSMsgType.TEXT:
         text = message.data
+        metrics.pipeline.frame(len(text) if text.isascii() else len(text.encode("utf-8")))
+        started = time.perf_counter()
         try:
-            return json.loads(text)
-        except json.JSONDecodeError:
+            with profiling.span("decode"):
+                # Objects are parsed on first access; the response type is readable before that.
+                payload = codec.lazy_loads(text)
+        except codec.DecodeError:
             return text
+        # A lazy object is only peeked at here; its parse is timed as "decode" once a consumer reads it.
+        metrics.pipeline.observe(
+            "decode.peek" if isinstance(payload, codec.LazyJSON) else "decode", time.perf_counter() - started
+        )
+        return payload
     if message.type == aiohttp.WSMsgType.BINARY:
+        metrics.pipeline.frame(len(message.data))
         return message.data
     return None
 
@@ -182,16 +196,29 @@ async def _lobby_event_stream(
 
                     delay = reconnect_min_delay
                     async for message in ws:
+                        received_at = time.perf_counter()
                         payload = _decode_message(message)
                         if payload is not None:
+                            yielded_at = time.perf_counter()
                             yield payload
+                            # The generator resumes once the consumer is done with the event.
+                            done_at = time.perf_counter()
+                            metrics.pipeline.observe("consumer", done_at - yielded_at)
+                            metrics.pipeline.observe("lag.pipeline", done_at - received_at)
+                            if getattr(payload, "load_seconds", None) is not None:
+                                metrics.pipeline.observe("decode", payload.load_seconds)
+                            metrics.pipeline.event(payload)
+                    reason, detail = "closed", f"code {ws.close_code}"
         except asyncio.CancelledError:
             raise
-        except Exception:
+        except Exception as e:
             if not reconnect:
                 raise
+            reason, detail = type(e).__name__, str(e)
         if not reconnect:
             break
+        metrics.pipeline.reconnect(reason, detail)
+        print(f" ! Lobby connection to {url} lost ({reason}: {detail}); reconnecting in {delay:g}s")
         await asyncio.sleep(delay)
         delay = min(delay * 2, reconnect_max_delay)
 
@@ -250,8 +277,18 @@ def subscribe(subscription_names: list[str], player_ids: list[str] = None, eloty
     return subscriptions
 
 async def receive_lobby_events(subscriptions: Iterable[Subscription], callback: Callable, **kwargs) -> None:
+    name = f"callback.{metrics.callback_name(callback)}"
     async for event in _lobby_event_stream(subscriptions=subscriptions, **kwargs):
-        callback(event, **kwargs)
+        try:
+            # First access parses a lazily decoded event, so a malformed body surfaces here.
+            bool(event)
+        except codec.DecodeError as e:
+            print(f" ! Skipping malformed lobby event: {e}")
+            continue
+        started = time.perf_counter()
+        with profiling.span("callback"):
+            callback(event, **kwargs)
+        metrics.pipeline.observe(name, time.perf_counter() - started)
 
 def connect_to_subscriptions(
     subscriptions: list,
@@ -268,6 +305,18 @@ def connect_to_subscriptions(
     if create_task:
         return asyncio.create_task(coroutine)
     asyncio.run(coroutine)
+
+async def _receive_with_metrics(subscriptions, callback, metrics_file: Optional[str], metrics_port: Optional[int]) -> None:
+    exporter = metrics.start_exporting(metrics_file) if metrics_file else None
+    runner = await metrics.serve_metrics(port=metrics_port) if metrics_port else None
+    try:
+        await receive_lobby_events(subscriptions, callback)
+    finally:
+        if exporter is not None:
+            exporter.cancel()
+            metrics.write_metrics(metrics_file)
+        if runner is not None:
+            await runner.cleanup()
     
 ## ---------------------------- CLI/Arg parser ---------------------------- ##
 def _build_arg_parser() -> argparse.ArgumentParser:
@@ -300,6 +349,19 @@ def _build_arg_parser() -> argparse.ArgumentParser:
         default=None,
         help="Comma-separated elo type IDs to track in lobby.",
     )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="Write pipeline metrics (rates, decode/callback/lag histograms, reconnects) to this JSON file periodically.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve pipeline metrics at http://127.0.0.1:<port>/metrics (Prometheus) and /metrics.json.",
+    )
+    profiling.add_profiling_args(parser)
     return parser
 
 # Load AOE2 data (civilization names)
@@ -313,7 +375,14 @@ def main() -> None:
     parser = _build_arg_parser()
     args = parser.parse_args()
     subscriptions = subscribe(args)
-    connect_to_subscriptions(subscriptions, print_lobby_events)
+    with profiling.profiling_session(args, "lobby"):
+        try:
+            if args.metrics_file or args.metrics_port:
+                asyncio.run(_receive_with_metrics(subscriptions, print_lobby_events, args.metrics_file, args.metrics_port))
+            else:
+                connect_to_subscriptions(subscriptions, print_lobby_events)
+        except KeyboardInterrupt:
+            pass
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,27 @@
 """In-memory match collection that stays in sync with lobby subscriptions."""
 
+import asyncio
+import heapq
+import itertools
+import time
+
 from lobby import lobby
-from typing import Callable, Optional
+from lobby import metrics
+from lobby import snapshot
+from lobby.match_index import MatchIndex
+from lobby.records import to_dict, to_record
+from lobby.utils import iter_slots
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+
+@dataclass
+class MatchBookDelta:
+    '''What one MatchBook.update() changed, passed to update listeners.'''
+    event: dict
+    added: list = field(default_factory=list)      # Matches not previously in the book.
+    updated: list = field(default_factory=list)    # New versions of matches already in the book.
+    removed: list = field(default_factory=list)    # Matches dropped from the book (last known version).
 
 
 class MatchBook:
@@ -11,17 +31,39 @@ class MatchBook:
     # Pending lobby-leave candidates keyed by player id. These are resolved by
     # player_status updates to avoid lobby/spectate stream ordering races.
     _pending_lobby_leaves: dict[str, dict] = {}
+    # Seconds a pending lobby leave waits for a player_status update before it
+    # expires and the leave callback fires anyway.
+    pending_lobby_leave_timeout: float = 30.0
+    # Min-heap of (deadline, token, player_id). Entries are invalidated lazily:
+    # a popped entry whose token no longer matches the pending dict is skipped.
+    _pending_lobby_leave_deadlines: list[tuple[float, int, str]] = []
+    _pending_lobby_leave_tokens = itertools.count()
+    _pending_lobby_leave_stats: dict[str, int] = {"queued": 0, "emitted": 0, "suppressed": 0, "expired": 0}
+    # Loop timer armed for the earliest deadline so leaves also expire on a quiet stream.
+    _pending_lobby_leave_timer: Optional[asyncio.TimerHandle] = None
+    _pending_lobby_leave_timer_at: float = 0.0
+    _pending_lobby_leave_timer_loop: Optional[asyncio.AbstractEventLoop] = None
 
     def __init__(
         self,
         subscription_type: str,
         on_player_remove: Optional[Callable[[str, str, str, dict], None]] = None,
+        compact: bool = False,
     ):
         self.subscription_type = subscription_type 
+        # When True, matches are stored as lobby.records.MatchRecord instead of raw dicts.
+        self.compact = compact
         self._matches = []
+        self._index = MatchIndex()
         self._subscriptions = lobby.subscribe([subscription_type])
         self._task = None
+        self._snapshot_task = None
+        # Set after restoring from a snapshot; the next live update reconciles
+        # the restored matches against what the server actually reports.
+        self._reconcile_on_next_update = False
         self.on_player_remove = on_player_remove
+        self._update_listeners: list[Callable[["MatchBook", MatchBookDelta], None]] = []
+        self._delta: Optional[MatchBookDelta] = None
 
     def __iter__(self):
         return iter(self._matches)
@@ -43,17 +85,67 @@ class MatchBook:
         return self._task
 
     def add(self, match):
+        if self.compact:
+            match = to_record(match)
         self._matches.append(match)
+        self._index.add(match)
 
     def clear(self):
         self._matches.clear()
+        self._index.clear()
 
     def get_match_by_id(self, match_id):
+        match = self._index.get(match_id)
+        if match is not None:
+            return match
         return next(
             (match for match in self._matches if str(match.get("matchid")) == str(match_id)),
             None,
         )
 
+    def query(
+        self,
+        player_names: Optional[Iterable[str]] = None,
+        profile_ids: Optional[Iterable] = None,
+        map_names: Optional[Iterable[str]] = None,
+        elotypes: Optional[Iterable] = None,
+        civs: Optional[Iterable] = None,
+        min_avg_elo: Optional[float] = None,
+        max_avg_elo: Optional[float] = None,
+        predicate: Optional[Callable[[dict], bool]] = None,
+    ) -> list[dict]:
+        '''
+        Return all tracked matches satisfying every given filter, answered from the secondary indexes.
+
+        Values within one filter are OR-ed together and filters are AND-ed, e.g.
+        query(map_names=["Arabia"], elotypes=["3"], min_avg_elo=2000).
+
+        :param player_names: Player names to look for (case-insensitive).
+        :param profile_ids: Profile IDs to look for.
+        :param map_names: Map names as given in the match "map_name" field.
+        :param elotypes: Elo type IDs as given in the match "elotype" field.
+        :param civs: Civilization IDs picked in any slot.
+        :param min_avg_elo: Inclusive lower bound on the average slot rating.
+        :param max_avg_elo: Inclusive upper bound on the average slot rating.
+        :param predicate: Optional extra check applied to each indexed hit.
+        '''
+        return self._index.query(
+            predicate=predicate,
+            player_names=player_names,
+            profile_ids=profile_ids,
+            map_names=map_names,
+            elotypes=elotypes,
+            civs=civs,
+            min_avg_elo=min_avg_elo,
+            max_avg_elo=max_avg_elo,
+        )
+
+    def matches_for_player(self, player_name: str) -> list[dict]:
+        return self.query(player_names=[player_name])
+
+    def matches_for_profile_ids(self, profile_ids: Iterable) -> list[dict]:
+        return self.query(profile_ids=profile_ids)
+
     def print_number_of_matches(self):
         print(f"Current number of {self.subscription_type} matches: {len(self)}")
     
@@ -62,33 +154,43 @@ class MatchBook:
         received_matches = [
             event.get(response_type, {}).get(match_id, {}) for match_id in event.get(response_type, [])
         ]
+        if self.compact:
+            received_matches = [to_record(match) for match in received_matches]
+        received_match_ids = {str(m.get("matchid")) for m in received_matches}
         old_matches = [
             match
             for match in self._matches
-            if match.get("matchid") not in [m.get("matchid") for m in received_matches]
+            if str(match.get("matchid")) not in received_match_ids
         ]
         self._matches = old_matches + received_matches
+        for match in received_matches:
+            is_new = str(match.get("matchid")) not in self._index
+            self._index.add(match)
+            if self._delta is not None:
+                (self._delta.added if is_new else self._delta.updated).append(match)
 
     def remove_matches(self, event):
         event_types = list(event.keys())
         if len(event_types) > 1:
-            match_ids_to_remove = event.get(event_types[1])
-            self._matches = [
-                match
-                for match in self._matches
-                if str(match.get("matchid")) not in [str(id) for id in match_ids_to_remove]
-            ]
+            self._remove_match_ids(event.get(event_types[1]) or [])
+
+    def _remove_match_ids(self, match_ids):
+        match_ids_to_remove = {str(id) for id in match_ids}
+        self._matches = [
+            match
+            for match in self._matches
+            if str(match.get("matchid")) not in match_ids_to_remove
+        ]
+        for match_id in match_ids_to_remove:
+            removed = self._index.remove(match_id)
+            if removed is not None and self._delta is not None:
+                self._delta.removed.append(removed)
 
     def _build_player_match_index(self):
         index = {}
         for match in self._matches:
             match_id = str(match.get("matchid"))
-            slots = match.get("slots", {})
-            if not isinstance(slots, dict):
-                continue
-            for slot in slots.values():
-                if not isinstance(slot, dict):
-                    continue
+            for slot in iter_slots(match):
                 player_id = slot.get("profileid")
                 if player_id is None:
                     continue
@@ -125,11 +227,106 @@ class MatchBook:
         spectate_match_id = MatchBook._spectate_player_match_by_id.get(player_id)
         return spectate_match_id == match_id
 
-    def _queue_lobby_leave(self, player_id: str, match_id: str, match: dict, callback: Callable):
+    def _queue_lobby_leave(
+        self,
+        player_id: str,
+        match_id: str,
+        match: dict,
+        callback: Callable,
+        timeout: Optional[float] = None,
+    ):
+        if timeout is None:
+            timeout = MatchBook.pending_lobby_leave_timeout
+        deadline = time.monotonic() + timeout
+        token = next(MatchBook._pending_lobby_leave_tokens)
         MatchBook._pending_lobby_leaves[player_id] = {
             "match_id": match_id,
             "match": match,
             "callback": callback,
+            "deadline": deadline,
+            "token": token,
+        }
+        heapq.heappush(MatchBook._pending_lobby_leave_deadlines, (deadline, token, player_id))
+        MatchBook._pending_lobby_leave_stats["queued"] += 1
+        MatchBook._compact_pending_lobby_leave_deadlines()
+        MatchBook._arm_pending_lobby_leave_timer()
+
+    @classmethod
+    def _compact_pending_lobby_leave_deadlines(cls) -> None:
+        # Resolved entries leave stale heap items behind until their deadline;
+        # rebuild once they dominate so the heap tracks the live pending count.
+        if len(cls._pending_lobby_leave_deadlines) <= 2 * len(cls._pending_lobby_leaves) + 64:
+            return
+        cls._pending_lobby_leave_deadlines = [
+            (pending["deadline"], pending["token"], player_id)
+            for player_id, pending in cls._pending_lobby_leaves.items()
+        ]
+        heapq.heapify(cls._pending_lobby_leave_deadlines)
+
+    @classmethod
+    def _arm_pending_lobby_leave_timer(cls) -> None:
+        deadlines = cls._pending_lobby_leave_deadlines
+        if not deadlines:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to time against; the next update() expires them instead.
+            return
+        timer = cls._pending_lobby_leave_timer
+        if timer is not None:
+            if cls._pending_lobby_leave_timer_loop is loop and cls._pending_lobby_leave_timer_at <= deadlines[0][0]:
+                # An earlier timer is already armed and re-arms for the rest when it fires.
+                return
+            timer.cancel()
+        cls._pending_lobby_leave_timer_at = deadlines[0][0]
+        cls._pending_lobby_leave_timer_loop = loop
+        delay = max(0.0, deadlines[0][0] - time.monotonic())
+        cls._pending_lobby_leave_timer = loop.call_later(delay, cls._on_pending_lobby_leave_timer)
+
+    @classmethod
+    def _on_pending_lobby_leave_timer(cls) -> None:
+        cls._pending_lobby_leave_timer = None
+        cls.expire_pending_lobby_leaves()
+
+    @classmethod
+    def expire_pending_lobby_leaves(cls, now: Optional[float] = None) -> int:
+        """
+        Emit lobby leaves whose deadline passed without a resolving player_status update.
+
+        Expired entries are removed first and their callbacks are then fired as one batch.
+        Called after every update() and from a loop timer at the earliest pending deadline.
+
+        :param now: Monotonic timestamp to expire against. Defaults to time.monotonic().
+        :return: Number of expired entries.
+        """
+        now = time.monotonic() if now is None else now
+        deadlines = cls._pending_lobby_leave_deadlines
+        expired = []
+        while deadlines and deadlines[0][0] <= now:
+            _, token, player_id = heapq.heappop(deadlines)
+            pending = cls._pending_lobby_leaves.get(player_id)
+            if pending is None or pending.get("token") != token:
+                continue
+            del cls._pending_lobby_leaves[player_id]
+            expired.append((player_id, pending))
+        cls._arm_pending_lobby_leave_timer()
+
+        cls._pending_lobby_leave_stats["expired"] += len(expired)
+        for player_id, pending in expired:
+            callback = pending.get("callback")
+            if callback:
+                callback(player_id, "lobby", str(pending.get("match_id")), pending.get("match"))
+        return len(expired)
+
+    @classmethod
+    def pending_lobby_leave_stats(cls) -> dict[str, int]:
+        """Return counts of pending, resolved (emitted + suppressed), and expired lobby leaves."""
+        stats = cls._pending_lobby_leave_stats
+        return {
+            "pending": len(cls._pending_lobby_leaves),
+            "resolved": stats["emitted"] + stats["suppressed"],
+            **stats,
         }
 
     @classmethod
@@ -141,6 +338,9 @@ class MatchBook:
         - status == 'spectate' and same match_id: suppress lobby leave.
         - Any other state transition: emit lobby leave.
         - status == 'lobby' with same match_id: still in lobby context, keep pending.
+
+        Entries that never see a resolving update expire after pending_lobby_leave_timeout
+        seconds, see expire_pending_lobby_leaves().
         """
         pending = cls._pending_lobby_leaves.get(str(player_id))
         if not pending:
@@ -152,12 +352,14 @@ class MatchBook:
 
         if current_status == "spectate" and current_match_id == pending_match_id:
             cls._pending_lobby_leaves.pop(str(player_id), None)
+            cls._pending_lobby_leave_stats["suppressed"] += 1
             return
 
         if current_status == "lobby" and current_match_id == pending_match_id:
             return
 
         cls._pending_lobby_leaves.pop(str(player_id), None)
+        cls._pending_lobby_leave_stats["emitted"] += 1
         callback = pending.get("callback")
         if callback:
             callback(str(player_id), "lobby", pending_match_id, pending.get("match"))
@@ -169,9 +371,151 @@ class MatchBook:
             player_id: match_id for player_id, (match_id, _) in self._build_player_match_index().items()
         }
 
+    ## ---------------------------- Snapshots ---------------------------- ##
+    def snapshot_state(self) -> dict:
+        '''
+        Return a JSON-serializable copy of this book's state: its matches, the shared
+        spectate player index, and pending lobby leaves (with their remaining time).
+        '''
+        now = time.monotonic()
+        pending_leaves = {}
+        if self.subscription_type == "lobby":
+            pending_leaves = {
+                player_id: {
+                    "match_id": pending.get("match_id"),
+                    "match": to_dict(pending.get("match")),
+                    "remaining": max(pending.get("deadline", now) - now, 0.0),
+                }
+                for player_id, pending in MatchBook._pending_lobby_leaves.items()
+            }
+        return {
+            "subscription_type": self.subscription_type,
+            "saved_at": time.time(),
+            "matches": [to_dict(match) for match in self._matches],
+            "spectate_player_match_by_id": MatchBook._spectate_player_match_by_id,
+            "pending_lobby_leaves": pending_leaves,
+        }
+
+    def restore_state(self, state: dict) -> None:
+        '''
+        Load state produced by snapshot_state(). Time spent offline is deducted from
+        pending leave deadlines, and the next live update reconciles the restored matches.
+        '''
+        if state.get("subscription_type") != self.subscription_type:
+            raise ValueError(
+                f"Snapshot is for '{state.get('subscription_type')}' matches, not '{self.subscription_type}'"
+            )
+        self.clear()
+        for match in state.get("matches", []):
+            self.add(match)
+
+        if self.subscription_type == "spectate":
+            self._sync_shared_spectate_index()
+        elif not MatchBook._spectate_player_match_by_id:
+            MatchBook._spectate_player_match_by_id = dict(state.get("spectate_player_match_by_id", {}))
+
+        offline = max(time.time() - state.get("saved_at", time.time()), 0.0)
+        for player_id, pending in state.get("pending_lobby_leaves", {}).items():
+            if self.on_player_remove is None or player_id in MatchBook._pending_lobby_leaves:
+                continue
+            self._queue_lobby_leave(
+                player_id,
+                str(pending.get("match_id")),
+                pending.get("match"),
+                self.on_player_remove,
+                timeout=max(pending.get("remaining", 0.0) - offline, 0.0),
+            )
+        self._reconcile_on_next_update = True
+
+    def save_snapshot(self, path) -> int:
+        '''
+        Write the current state to path in the compact snapshot format.
+
+        :return: Number of bytes written.
+        '''
+        return snapshot.write_snapshot(path, self.snapshot_state())
+
+    def load_snapshot(self, path) -> bool:
+        '''
+        Restore state from a snapshot file written by save_snapshot().
+
+        :return: True if a snapshot was found and restored, False if none exists.
+        :raises snapshot.SnapshotError: If the file is truncated, corrupt, or of an unknown version.
+        :raises ValueError: If the snapshot is for another subscription type. The book is left unchanged.
+        :raises OSError: If the file exists but cannot be read.
+        '''
+        state = snapshot.read_snapshot(path)
+        if state is None:
+            return False
+        self.restore_state(state)
+        return True
+
+    async def _snapshot_loop(self, path, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            # Capture on the loop thread so the state is consistent, then encode
+            # and write off-thread so disk I/O never blocks event handling.
+            state = self.snapshot_state()
+            try:
+                await asyncio.to_thread(snapshot.write_snapshot, path, state)
+            except OSError as e:
+                print(f" ! Failed to write {self.subscription_type} snapshot to '{path}': {e}")
+
+    def start_snapshots(self, path, interval: float = 30.0):
+        '''
+        Start a background task writing a snapshot to path every interval seconds.
+        Must be called with a running event loop, like start().
+        '''
+        if self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop(path, interval))
+        return self._snapshot_task
+
+    def _reconcile_restored_matches(self, event) -> None:
+        response_type = lobby.get_response_type(event)
+        if "update" not in response_type:
+            return
+        self._reconcile_on_next_update = False
+        # The first update after (re)subscribing carries every live match, so
+        # restored matches missing from it ended while we were down. Drop them
+        # without reporting their players as leaving; update listeners still get
+        # them in the delta's removed list.
+        live_match_ids = {str(match_id) for match_id in event.get(response_type, {})}
+        stale_match_ids = [
+            str(match.get("matchid")) for match in self._matches if str(match.get("matchid")) not in live_match_ids
+        ]
+        if stale_match_ids:
+            self._remove_match_ids(stale_match_ids)
+
+    def add_update_listener(self, listener: Callable[["MatchBook", MatchBookDelta], None]) -> None:
+        '''
+        Register a callable run after every update() with the book and a MatchBookDelta
+        describing the added, updated, and removed matches.
+        '''
+        self._update_listeners.append(listener)
+
+    def remove_update_listener(self, listener: Callable[["MatchBook", MatchBookDelta], None]) -> None:
+        if listener in self._update_listeners:
+            self._update_listeners.remove(listener)
+
     def update(self, event):
+        started = time.perf_counter()
+        self._delta = MatchBookDelta(event) if self._update_listeners else None
+        if self._reconcile_on_next_update:
+            self._reconcile_restored_matches(event)
         previous_player_index = self._build_player_match_index()
         self.add_matches(event)
         self.remove_matches(event)
+        delta, self._delta = self._delta, None
         self._sync_shared_spectate_index()
         self._emit_player_remove_events(event, previous_player_index)
+        MatchBook.expire_pending_lobby_leaves()
+        finished = time.perf_counter()
+        metrics.pipeline.observe(f"book.{self.subscription_type}.update", finished - started)
+        metrics.pipeline.gauge(f"book.{self.subscription_type}.matches", len(self._matches))
+        metrics.pipeline.gauge("book.pending_lobby_leaves", len(MatchBook._pending_lobby_leaves))
+        if delta is not None:
+            for listener in list(self._update_listeners):
+                listener(self, delta)
+                now = time.perf_counter()
+                metrics.pipeline.observe(f"listener.{metrics.callback_name(listener)}", now - finished)
+                finished = now
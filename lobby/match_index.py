@@ -0,0 +1,216 @@
+"""Secondary indexes over lobby matches for fast multi-key queries."""
+
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Callable, Iterable, Optional
+
+from lobby.utils import iter_slots
+
+
+# Slot keys checked, in order, when reading a player's rating from a slot.
+SLOT_RATING_KEYS = ("rating", "elo")
+
+
+def _match_key(match) -> Optional[str]:
+    match_id = match.get("matchid")
+    return str(match_id) if match_id is not None else None
+
+
+def _slot_rating(slot) -> Optional[float]:
+    for key in SLOT_RATING_KEYS:
+        value = slot.get(key)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _normalize_name(name) -> str:
+    return str(name).casefold()
+
+
+class MatchIndex:
+    '''
+    Secondary indexes for a set of lobby or spectate matches.
+
+    Each index maps a key (player name, profile id, map, elotype, civ) to the set
+    of match ids carrying it. Average elo is kept in a sorted list so range
+    queries use bisection instead of a scan. All keys are stored as strings,
+    and player names are matched case-insensitively.
+    '''
+
+    def __init__(self):
+        # Values are raw match dicts or lobby.records.MatchRecord instances.
+        self._matches: dict[str, dict] = {}
+        self._by_name: dict[str, set[str]] = {}
+        self._by_profile_id: dict[str, set[str]] = {}
+        self._by_map: dict[str, set[str]] = {}
+        self._by_elotype: dict[str, set[str]] = {}
+        self._by_civ: dict[str, set[str]] = {}
+        self._indexes = (self._by_map, self._by_elotype, self._by_name, self._by_profile_id, self._by_civ)
+        # Keys each match was indexed under, one tuple per entry of _indexes, so
+        # removal never rescans slots. Tuples of strings stay out of the GC.
+        self._keys: dict[str, tuple[tuple[str, ...], ...]] = {}
+        self._avg_elo: dict[str, float] = {}
+        self._avg_elo_sorted: list[tuple[float, str]] = []
+
+    def __len__(self):
+        return len(self._matches)
+
+    def __contains__(self, match_id):
+        return str(match_id) in self._matches
+
+    def get(self, match_id) -> Optional[dict]:
+        return self._matches.get(str(match_id))
+
+    def match_ids(self) -> set[str]:
+        return set(self._matches)
+
+    def clear(self):
+        self._matches.clear()
+        self._keys.clear()
+        for index in self._indexes:
+            index.clear()
+        self._avg_elo.clear()
+        self._avg_elo_sorted.clear()
+
+    @staticmethod
+    def _link(index: dict, keys: Iterable, match_id: str) -> tuple[str, ...]:
+        linked = []
+        for key in keys:
+            if key is None or key == "":
+                continue
+            key = str(key)
+            index.setdefault(key, set()).add(match_id)
+            linked.append(key)
+        return tuple(linked)
+
+    def add(self, match: dict) -> Optional[str]:
+        '''
+        Index a match, replacing any previously indexed version with the same id.
+
+        :param match: Match dict as received from the lobby stream.
+        :return: The match id the match was indexed under, or None if it has no id.
+        '''
+        match_id = _match_key(match)
+        if match_id is None:
+            return None
+        self.remove(match_id)
+
+        slots = list(iter_slots(match))
+        names = [_normalize_name(slot.get("name")) for slot in slots if slot.get("name")]
+        ratings = [rating for rating in (_slot_rating(slot) for slot in slots) if rating is not None]
+
+        self._matches[match_id] = match
+        self._keys[match_id] = (
+            self._link(self._by_map, [match.get("map_name")], match_id),
+            self._link(self._by_elotype, [match.get("elotype")], match_id),
+            self._link(self._by_name, names, match_id),
+            self._link(self._by_profile_id, [slot.get("profileid") for slot in slots], match_id),
+            self._link(self._by_civ, [slot.get("civ") for slot in slots], match_id),
+        )
+        if ratings:
+            avg_elo = sum(ratings) / len(ratings)
+            self._avg_elo[match_id] = avg_elo
+            insort(self._avg_elo_sorted, (avg_elo, match_id))
+        return match_id
+
+    def remove(self, match_id) -> Optional[dict]:
+        '''
+        Drop a match from every index.
+
+        :param match_id: Id of the match to remove.
+        :return: The removed match, or None if it was not indexed.
+        '''
+        match_id = str(match_id)
+        match = self._matches.pop(match_id, None)
+        if match is None:
+            return None
+        for index, keys in zip(self._indexes, self._keys.pop(match_id, ())):
+            for key in keys:
+                match_ids = index.get(key)
+                if match_ids is None:
+                    continue
+                match_ids.discard(match_id)
+                if not match_ids:
+                    del index[key]
+        avg_elo = self._avg_elo.pop(match_id, None)
+        if avg_elo is not None:
+            position = bisect_left(self._avg_elo_sorted, (avg_elo, match_id))
+            if position < len(self._avg_elo_sorted) and self._avg_elo_sorted[position] == (avg_elo, match_id):
+                del self._avg_elo_sorted[position]
+        return match
+
+    def average_elo(self, match_id) -> Optional[float]:
+        return self._avg_elo.get(str(match_id))
+
+    @staticmethod
+    def _lookup(index: dict, keys: Iterable) -> set[str]:
+        found = set()
+        for key in keys:
+            found |= index.get(str(key), set())
+        return found
+
+    def _elo_range(self, min_avg_elo: Optional[float], max_avg_elo: Optional[float]) -> set[str]:
+        low = 0
+        high = len(self._avg_elo_sorted)
+        if min_avg_elo is not None:
+            low = bisect_left(self._avg_elo_sorted, (float(min_avg_elo), ""))
+        if max_avg_elo is not None:
+            # "\uffff" sorts after any match id, making the upper bound inclusive.
+            high = bisect_right(self._avg_elo_sorted, (float(max_avg_elo), "\uffff"))
+        return {match_id for _, match_id in self._avg_elo_sorted[low:high]}
+
+    def query_ids(
+        self,
+        player_names: Optional[Iterable[str]] = None,
+        profile_ids: Optional[Iterable] = None,
+        map_names: Optional[Iterable[str]] = None,
+        elotypes: Optional[Iterable] = None,
+        civs: Optional[Iterable] = None,
+        min_avg_elo: Optional[float] = None,
+        max_avg_elo: Optional[float] = None,
+    ) -> set[str]:
+        '''
+        Return ids of matches satisfying every given filter.
+
+        Values within one filter are OR-ed together (any of these profile ids),
+        and the filters are AND-ed with each other (this map and this elotype).
+        Filters left as None are ignored; with no filters all match ids are returned.
+        '''
+        candidate_sets = []
+        if player_names is not None:
+            candidate_sets.append(self._lookup(self._by_name, (_normalize_name(name) for name in player_names)))
+        if profile_ids is not None:
+            candidate_sets.append(self._lookup(self._by_profile_id, profile_ids))
+        if map_names is not None:
+            candidate_sets.append(self._lookup(self._by_map, map_names))
+        if elotypes is not None:
+            candidate_sets.append(self._lookup(self._by_elotype, elotypes))
+        if civs is not None:
+            candidate_sets.append(self._lookup(self._by_civ, civs))
+        if min_avg_elo is not None or max_avg_elo is not None:
+            candidate_sets.append(self._elo_range(min_avg_elo, max_avg_elo))
+
+        if not candidate_sets:
+            return set(self._matches)
+        candidate_sets.sort(key=len)
+        result = set(candidate_sets[0])
+        for candidates in candidate_sets[1:]:
+            if not result:
+                break
+            result &= candidates
+        return result
+
+    def query(self, predicate: Optional[Callable[[dict], bool]] = None, **filters: Any) -> list[dict]:
+        '''
+        Return matches satisfying the given filters, see query_ids() for the filter names.
+
+        :param predicate: Optional extra check applied to each indexed hit.
+        '''
+        matches = [self._matches[match_id] for match_id in self.query_ids(**filters)]
+        if predicate is not None:
+            matches = [match for match in matches if predicate(match)]
+        return matches
@@ -0,0 +1,348 @@
+"""Durable SQLite record of lobby and spectate match lifecycles, fed by MatchBook deltas.
+
+MatchBook forgets a match as soon as the server drops it. MatchStore keeps it: when each
+match was created and removed per context, its map and elotype, and every player's join
+and leave, in normalized tables indexed for player and time queries:
+
+    store = MatchStore("matches.sqlite3")
+    runtime = LobbyRuntime(on_player_remove=store.on_player_remove)
+    for book in runtime.books.values():
+        store.attach(book)
+    runtime.start()
+    ...
+    store.matches_for_player("199325", since=time.time() - 86400)
+
+The update listener only diffs slots against the store's own copy of each match's players
+and queues rows; a background thread writes them in batched WAL transactions, so the event
+loop never waits for the disk. Matches left open by a previous run are closed on the first
+full update of their context that no longer contains them.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from itertools import groupby
+from typing import Optional
+
+from lobby import lobby
+from lobby.match_book import MatchBook, MatchBookDelta
+from lobby.utils import iter_slots
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    context TEXT NOT NULL,
+    match_id TEXT NOT NULL,
+    map_name TEXT,
+    elotype TEXT,
+    created_at REAL NOT NULL,
+    removed_at REAL,
+    PRIMARY KEY (context, match_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS matches_created_at ON matches (created_at);
+CREATE INDEX IF NOT EXISTS matches_match_id ON matches (match_id);
+
+CREATE TABLE IF NOT EXISTS players (
+    profile_id TEXT PRIMARY KEY,
+    name TEXT,
+    last_seen_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS match_players (
+    context TEXT NOT NULL,
+    match_id TEXT NOT NULL,
+    profile_id TEXT NOT NULL,
+    joined_at REAL NOT NULL,
+    left_at REAL,
+    left_reason TEXT
+);
+CREATE INDEX IF NOT EXISTS match_players_player ON match_players (profile_id, joined_at);
+CREATE INDEX IF NOT EXISTS match_players_match ON match_players (context, match_id);
+
+CREATE VIEW IF NOT EXISTS match_lifecycle AS
+SELECT ids.match_id,
+       COALESCE(spectate.map_name, lobby.map_name) AS map_name,
+       COALESCE(spectate.elotype, lobby.elotype) AS elotype,
+       lobby.created_at AS created_at,
+       lobby.removed_at AS closed_at,
+       spectate.created_at AS started_at,
+       spectate.removed_at AS ended_at
+FROM (SELECT DISTINCT match_id FROM matches) AS ids
+LEFT JOIN matches AS lobby ON lobby.context = 'lobby' AND lobby.match_id = ids.match_id
+LEFT JOIN matches AS spectate ON spectate.context = 'spectate' AND spectate.match_id = ids.match_id;
+"""
+
+# Statements the writer runs, by the operation name queued with their parameters.
+_STATEMENTS = {
+    "match": (
+        "INSERT INTO matches (context, match_id, map_name, elotype, created_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (context, match_id) DO UPDATE SET map_name = excluded.map_name, elotype = excluded.elotype, removed_at = NULL"
+    ),
+    "player": (
+        "INSERT INTO players (profile_id, name, last_seen_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (profile_id) DO UPDATE SET name = excluded.name, last_seen_at = excluded.last_seen_at"
+    ),
+    "join": "INSERT INTO match_players (context, match_id, profile_id, joined_at) VALUES (?, ?, ?, ?)",
+    "leave": (
+        "UPDATE match_players SET left_at = ?, left_reason = 'left' "
+        "WHERE context = ? AND match_id = ? AND profile_id = ? AND left_at IS NULL"
+    ),
+    # A confirmed leave from on_player_remove; also corrects a "closed" leave, since the player
+    # left the lobby instead of moving on to the started game.
+    "confirmed_leave": (
+        "UPDATE match_players SET left_at = COALESCE(left_at, ?), left_reason = 'left' "
+        "WHERE context = ? AND match_id = ? AND profile_id = ? AND (left_at IS NULL OR left_reason = 'closed')"
+    ),
+    "remove": "UPDATE matches SET removed_at = ? WHERE context = ? AND match_id = ?",
+    "close": (
+        "UPDATE match_players SET left_at = ?, left_reason = 'closed' "
+        "WHERE context = ? AND match_id = ? AND left_at IS NULL"
+    ),
+}
+
+_STOP = object()
+
+
+def _match_state(match) -> tuple:
+    players = {}
+    for slot in iter_slots(match):
+        profile_id = slot.get("profileid")
+        if profile_id is not None:
+            players[str(profile_id)] = slot.get("name")
+    map_name, elotype = match.get("map_name"), match.get("elotype")
+    return map_name, None if elotype is None else str(elotype), players
+
+
+class MatchStore:
+    def __init__(
+        self,
+        path: str = "lobby_matches.sqlite3",
+        batch_size: int = 2000,
+        flush_interval: float = 1.0,
+        max_queue: int = 200_000,
+    ):
+        '''
+        :param path: SQLite database file, created with the schema if missing.
+        :param batch_size: Most rows written per transaction.
+        :param flush_interval: Seconds the writer waits to fill a batch before committing what it has.
+        :param max_queue: Rows queued for the writer before new rows are dropped (and counted) instead of
+            blocking the event loop.
+        '''
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        # (context, match_id) -> (map_name, elotype, {profile_id: name}) of every match not yet removed.
+        self._matches: dict[tuple[str, str], tuple] = {}
+        # context -> IDs of matches loaded as open at startup, until the context's first full update confirms them.
+        self._unconfirmed: dict[str, set] = {}
+        self._stats = {"queued": 0, "written": 0, "batches": 0, "dropped": 0, "errors": 0, "last_batch_seconds": 0.0}
+        self._idle = threading.Event()
+        self._idle.set()
+
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.executescript(_SCHEMA)
+            self._load_open_matches(connection)
+        finally:
+            connection.close()
+        self._thread = threading.Thread(target=self._write_loop, name="MatchStore", daemon=True)
+        self._thread.start()
+
+    def _load_open_matches(self, connection: sqlite3.Connection) -> None:
+        # Resume the diff state of matches that were live at shutdown, so a restart does not
+        # record every player still in them as joining again.
+        for context, match_id, map_name, elotype in connection.execute(
+            "SELECT context, match_id, map_name, elotype FROM matches WHERE removed_at IS NULL"
+        ):
+            self._matches[(context, match_id)] = (map_name, elotype, {})
+            self._unconfirmed.setdefault(context, set()).add(match_id)
+        for context, match_id, profile_id, name in connection.execute(
+            "SELECT match_players.context, match_players.match_id, match_players.profile_id, players.name "
+            "FROM match_players LEFT JOIN players USING (profile_id) WHERE match_players.left_at IS NULL"
+        ):
+            state = self._matches.get((context, match_id))
+            if state is not None:
+                state[2][profile_id] = name
+
+    ## ---------------------------- Ingest (event loop thread) ---------------------------- ##
+    def attach(self, book: MatchBook) -> "MatchStore":
+        book.add_update_listener(self._on_update)
+        return self
+
+    def detach(self, book: MatchBook) -> None:
+        book.remove_update_listener(self._on_update)
+
+    def _put(self, operation: str, parameters: tuple) -> None:
+        self._idle.clear()
+        try:
+            self._queue.put_nowait((operation, parameters))
+        except queue.Full:
+            self._stats["dropped"] += 1
+            return
+        self._stats["queued"] += 1
+
+    def _on_update(self, book: MatchBook, delta: MatchBookDelta) -> None:
+        now = time.time()
+        context = book.subscription_type
+        for match in delta.added + delta.updated:
+            key = (context, str(match.get("matchid")))
+            map_name, elotype, players = _match_state(match)
+            previous = self._matches.get(key)
+            if previous is None or previous[:2] != (map_name, elotype):
+                self._put("match", (context, key[1], map_name, elotype, now))
+            previous_players = previous[2] if previous is not None else {}
+            for profile_id, name in players.items():
+                if profile_id not in previous_players:
+                    self._put("player", (profile_id, name, now))
+                    self._put("join", (context, key[1], profile_id, now))
+            for profile_id in previous_players.keys() - players.keys():
+                self._put("leave", (now, context, key[1], profile_id))
+            self._matches[key] = (map_name, elotype, players)
+        for match in delta.removed:
+            match_id = str(match.get("matchid"))
+            self._matches.pop((context, match_id), None)
+            self._put("remove", (now, context, match_id))
+            self._put("close", (now, context, match_id))
+        if context in self._unconfirmed and "update" in lobby.get_response_type(delta.event):
+            self._close_unconfirmed(book, context, now)
+
+    def _close_unconfirmed(self, book: MatchBook, context: str, now: float) -> None:
+        # After its first full update the book holds every live match, so matches that were open
+        # at startup and are not in it ended while this process was down. Close them as of now.
+        for match_id in self._unconfirmed.pop(context):
+            if book.get_match_by_id(match_id) is None and self._matches.pop((context, match_id), None) is not None:
+                self._put("remove", (now, context, match_id))
+                self._put("close", (now, context, match_id))
+
+    def on_player_remove(self, player_id: str, context: str, match_id: str, match) -> None:
+        '''MatchBook on_player_remove callback recording a confirmed leave. Chain it from your own callback if you have one.'''
+        self._put("confirmed_leave", (time.time(), context, str(match_id), str(player_id)))
+
+    ## ---------------------------- Writer thread ---------------------------- ##
+    def _write_loop(self) -> None:
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode = WAL")
+        # WAL with synchronous=NORMAL stays consistent on power loss and only risks the last commits.
+        connection.execute("PRAGMA synchronous = NORMAL")
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    self._idle.set()
+                    continue
+                if item is _STOP:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                stop = False
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._write_batch(connection, batch)
+                if stop:
+                    return
+                if self._queue.empty():
+                    self._idle.set()
+        finally:
+            connection.close()
+            self._idle.set()
+
+    def _write_batch(self, connection: sqlite3.Connection, batch: list) -> None:
+        started = time.perf_counter()
+        try:
+            with connection:
+                # Runs of the same statement go through executemany(); order between runs is kept.
+                for operation, items in groupby(batch, key=lambda item: item[0]):
+                    connection.executemany(_STATEMENTS[operation], [parameters for _, parameters in items])
+        except sqlite3.Error as e:
+            self._stats["errors"] += 1
+            print(f" ! Failed to write {len(batch)} match rows to '{self.path}': {e}")
+            return
+        self._stats["written"] += len(batch)
+        self._stats["batches"] += 1
+        self._stats["last_batch_seconds"] = time.perf_counter() - started
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        '''Wait until every queued row is committed. Blocks, so call it off the event loop. Returns False on timeout.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not (self._queue.empty() and self._idle.is_set()):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._idle.wait(0.05 if remaining is None else min(0.05, remaining))
+        return True
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        '''Commit the queued rows and stop the writer thread.'''
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        '''Return row counts: "queued", "written", "dropped" (queue full), "pending", plus "batches", "errors", and "last_batch_seconds".'''
+        return {**self._stats, "pending": self._queue.qsize(), "open_matches": len(self._matches)}
+
+    def __enter__(self) -> "MatchStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    ## ---------------------------- Queries (any thread) ---------------------------- ##
+    def _query(self, sql: str, parameters: tuple = ()) -> list[dict]:
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in connection.execute(sql, parameters)]
+        finally:
+            connection.close()
+
+    def matches_for_player(self, profile_id, since: Optional[float] = None, until: Optional[float] = None) -> list[dict]:
+        '''
+        Return the player's match memberships joined after since and before until, newest first:
+        context, match_id, map_name, elotype, joined_at, left_at, and left_reason ("left" or "closed").
+        '''
+        return self._query(
+            "SELECT match_players.context, match_players.match_id, matches.map_name, matches.elotype, "
+            "match_players.joined_at, match_players.left_at, match_players.left_reason "
+            "FROM match_players JOIN matches USING (context, match_id) "
+            "WHERE match_players.profile_id = ? AND match_players.joined_at >= ? AND match_players.joined_at < ? "
+            "ORDER BY match_players.joined_at DESC",
+            (str(profile_id), since if since is not None else float("-inf"), until if until is not None else float("inf")),
+        )
+
+    def matches_between(self, start: float, end: Optional[float] = None, context: Optional[str] = None) -> list[dict]:
+        '''Return matches created in [start, end), oldest first, optionally of one context.'''
+        end = time.time() if end is None else end
+        sql = "SELECT * FROM matches WHERE created_at >= ? AND created_at < ?"
+        parameters = (start, end)
+        if context is not None:
+            sql += " AND context = ?"
+            parameters += (context,)
+        return self._query(sql + " ORDER BY created_at", parameters)
+
+    def lifecycle(self, match_id) -> Optional[dict]:
+        '''Return one match's created_at, closed_at (left the lobby), started_at, and ended_at, or None if never seen.'''
+        rows = self._query("SELECT * FROM match_lifecycle WHERE match_id = ?", (str(match_id),))
+        return rows[0] if rows else None
+
+    def players(self, context: str, match_id) -> list[dict]:
+        '''Return everyone who was in a match, in join order.'''
+        return self._query(
+            "SELECT match_players.profile_id, players.name, match_players.joined_at, match_players.left_at, match_players.left_reason "
+            "FROM match_players LEFT JOIN players USING (profile_id) "
+            "WHERE match_players.context = ? AND match_players.match_id = ? ORDER BY match_players.joined_at",
+            (context, str(match_id)),
+        )
@@ -0,0 +1,284 @@
+"""Always-on latency and throughput metrics for the lobby pipeline.
+
+lobby._lobby_event_stream() records every frame (count, UTF-8 bytes, decode time), the time each
+consumer spends on an event, the event's lag behind its upstream timestamp when the server
+sends one, and every reconnect with its reason. MatchBook records its size and the cost of
+each update, and receive_lobby_events() and MatchBook listeners record per-callback times.
+
+Everything lands in the process-wide `pipeline` registry, which can be read in-process:
+
+    from lobby import metrics
+    metrics.pipeline.snapshot()["rates"]["frames_per_second"]
+
+or exported as JSON to a file (start_exporting()) or as Prometheus text over HTTP
+(serve_metrics(), at /metrics and /metrics.json). Recording costs a clock read and a
+bisect, so it stays on without a profiling session.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Optional
+
+from aiohttp import web
+
+from shared import codec
+
+
+defaults = {
+    "export_interval": 15.0,    # Seconds between metrics file writes.
+    "host": "127.0.0.1",
+    "port": 9108,
+    "rate_window": 60,          # Seconds of per-second frame counts kept for rates.
+}
+
+# Histogram bucket upper bounds in seconds: 1 microsecond to about 134 seconds, doubling.
+BUCKETS = tuple(1e-6 * 2 ** exponent for exponent in range(28))
+
+# Top-level event keys checked for an upstream timestamp, in seconds or milliseconds since the epoch.
+_TIMESTAMP_KEYS = ("timestamp", "ts", "time", "sent_at")
+
+
+class Histogram:
+    '''Counts of observed durations in the fixed BUCKETS, with sum and max. Percentiles are bucket upper bounds.'''
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percentile: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = percentile / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class PipelineMetrics:
+    '''
+    Counters, gauges, duration histograms, and frame rates for one process.
+
+    Histograms are named "decode" (parsing an event; lazily decoded objects are parsed, and timed, when their
+    consumer first reads them), "decode.peek" (reading a lazy object's response type on receipt), "consumer"
+    (time a consumer of _lobby_event_stream() held each event), "lag.upstream" (consumer done minus the
+    event's upstream timestamp, when present), "lag.pipeline" (frame received to consumer done),
+    "callback.<name>", "listener.<name>", and "book.<context>.update".
+    '''
+
+    def __init__(self, rate_window: int = defaults["rate_window"]):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters: dict[str, int] = {"frames": 0, "bytes": 0, "events": 0, "reconnects": 0}
+        self.gauges: dict[str, float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.reconnect_reasons: dict[str, int] = {}
+        self.last_reconnect: Optional[dict] = None
+        # [second, frames, bytes] per second, oldest first.
+        self._window: deque = deque(maxlen=rate_window + 1)
+
+    ## ---------------------------- Recording ---------------------------- ##
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def frame(self, size: int) -> None:
+        '''Count one received frame of size bytes (UTF-8 encoded size for text frames).'''
+        second = int(time.monotonic())
+        with self._lock:
+            self.counters["frames"] += 1
+            self.counters["bytes"] += size
+            window = self._window
+            if not window or window[-1][0] != second:
+                window.append([second, 0, 0])
+            bucket = window[-1]
+            bucket[1] += 1
+            bucket[2] += size
+
+    def event(self, event) -> None:
+        '''Count an event its consumer is done with, and record its lag behind its upstream timestamp if it has one.'''
+        with self._lock:
+            self.counters["events"] += 1
+        upstream = upstream_timestamp(event)
+        if upstream is not None:
+            self.observe("lag.upstream", max(0.0, time.time() - upstream))
+
+    def reconnect(self, reason: str, detail: str = "") -> None:
+        '''Count a reconnect. reason is a short category (an exception type, or "closed"); detail, e.g. the error message, is kept for the last one only.'''
+        with self._lock:
+            self.counters["reconnects"] += 1
+            self.reconnect_reasons[reason] = self.reconnect_reasons.get(reason, 0) + 1
+            self.last_reconnect = {"reason": reason, "detail": detail, "at": time.time()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self.counters = dict.fromkeys(self.counters, 0)
+            self.gauges.clear()
+            self.histograms.clear()
+            self.reconnect_reasons.clear()
+            self.last_reconnect = None
+            self._window.clear()
+
+    ## ---------------------------- Reading ---------------------------- ##
+    def rates(self, seconds: int = 10) -> dict:
+        '''Frames and bytes per second over the last `seconds` complete seconds.'''
+        now = int(time.monotonic())
+        with self._lock:
+            buckets = [bucket for bucket in self._window if now - seconds <= bucket[0] < now]
+        return {
+            "frames_per_second": sum(bucket[1] for bucket in buckets) / seconds,
+            "bytes_per_second": sum(bucket[2] for bucket in buckets) / seconds,
+            "window_seconds": seconds,
+        }
+
+    def snapshot(self) -> dict:
+        '''All metrics as a JSON-serializable dict.'''
+        with self._lock:
+            histograms = {name: histogram.summary() for name, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+            reasons = dict(self.reconnect_reasons)
+            last_reconnect = self.last_reconnect
+        return {
+            "at": time.time(),
+            "uptime": time.time() - self.started_at,
+            "counters": counters,
+            "rates": self.rates(),
+            "gauges": dict(self.gauges),
+            "histograms": histograms,
+            "reconnects": {"count": counters["reconnects"], "reasons": reasons, "last": last_reconnect},
+        }
+
+    def to_prometheus(self, prefix: str = "agekeeper_lobby") -> str:
+        '''All metrics in the Prometheus text exposition format.'''
+        lines = []
+        with self._lock:
+            for name, value in self.counters.items():
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            if self.reconnect_reasons:
+                lines.append(f"# TYPE {prefix}_reconnect_reasons_total counter")
+            for reason, count in self.reconnect_reasons.items():
+                lines.append(f'{prefix}_reconnect_reasons_total{{reason="{_label(reason)}"}} {count}')
+            if self.histograms:
+                lines.append(f"# TYPE {prefix}_seconds histogram")
+            for name, histogram in self.histograms.items():
+                label = f'name="{_label(name)}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_seconds_bucket{{{label},le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'{prefix}_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}_seconds_sum{{{label}}} {histogram.total}")
+                lines.append(f"{prefix}_seconds_count{{{label}}} {histogram.count}")
+        if self.gauges:
+            lines.append(f"# TYPE {prefix}_gauge gauge")
+        for name, value in self.gauges.items():
+            lines.append(f'{prefix}_gauge{{name="{_label(name)}"}} {value}')
+        rates = self.rates()
+        lines.append(f"# TYPE {prefix}_frames_per_second gauge")
+        lines.append(f"{prefix}_frames_per_second {rates['frames_per_second']}")
+        lines.append(f"# TYPE {prefix}_bytes_per_second gauge")
+        lines.append(f"{prefix}_bytes_per_second {rates['bytes_per_second']}")
+        return "\n".join(lines) + "\n"
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def upstream_timestamp(event) -> Optional[float]:
+    '''
+    The event's upstream send time in epoch seconds, if it carries one at the top level.
+    A lazily decoded event its consumer never read is not parsed just for this, and gives None.
+    '''
+    if not hasattr(event, "get") or not getattr(event, "loaded", True):
+        return None
+    for key in _TIMESTAMP_KEYS:
+        value = event.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+            return value / 1000 if value > 1e11 else float(value)
+    return None
+
+
+def callback_name(callback) -> str:
+    return getattr(callback, "__qualname__", None) or type(callback).__name__
+
+
+pipeline = PipelineMetrics()
+
+
+## ---------------------------- Export ---------------------------- ##
+def write_metrics(path: str, metrics: PipelineMetrics = pipeline) -> None:
+    '''Write metrics.snapshot() to path as JSON, replacing the previous file atomically.'''
+    data = codec.dumps_bytes(metrics.snapshot())
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+
+
+async def _export_loop(path: str, interval: float, metrics: PipelineMetrics):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(write_metrics, path, metrics)
+        except OSError as e:
+            print(f" ! Failed to write lobby metrics to '{path}': {e}")
+
+
+def start_exporting(path: str, interval: float = defaults["export_interval"], metrics: PipelineMetrics = pipeline) -> asyncio.Task:
+    '''Start a background task writing the metrics to path every interval seconds. Needs a running event loop.'''
+    return asyncio.create_task(_export_loop(path, interval, metrics))
+
+
+async def serve_metrics(host: str = defaults["host"], port: int = defaults["port"], metrics: PipelineMetrics = pipeline) -> web.AppRunner:
+    '''
+    Serve the metrics over HTTP: Prometheus text at /metrics, the snapshot at /metrics.json.
+    Returns the runner; await runner.cleanup() to stop.
+    '''
+    async def prometheus(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+    async def json_snapshot(request: web.Request) -> web.Response:
+        return web.Response(body=codec.dumps_bytes(metrics.snapshot()), content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus)
+    app.router.add_get("/metrics.json", json_snapshot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
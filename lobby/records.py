@@ -0,0 +1,165 @@
+"""Compact records for lobby matches, an opt-in alternative to raw JSON dicts.
+
+A MatchRecord is a named tuple holding interned strings, integer ids, and
+its slots as per-field columns of plain tuples. Plain tuples of atomic values
+are untracked by the cyclic garbage collector, so each match costs one tracked
+object instead of one per slot, and the records are smaller than the dicts.
+"""
+
+import sys
+from typing import Any, NamedTuple, Optional
+
+
+_SLOT_FIELDS = ("name", "profileid", "civ", "rating")
+_MATCH_FIELDS = ("matchid", "map_name", "elotype")
+
+
+def _as_int(value) -> Optional[int]:
+    # Only conversions that round-trip exactly: 1500.5 or "007" are not ints here.
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            as_int = int(value)
+        except ValueError:
+            return None
+        return as_int if str(as_int) == value else None
+    return None
+
+
+def _as_id(value):
+    # Integer ids are stored as ints; anything else is kept (interned) as-is.
+    as_int = _as_int(value)
+    if as_int is not None:
+        return as_int
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _record_get(record, fields, key, default):
+    if key in fields:
+        value = getattr(record, key)
+        return default if value is None else value
+    if record.extra:
+        return record.extra.get(key, default)
+    return default
+
+
+def _record_to_dict(record, fields) -> dict:
+    result = dict(record.extra) if record.extra else {}
+    for key in fields:
+        value = getattr(record, key)
+        if value is not None:
+            result[key] = value
+    return result
+
+
+class SlotRecord(NamedTuple):
+    position: Any
+    name: Optional[str] = None
+    profileid: Any = None
+    civ: Any = None
+    rating: Any = None
+    # Any slot fields not modelled above, or None.
+    extra: Optional[dict] = None
+
+    @classmethod
+    def from_dict(cls, position, slot: dict) -> "SlotRecord":
+        extra = {key: value for key, value in slot.items() if key not in _SLOT_FIELDS}
+        return cls(
+            position=_as_id(position),
+            name=_intern(slot.get("name")),
+            profileid=_as_id(slot.get("profileid")),
+            civ=_as_id(slot.get("civ")),
+            rating=_as_id(slot.get("rating")),
+            extra=extra or None,
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        '''Dict-style field access so code written against raw slot dicts keeps working.'''
+        return _record_get(self, _SLOT_FIELDS, key, default)
+
+    def to_dict(self) -> dict:
+        return _record_to_dict(self, _SLOT_FIELDS)
+
+
+class MatchRecord(NamedTuple):
+    matchid: Any
+    map_name: Optional[str] = None
+    elotype: Any = None
+    # Slots are stored column-wise, one plain tuple per field, so a match costs
+    # a handful of GC-untracked tuples instead of one object per slot.
+    positions: tuple = ()
+    names: tuple = ()
+    profileids: tuple = ()
+    civs: tuple = ()
+    ratings: tuple = ()
+    slot_extras: tuple = ()
+    # Any match fields not modelled above, or None.
+    extra: Optional[dict] = None
+
+    @classmethod
+    def from_dict(cls, match: dict) -> "MatchRecord":
+        raw_slots = match.get("slots", {})
+        slots = []
+        if isinstance(raw_slots, dict):
+            slots = [
+                SlotRecord.from_dict(position, slot)
+                for position, slot in raw_slots.items()
+                if isinstance(slot, dict)
+            ]
+        extra = {key: value for key, value in match.items() if key not in _MATCH_FIELDS and key != "slots"}
+        return cls(
+            matchid=_as_id(match.get("matchid")),
+            map_name=_intern(match.get("map_name")),
+            elotype=_as_id(match.get("elotype")),
+            positions=tuple(slot.position for slot in slots),
+            names=tuple(slot.name for slot in slots),
+            profileids=tuple(slot.profileid for slot in slots),
+            civs=tuple(slot.civ for slot in slots),
+            ratings=tuple(slot.rating for slot in slots),
+            slot_extras=tuple(slot.extra for slot in slots),
+            extra=extra or None,
+        )
+
+    @property
+    def slots(self) -> tuple[SlotRecord, ...]:
+        '''Slot records, built on demand from the per-field columns.'''
+        return tuple(
+            SlotRecord(*fields)
+            for fields in zip(self.positions, self.names, self.profileids, self.civs, self.ratings, self.slot_extras)
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        '''
+        Dict-style field access so code written against raw match dicts keeps working.
+        "slots" is returned as a freshly built {position: SlotRecord} dict; prefer
+        lobby.utils.iter_slots() on hot paths.
+        '''
+        if key == "slots":
+            return {str(slot.position): slot for slot in self.slots}
+        return _record_get(self, _MATCH_FIELDS, key, default)
+
+    def to_dict(self) -> dict:
+        match = _record_to_dict(self, _MATCH_FIELDS)
+        match["slots"] = {str(slot.position): slot.to_dict() for slot in self.slots}
+        return match
+
+
+def to_record(match) -> MatchRecord:
+    '''Convert a raw match dict to a MatchRecord; records are returned unchanged.'''
+    if isinstance(match, MatchRecord):
+        return match
+    return MatchRecord.from_dict(match)
+
+
+def to_dict(match) -> dict:
+    '''Convert a MatchRecord back to a raw match dict; dicts are returned unchanged.'''
+    if isinstance(match, MatchRecord):
+        return match.to_dict()
+    return match
@@ -0,0 +1,348 @@
+"""Local fan-out relay that shares one aoe2lobby upstream connection between many clients.
+
+The relay keeps a single upstream subscription and one MatchBook per context,
+and serves local WebSocket clients using the same protocol as the upstream
+server: clients send the usual subscribe messages (see lobby.Subscription)
+and receive a full "<context>_update" snapshot followed by deltas in the
+upstream event format. A client that falls behind gets a fresh snapshot whose
+"<context>_remove" list retracts every match it may still hold that has ended.
+Existing consumers can therefore switch to the relay by passing
+url="ws://127.0.0.1:8765/ws/" to lobby.connect_to_subscriptions().
+
+Subscription types act as per-client filters:
+- "matches": every match of the context.
+- "players": matches containing any of the given profile IDs, plus
+  player_status events for those IDs.
+- "elotypes": matches with any of the given elo types.
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+import aiohttp
+from aiohttp import web
+
+from lobby import lobby
+from lobby.match_book import MatchBook
+from lobby.records import to_dict
+from lobby.utils import iter_slots
+from shared import codec
+
+
+defaults = {
+    "host": "127.0.0.1",
+    "port": 8765,
+    "path": "/ws/",
+    "contexts": ["lobby", "spectate"],
+    "client_queue_size": 256,   # Pending messages per client before it is resynced with a fresh snapshot.
+}
+
+
+## ---------------------------- Client filters ---------------------------- ##
+@dataclass(frozen=True)
+class RelayFilter:
+    '''What one client wants from one context. Hashable, so clients with equal filters share encoded messages.'''
+    all_matches: bool = False
+    profile_ids: frozenset = field(default_factory=frozenset)
+    elotypes: frozenset = field(default_factory=frozenset)
+
+    def merge(self, subscription_type: str, ids: Optional[Iterable] = None) -> "RelayFilter":
+        ids = frozenset(str(item) for item in ids or [])
+        if subscription_type == "matches":
+            return RelayFilter(True, self.profile_ids, self.elotypes)
+        if subscription_type == "players":
+            return RelayFilter(self.all_matches, self.profile_ids | ids, self.elotypes)
+        if subscription_type == "elotypes":
+            return RelayFilter(self.all_matches, self.profile_ids, self.elotypes | ids)
+        raise ValueError(f"Unknown subscription type: {subscription_type}")
+
+    def accepts(self, match) -> bool:
+        if match is None:
+            return False
+        if self.all_matches:
+            return True
+        if self.elotypes and str(match.get("elotype")) in self.elotypes:
+            return True
+        if self.profile_ids:
+            return any(str(slot.get("profileid")) in self.profile_ids for slot in iter_slots(match))
+        return False
+
+
+class _RelayClient:
+    def __init__(self, ws: web.WebSocketResponse, queue_size: int):
+        self.ws = ws
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.filters: dict[str, RelayFilter] = {}
+        # Match IDs per context the client holds or has queued. Removals leave it once they are sent,
+        # so a resync that drops the backlog still retracts them.
+        self.held: dict[str, set] = {}
+
+    def wants_player(self, player_id: str) -> bool:
+        return any(player_id in relay_filter.profile_ids for relay_filter in self.filters.values())
+
+
+## ---------------------------- Relay ---------------------------- ##
+class LobbyRelay:
+    def __init__(
+        self,
+        contexts: Iterable[str] = defaults["contexts"],
+        host: str = defaults["host"],
+        port: int = defaults["port"],
+        path: str = defaults["path"],
+        upstream_url: str = lobby.WS_URL,
+        upstream_subscriptions: Optional[list] = None,
+        client_queue_size: int = defaults["client_queue_size"],
+        compact: bool = False,
+    ):
+        '''
+        :param contexts: Match contexts to mirror ("lobby", "spectate"), one MatchBook each.
+        :param upstream_subscriptions: Extra upstream subscriptions, e.g. a players subscription for player_status events.
+        :param client_queue_size: Per-client backlog limit. A client that falls this far behind is resynced with a snapshot.
+        :param compact: Store matches as lobby.records.MatchRecord.
+        '''
+        self.contexts = list(contexts)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.upstream_url = upstream_url
+        self.books = {context: MatchBook(context, compact=compact) for context in self.contexts}
+        self.upstream_subscriptions = lobby.subscribe(self.contexts) + list(upstream_subscriptions or [])
+        self.client_queue_size = client_queue_size
+        self.clients: set[_RelayClient] = set()
+        self.stats = {"events": 0, "malformed": 0, "messages_sent": 0, "resyncs": 0}
+        self._runner: Optional[web.AppRunner] = None
+
+    ## ---------------------------- Encoding ---------------------------- ##
+    @staticmethod
+    def _encode(event: dict) -> str:
+        return codec.dumps(event)
+
+    def _snapshot_message(self, client: _RelayClient, context: str, relay_filter: RelayFilter) -> tuple[str, list]:
+        matches = {
+            str(match.get("matchid")): to_dict(match)
+            for match in self.books[context]
+            if relay_filter.accepts(match)
+        }
+        # Clients apply a snapshot as upserts, so matches they hold that it lacks (e.g. whose removal was
+        # dropped with a backlog) are removed explicitly.
+        removals = [match_id for match_id in client.held.get(context, ()) if match_id not in matches]
+        client.held[context] = set(matches).union(removals)
+        return self._encode({f"{context}_update": matches, f"{context}_remove": removals}), removals
+
+    @staticmethod
+    def _removal_key(event: dict, context: str) -> str:
+        # MatchBook.remove_matches reads removals from the event's second key.
+        event_types = list(event.keys())
+        return event_types[1] if len(event_types) > 1 else f"{context}_remove"
+
+    def _match_ids(self, event: dict, context: str) -> tuple[list, list]:
+        '''(upserted, removed) match IDs of an event as sent to clients.'''
+        updated = event.get(lobby.get_response_type(event))
+        removed = event.get(self._removal_key(event, context)) if len(event) > 1 else None
+        return (
+            [str(match_id) for match_id in updated] if isinstance(updated, dict) else [],
+            [str(match_id) for match_id in removed] if isinstance(removed, list) else [],
+        )
+
+    def _filtered_event(self, event: dict, context: str, relay_filter: RelayFilter, previous: dict) -> Optional[dict]:
+        response_type = lobby.get_response_type(event)
+        if relay_filter.all_matches:
+            return event
+        updated = event.get(response_type) or {}
+        removal_key = self._removal_key(event, context)
+        removed_ids = event.get(removal_key) if len(event) > 1 else []
+        upserts = {}
+        removals = []
+        for match_id, match in updated.items() if isinstance(updated, dict) else []:
+            if relay_filter.accepts(match):
+                upserts[match_id] = match
+            elif relay_filter.accepts(previous.get(str(match_id))):
+                # The match no longer passes this filter (e.g. the watched player left), so retract it.
+                removals.append(match_id)
+        for match_id in removed_ids if isinstance(removed_ids, list) else []:
+            if relay_filter.accepts(previous.get(str(match_id))):
+                removals.append(match_id)
+        if not upserts and not removals:
+            return None
+        filtered = {response_type: upserts, removal_key: removals}
+        for key, value in event.items():
+            if key not in filtered:
+                filtered[key] = value
+        return filtered
+
+    ## ---------------------------- Fan-out ---------------------------- ##
+    def _send(self, client: _RelayClient, message: str, context: Optional[str] = None, removed: list = ()) -> None:
+        try:
+            client.queue.put_nowait((message, context, removed))
+        except asyncio.QueueFull:
+            self._resync(client)
+
+    def _resync(self, client: _RelayClient) -> None:
+        # Drop the stale backlog and replace it with one snapshot per context;
+        # a snapshot supersedes every delta queued before it.
+        while not client.queue.empty():
+            client.queue.get_nowait()
+        for context, relay_filter in client.filters.items():
+            message, removals = self._snapshot_message(client, context, relay_filter)
+            client.queue.put_nowait((message, context, removals))
+        self.stats["resyncs"] += 1
+
+    def publish(self, event) -> None:
+        '''Apply one upstream event to the matching MatchBook and fan it out to subscribed clients.'''
+        try:
+            # First access parses a lazily decoded event, so a malformed body surfaces here.
+            if not isinstance(event, dict) or not event:
+                return
+        except codec.DecodeError as e:
+            self.stats["malformed"] += 1
+            print(f" ! Skipping malformed lobby event: {e}")
+            return
+        self.stats["events"] += 1
+        response_type = lobby.get_response_type(event)
+        context = response_type.split("_")[0]
+        book = self.books.get(context)
+        if book is None:
+            self._publish_player_event(event, response_type)
+            return
+
+        touched_ids = []
+        updated = event.get(response_type)
+        if isinstance(updated, dict):
+            touched_ids.extend(updated.keys())
+        if len(event) > 1 and isinstance(event.get(self._removal_key(event, context)), list):
+            touched_ids.extend(event.get(self._removal_key(event, context)))
+        previous = {str(match_id): book.get_match_by_id(match_id) for match_id in touched_ids}
+        book.update(event)
+
+        groups: dict[RelayFilter, list[_RelayClient]] = {}
+        for client in self.clients:
+            relay_filter = client.filters.get(context)
+            if relay_filter is not None:
+                groups.setdefault(relay_filter, []).append(client)
+        for relay_filter, clients in groups.items():
+            filtered = self._filtered_event(event, context, relay_filter, previous)
+            if filtered is None:
+                continue
+            message = self._encode(filtered)
+            upserted, removed = self._match_ids(filtered, context)
+            for client in clients:
+                client.held.setdefault(context, set()).update(upserted)
+                self._send(client, message, context, removed)
+
+    def _publish_player_event(self, event: dict, response_type: str) -> None:
+        payload = event.get(response_type)
+        player_ids = [str(player_id) for player_id in payload] if isinstance(payload, dict) else []
+        message = None
+        for client in self.clients:
+            if any(client.wants_player(player_id) for player_id in player_ids):
+                message = message or self._encode(event)
+                self._send(client, message)
+
+    ## ---------------------------- Server ---------------------------- ##
+    async def _writer(self, client: _RelayClient) -> None:
+        while True:
+            message, context, removed = await client.queue.get()
+            await client.ws.send_str(message)
+            if removed:
+                client.held[context].difference_update(removed)
+            self.stats["messages_sent"] += 1
+
+    def _handle_subscribe(self, client: _RelayClient, text: str) -> None:
+        try:
+            request = codec.loads(text)
+        except codec.DecodeError:
+            return
+        if not isinstance(request, dict) or request.get("action") != "subscribe":
+            return
+        context = request.get("context")
+        if context not in self.books:
+            return
+        try:
+            relay_filter = client.filters.get(context, RelayFilter()).merge(request.get("type"), request.get("ids"))
+        except ValueError:
+            return
+        client.filters[context] = relay_filter
+        message, removals = self._snapshot_message(client, context, relay_filter)
+        self._send(client, message, context, removals)
+
+    async def handle_client(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=20.0)
+        await ws.prepare(request)
+        client = _RelayClient(ws, self.client_queue_size)
+        self.clients.add(client)
+        writer = asyncio.create_task(self._writer(client))
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    self._handle_subscribe(client, message.data)
+        finally:
+            self.clients.discard(client)
+            writer.cancel()
+        return ws
+
+    async def start_server(self) -> None:
+        app = web.Application()
+        app.router.add_get(self.path, self.handle_client)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"Lobby relay listening on ws://{self.host}:{self.port}{self.path}")
+
+    async def stop_server(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def run(self) -> None:
+        '''Serve local clients and consume the upstream stream until cancelled.'''
+        await self.start_server()
+        try:
+            async for event in lobby._lobby_event_stream(self.upstream_subscriptions, url=self.upstream_url):
+                self.publish(event)
+        finally:
+            await self.stop_server()
+
+
+## ---------------------------- CLI/Arg parser ---------------------------- ##
+def _build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Relay one aoe2lobby upstream connection to local WebSocket clients.")
+    parser.add_argument("--host", type=str, default=defaults["host"], help="Interface to listen on.")
+    parser.add_argument("--port", type=int, default=defaults["port"], help="Port to listen on.")
+    parser.add_argument("--path", type=str, default=defaults["path"], help="WebSocket path.")
+    parser.add_argument(
+        "--contexts",
+        type=str,
+        default=",".join(defaults["contexts"]),
+        help="Comma-separated match contexts to mirror (lobby, spectate).",
+    )
+    parser.add_argument(
+        "--players",
+        type=str,
+        default=None,
+        help="Comma-separated player profile IDs to request player_status events for upstream.",
+    )
+    parser.add_argument("--compact", action="store_true", help="Store matches as compact records.")
+    return parser
+
+
+def main() -> None:
+    args = _build_arg_parser().parse_args()
+    upstream_subscriptions = []
+    player_ids = lobby._parse_ids(args.players)
+    if player_ids:
+        upstream_subscriptions.append(lobby.lobby_players_subscription(player_ids))
+    relay = LobbyRelay(
+        contexts=lobby._parse_ids(args.contexts) or defaults["contexts"],
+        host=args.host,
+        port=args.port,
+        path=args.path,
+        upstream_subscriptions=upstream_subscriptions,
+        compact=args.compact,
+    )
+    asyncio.run(relay.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Embedded lobby runtime that keeps MatchBooks live on a background thread.
+
+Synchronous code (web handlers, batch jobs) can hold live lobby state without
+managing an event loop:
+
+    runtime = LobbyRuntime(contexts=["lobby", "spectate"])
+    runtime.start()
+    view = runtime.snapshot("lobby")          # lock-free, any thread
+    hits = runtime.query("lobby", map_names=["Arabia"], min_avg_elo=2000)
+    runtime.stop()
+
+All MatchBook mutation happens on the runtime's own event loop thread. The loop
+publishes an immutable BookSnapshot by swapping a single reference, at most once per
+publish_interval while events arrive, so readers never take a lock and never see a
+half-applied update.
+
+With an election (shared.process_guard.LeaderElection), several runtimes can run as
+leader and hot standbys: only the leader connects upstream and writes snapshots, while
+standbys reload its snapshots as they change, so a standby that takes over already
+serves the leader's last state and only has to reconnect.
+
+    runtime = LobbyRuntime(snapshot_path="state", snapshot_interval=5, election=LeaderElection("lobby"))
+"""
+
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Callable, Iterable, Optional
+
+from lobby import lobby, metrics, snapshot
+from lobby.match_book import MatchBook
+from lobby.utils import extract_player_status_update
+from shared import codec
+from shared.process_guard import LeaderElection
+
+
+@dataclass(frozen=True)
+class BookSnapshot:
+    '''Immutable, point-in-time view of one MatchBook.'''
+    context: str
+    matches: tuple
+    version: int
+    updated_at: float
+
+    def __len__(self):
+        return len(self.matches)
+
+    def __iter__(self):
+        return iter(self.matches)
+
+    @cached_property
+    def _by_id(self) -> dict:
+        # Built by the first reader that needs it; concurrent readers at worst build identical dicts.
+        return {str(match.get("matchid")): match for match in self.matches}
+
+    def get_match_by_id(self, match_id):
+        return self._by_id.get(str(match_id))
+
+
+class LobbyRuntime:
+    def __init__(
+        self,
+        contexts: Iterable[str] = ("lobby", "spectate"),
+        url: str = lobby.WS_URL,
+        extra_subscriptions: Optional[list] = None,
+        on_player_remove: Optional[Callable[[str, str, str, dict], None]] = None,
+        compact: bool = False,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 30.0,
+        election: Optional[LeaderElection] = None,
+        publish_interval: float = 0.05,
+    ):
+        '''
+        :param contexts: Match contexts to track, one MatchBook each.
+        :param extra_subscriptions: Additional upstream subscriptions, e.g. lobby.lobby_players_subscription(ids).
+        :param on_player_remove: Forwarded to each MatchBook. Called on the runtime thread.
+        :param compact: Store matches as lobby.records.MatchRecord.
+        :param snapshot_path: Directory for warm-restart snapshots ("<context>.snapshot" per book), or None to disable.
+        :param election: Run as leader or standby. A standby stays disconnected, keeping its books warm from the
+            leader's snapshots in snapshot_path, until it is elected. Use a short snapshot_interval, as a standby
+            is as far behind as the leader's last snapshot.
+        :param publish_interval: Longest time in seconds a published view trails the books while events arrive.
+            Each publish copies the book, so a burst of events is published once. 0 publishes after every event.
+        '''
+        self.contexts = list(contexts)
+        self.url = url
+        self.books = {
+            context: MatchBook(context, on_player_remove=on_player_remove, compact=compact)
+            for context in self.contexts
+        }
+        self.subscriptions = lobby.subscribe(self.contexts) + list(extra_subscriptions or [])
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.election = election
+        self.publish_interval = publish_interval
+        self.role: Optional[str] = None
+
+        self._snapshots = {
+            context: BookSnapshot(context, (), 0, 0.0) for context in self.contexts
+        }
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready = threading.Event()
+        self._publish_pending: set[str] = set()
+        self._events = 0
+        self._last_event_at: Optional[float] = None
+        self._error: Optional[BaseException] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    ## ---------------------------- Lifecycle ---------------------------- ##
+    def start(self, timeout: float = 10.0) -> "LobbyRuntime":
+        '''Start the background thread and wait until its event loop is running.'''
+        if self.is_running():
+            return self
+        self._ready.clear()
+        self._error = None
+        self._thread = threading.Thread(target=self._run_thread, name="LobbyRuntime", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError("Lobby runtime did not start in time")
+        return self
+
+    def stop(self, timeout: float = 10.0) -> None:
+        '''Cancel the stream, write a final snapshot if enabled, and join the thread.'''
+        if self._thread is None:
+            return
+        loop, task = self._loop, self._task
+        if loop is not None and task is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError("Lobby runtime did not stop in time")
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def health(self, max_event_age: float = 120.0) -> dict:
+        '''
+        Report runtime health. "healthy" requires a live thread and, once any event
+        was received, one within the last max_event_age seconds.
+        '''
+        now = time.time()
+        last_event_age = None if self._last_event_at is None else now - self._last_event_at
+        running = self.is_running()
+        return {
+            "running": running,
+            "healthy": running and (last_event_age is None or last_event_age <= max_event_age),
+            "events": self._events,
+            "last_event_age": last_event_age,
+            "match_counts": {context: len(view) for context, view in self._snapshots.items()},
+            "error": repr(self._error) if self._error else None,
+            "role": self.role,
+            "reconnects": metrics.pipeline.snapshot()["reconnects"],
+        }
+
+    def _run_thread(self) -> None:
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        asyncio.set_event_loop(loop)
+        try:
+            self._task = loop.create_task(self._main())
+            loop.call_soon(self._ready.set)
+            loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self._error = e
+            print(f" ! Lobby runtime stopped with error: {e!r}")
+        finally:
+            self._ready.set()
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+            self._loop = None
+            self._task = None
+
+    async def _main(self) -> None:
+        if self.election is not None:
+            try:
+                await self._stand_by()
+            except asyncio.CancelledError:
+                self.role = None
+                raise
+        self.role = "leader"
+        snapshot_tasks = []
+        if self.snapshot_path:
+            for context, book in self.books.items():
+                self._load_leader_snapshot(context, book)
+                self._publish(context)
+                snapshot_tasks.append(book.start_snapshots(self._snapshot_file(context), self.snapshot_interval))
+        try:
+            async for event in lobby._lobby_event_stream(self.subscriptions, url=self.url):
+                self._handle_event(event)
+        finally:
+            for context in list(self._publish_pending):
+                self._publish_scheduled(context)
+            for task in snapshot_tasks:
+                task.cancel()
+            if self.snapshot_path:
+                for context, book in self.books.items():
+                    book.save_snapshot(self._snapshot_file(context))
+            if self.election is not None:
+                # After the final snapshot, so the standby that takes over starts from it.
+                self.election.release()
+            self.role = None
+
+    async def _stand_by(self) -> None:
+        self.role = "standby"
+        loaded = {}
+        while not self.election.try_acquire():
+            if self.snapshot_path:
+                self._refresh_standby_books(loaded)
+            await asyncio.sleep(self.election.poll_interval)
+
+    def _refresh_standby_books(self, loaded: dict) -> None:
+        # Reload each book whenever the leader replaces its snapshot. Pending lobby leaves are
+        # left out: their callbacks belong to the leader until this runtime takes over.
+        for context, book in self.books.items():
+            path = self._snapshot_file(context)
+            try:
+                modified = os.stat(path).st_mtime_ns
+                if loaded.get(context) == modified:
+                    continue
+                state = snapshot.read_snapshot(path)
+            except FileNotFoundError:
+                continue
+            except (OSError, snapshot.SnapshotError) as e:
+                print(f" ! Standby could not read '{path}': {e}")
+                continue
+            if state is None:
+                continue
+            book.restore_state(dict(state, pending_lobby_leaves={}))
+            loaded[context] = modified
+            self._publish(context)
+
+    def _load_leader_snapshot(self, context: str, book: MatchBook) -> None:
+        # A snapshot that cannot be loaded must not keep the leader from starting: start this
+        # book cold and move the file aside, so the next snapshot does not overwrite the evidence.
+        path = self._snapshot_file(context)
+        try:
+            book.load_snapshot(path)
+        except (OSError, ValueError) as e:  # SnapshotError is a ValueError.
+            book.clear()
+            print(f" ! Could not load snapshot '{path}', starting {context} cold: {e}")
+            try:
+                os.replace(path, f"{path}.corrupt")
+            except OSError as move_error:
+                print(f" ! Could not move '{path}' aside: {move_error}")
+
+    def _snapshot_file(self, context: str) -> str:
+        return f"{self.snapshot_path}/{context}.snapshot"
+
+    ## ---------------------------- Event handling (runtime thread) ---------------------------- ##
+    def _handle_event(self, event) -> None:
+        try:
+            # First access parses a lazily decoded event, so a malformed body surfaces here.
+            if not isinstance(event, dict) or not event:
+                return
+        except codec.DecodeError as e:
+            print(f" ! Skipping malformed lobby event: {e}")
+            return
+        self._events += 1
+        self._last_event_at = time.time()
+        response_type = lobby.get_response_type(event)
+        if response_type == "player_status":
+            update = extract_player_status_update(event)
+            if update is not None:
+                MatchBook.resolve_pending_lobby_leave_from_player_status(*update)
+            return
+        context = response_type.split("_")[0]
+        book = self.books.get(context)
+        if book is None:
+            return
+        book.update(event)
+        self._schedule_publish(context)
+
+    def _schedule_publish(self, context: str) -> None:
+        if not self.publish_interval or self._loop is None:
+            self._publish(context)
+        elif context not in self._publish_pending:
+            self._publish_pending.add(context)
+            self._loop.call_later(self.publish_interval, self._publish_scheduled, context)
+
+    def _publish_scheduled(self, context: str) -> None:
+        self._publish_pending.discard(context)
+        self._publish(context)
+
+    def _publish(self, context: str) -> None:
+        previous = self._snapshots[context]
+        # A single reference assignment, atomic under the GIL: readers see either
+        # the previous view or this one, never a partial update.
+        self._snapshots[context] = BookSnapshot(
+            context, tuple(self.books[context]), previous.version + 1, time.time()
+        )
+
+    ## ---------------------------- Thread-safe reads ---------------------------- ##
+    def snapshot(self, context: str = "lobby") -> BookSnapshot:
+        '''Return the latest published view of a context. Lock-free; safe from any thread.'''
+        return self._snapshots[context]
+
+    def call(self, function: Callable, *args, timeout: Optional[float] = 5.0, **kwargs):
+        '''
+        Run function(*args, **kwargs) on the runtime thread between events and return
+        its result. Use for reads that need the MatchBook indexes.
+        '''
+        loop = self._loop
+        if loop is None or not self.is_running():
+            raise RuntimeError("Lobby runtime is not running")
+
+        async def _call():
+            return function(*args, **kwargs)
+
+        return asyncio.run_coroutine_threadsafe(_call(), loop).result(timeout)
+
+    def query(self, context: str = "lobby", timeout: Optional[float] = 5.0, **filters) -> list:
+        '''Run MatchBook.query() on the runtime thread; see MatchBook.query() for filters.'''
+        return self.call(self.books[context].query, timeout=timeout, **filters)
@@ -0,0 +1,89 @@
+"""Compact on-disk snapshots of MatchBook state for warm restarts."""
+
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Optional
+
+from shared import codec
+
+
+# File layout: 4-byte magic, uint16 format version, uint32 CRC32 of the
+# payload, then the zlib-compressed compact JSON payload.
+SNAPSHOT_MAGIC = b"AKMB"
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file is truncated, corrupt, or of an unknown version."""
+
+
+def encode_snapshot(state: dict) -> bytes:
+    '''
+    Serialize a snapshot state dict into the compact binary snapshot format.
+
+    :param state: JSON-serializable state, as returned by MatchBook.snapshot_state().
+    :return: Header plus compressed payload.
+    '''
+    payload = zlib.compress(codec.dumps_bytes(state), 6)
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, zlib.crc32(payload)) + payload
+
+
+def decode_snapshot(blob: bytes) -> dict:
+    '''
+    Parse bytes produced by encode_snapshot().
+
+    :param blob: Raw snapshot file contents.
+    :return: The state dict stored in the snapshot.
+    '''
+    if len(blob) < _HEADER.size:
+        raise SnapshotError("Snapshot is truncated")
+    magic, version, checksum = _HEADER.unpack_from(blob)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError("Not a MatchBook snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {version}")
+    payload = blob[_HEADER.size:]
+    if zlib.crc32(payload) != checksum:
+        raise SnapshotError("Snapshot checksum mismatch")
+    try:
+        return codec.loads(zlib.decompress(payload))
+    except (zlib.error, codec.DecodeError) as e:
+        raise SnapshotError(f"Snapshot payload is corrupt: {e}") from e
+
+
+def write_snapshot(path, state: dict) -> int:
+    '''
+    Atomically write a snapshot to disk. The file is written next to the target and
+    renamed into place, so readers never observe a partially written snapshot.
+
+    :return: Number of bytes written.
+    '''
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    blob = encode_snapshot(state)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(blob)
+
+
+def read_snapshot(path) -> Optional[dict]:
+    '''
+    Read a snapshot from disk.
+
+    :return: The stored state, or None if the file does not exist.
+    :raises SnapshotError: If the file is truncated, corrupt, or of an unknown version.
+    :raises OSError: If the file exists but cannot be read.
+    '''
+    try:
+        with open(path, "rb") as f:
+            blob = f.read()
+    except FileNotFoundError:
+        return None
+    return decode_snapshot(blob)
@@ -1,5 +1,8 @@
 """Small shared helpers for parsing lobby event payloads."""
 
+from lobby.records import MatchRecord
+
+
 def extract_player_status_update(event):
     """Extract (player_id, status, match_id) from a player_status event payload."""
     player_status = event.get("player_status", {})
@@ -12,3 +15,16 @@ def extract_player_status_update(event):
     status = player_state.get("status")
     match_id = player_state.get("matchid")
     return player_id, status, match_id
+
+
+def iter_slots(match):
+    """Yield the player slots of a match, whether it is a raw dict or a MatchRecord."""
+    if isinstance(match, MatchRecord):
+        yield from match.slots
+        return
+    slots = match.get("slots", {})
+    if not isinstance(slots, dict):
+        return
+    for slot in slots.values():
+        if isinstance(slot, dict):
+            yield slot
@@ -0,0 +1,154 @@
+"""Watchlist matcher that turns lobby and spectate events into per-player transitions."""
+
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional
+
+from lobby import lobby
+from lobby.utils import iter_slots
+
+
+# Transition kinds per context: (player appeared, player disappeared).
+TRANSITIONS = {
+    "lobby": ("enter", "leave"),
+    "spectate": ("start", "end"),
+}
+
+
+@dataclass(frozen=True)
+class WatchEvent:
+    kind: str           # "enter"/"leave" for lobbies, "start"/"end" for spectate games.
+    profile_id: str
+    context: str
+    match_id: str
+    match: Any          # The match as last seen; for removals, its version before it was removed.
+
+
+class Watchlist:
+    '''
+    Matches lobby/spectate events against a large set of watched profile IDs.
+
+    Cost per event depends only on the matches in that event: each of their slots
+    is checked with one hashed set lookup, and the previous state of a match is
+    kept only while it contains a watched player. Watchlist size does not affect
+    per-event cost. Transitions caused by a removal carry the last version of the
+    match seen before it was removed.
+    '''
+
+    def __init__(
+        self,
+        profile_ids: Iterable = (),
+        on_transition: Optional[Callable[[WatchEvent], None]] = None,
+    ):
+        self._watched: set[str] = {str(profile_id) for profile_id in profile_ids}
+        self.on_transition = on_transition
+        # (context, match_id) -> (watched profile IDs currently in that match, last seen version of the match).
+        self._present: dict[tuple[str, str], tuple[frozenset, Any]] = {}
+        self.stats = {"events": 0, "slots_checked": 0, "transitions": 0}
+
+    def __len__(self):
+        return len(self._watched)
+
+    def __contains__(self, profile_id):
+        return str(profile_id) in self._watched
+
+    def add(self, profile_ids: Iterable) -> None:
+        self._watched.update(str(profile_id) for profile_id in profile_ids)
+
+    def remove(self, profile_ids: Iterable) -> None:
+        '''Stop watching profile IDs. No transitions are emitted for them, including leaves from matches they are in now.'''
+        removed = {str(profile_id) for profile_id in profile_ids}
+        self._watched.difference_update(removed)
+        for key, (present, match) in list(self._present.items()):
+            if present & removed:
+                remaining = present - removed
+                if remaining:
+                    self._present[key] = (remaining, match)
+                else:
+                    del self._present[key]
+
+    def add_from_leaderboard(self, response: dict) -> int:
+        '''
+        Watch every player on a leaderboard page, as returned by aoe2api.fetch_leaderboard().
+
+        :return: Number of profile IDs added.
+        '''
+        items = (response.get("content") or {}).get("items") or []
+        profile_ids = [item.get("rlUserId") for item in items if item.get("rlUserId") is not None]
+        self.add(profile_ids)
+        return len(profile_ids)
+
+    def _watched_in(self, match) -> frozenset:
+        watched = self._watched
+        found = []
+        slots_checked = 0
+        for slot in iter_slots(match):
+            slots_checked += 1
+            profile_id = slot.get("profileid")
+            if profile_id is not None and str(profile_id) in watched:
+                found.append(str(profile_id))
+        self.stats["slots_checked"] += slots_checked
+        return frozenset(found)
+
+    def _transition(self, context: str, match_id: str, match, before: frozenset, after: frozenset, out: list):
+        appeared, disappeared = TRANSITIONS.get(context, ("enter", "leave"))
+        for profile_id in after - before:
+            out.append(WatchEvent(appeared, profile_id, context, match_id, match))
+        for profile_id in before - after:
+            out.append(WatchEvent(disappeared, profile_id, context, match_id, match))
+        key = (context, match_id)
+        if after:
+            self._present[key] = (after, match)
+        else:
+            self._present.pop(key, None)
+
+    def process(self, event) -> list[WatchEvent]:
+        '''
+        Match one upstream lobby/spectate event against the watchlist.
+
+        :param event: Event dict as yielded by the lobby stream, e.g. {"lobby_update": {...}, "lobby_remove": [...]}.
+        :return: Transitions caused by this event, also passed to on_transition if set.
+        '''
+        if not isinstance(event, dict):
+            return []
+        # Lazily decoded events expose their type unparsed, so events of other kinds are never parsed here.
+        if getattr(event, "first_key", None) is None and not event:
+            return []
+        response_type = lobby.get_response_type(event)
+        context = response_type.split("_")[0]
+        if context not in TRANSITIONS:
+            return []
+        self.stats["events"] += 1
+        transitions = []
+
+        updated = event.get(response_type)
+        if isinstance(updated, dict):
+            for match_id, match in updated.items():
+                if not isinstance(match, dict):
+                    continue
+                match_id = str(match.get("matchid", match_id))
+                before = self._present.get((context, match_id), (frozenset(), None))[0]
+                after = self._watched_in(match)
+                if before or after:
+                    self._transition(context, match_id, match, before, after, transitions)
+
+        # Removals follow MatchBook.remove_matches: match IDs under the second key.
+        event_types = list(event.keys())
+        removed = event.get(event_types[1]) if len(event_types) > 1 else None
+        if isinstance(removed, list):
+            for match_id in removed:
+                match_id = str(match_id)
+                present = self._present.get((context, match_id))
+                if present is not None:
+                    before, last_match = present
+                    self._transition(context, match_id, last_match, before, frozenset(), transitions)
+
+        self.stats["transitions"] += len(transitions)
+        if self.on_transition is not None:
+            for transition in transitions:
+                self.on_transition(transition)
+        return transitions
+
+    def whereabouts(self, profile_id) -> list[tuple[str, str]]:
+        '''Return (context, match_id) pairs the player is currently seen in.'''
+        profile_id = str(profile_id)
+        return [key for key, (present, _) in self._present.items() if profile_id in present]
@@ -0,0 +1,358 @@
+"""Player-driven replay harvesting: follow a set of players instead of scanning match ID ranges."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2api import aoe2api
+from shared import process_guard, profiling
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import heapq
+import re
+import threading
+import time
+
+defaults = {
+    "destination_folder": aoe2api.defaults["destination_folder"],
+    "match_type": 3,
+    "region": 7,
+    "leaderboard_pages": 0,         # Leaderboard pages of 100 players to follow, e.g. 5 for the top 500.
+    "leaderboard_count": 100,
+    "request_interval": 2,          # Delay between match list polls in seconds.
+    "min_poll_interval": 600,       # Most frequent poll of a player who plays constantly (seconds).
+    "max_poll_interval": 6 * 3600,  # Least frequent poll of an inactive player (seconds).
+    "download_workers": 4,
+    "back_off_delay": 20,
+    "back_off_multiplier": 2,
+    "max_back_off_delay": 300,
+    "seen_file": "harvest_seen.txt",  # Match IDs already downloaded or known to have no replay.
+    "missing_retries": 3,           # 404s of a match before it is recorded as having no replay.
+    "missing_max_age": 3600,        # Seconds after a match's first 404 after which it is recorded as having no replay.
+    "unzip_replays": False,
+    "remove_zip": False,
+    "resumable": False,
+}
+
+# Keys the match list has been seen to use for the match ID, in order of preference.
+_MATCH_ID_KEYS = ("matchId", "gameId", "matchid", "id")
+_STORED_REPLAY = re.compile(r"(\d{6,})")
+
+
+def extract_match_ids(response):
+    '''
+    Extracts match IDs from a fetch_player_match_list() response.
+
+    :return: List of match IDs as strings, in the order the API returned them.
+    '''
+    content = response.get("content")
+    if isinstance(content, dict):
+        content = content.get("items") or content.get("matchList") or content.get("matches") or []
+    if not isinstance(content, list):
+        return []
+    match_ids = []
+    for match in content:
+        if not isinstance(match, dict):
+            continue
+        match_id = next((match[key] for key in _MATCH_ID_KEYS if match.get(key) is not None), None)
+        if match_id is not None:
+            match_ids.append(str(match_id))
+    return match_ids
+
+
+def leaderboard_profile_ids(pages=1, count=defaults["leaderboard_count"], region=defaults["region"], match_type=defaults["match_type"], quiet=False):
+    '''Returns the profile IDs on the first `pages` leaderboard pages, e.g. pages=5 for the top 500.'''
+    profile_ids = []
+    for page in range(1, pages + 1):
+        response = aoe2api.fetch_leaderboard(region=str(region), match_type=str(match_type), page=page, count=count, quiet=quiet)
+        items = (response.get("content") or {}).get("items") or []
+        profile_ids.extend(str(item["rlUserId"]) for item in items if item.get("rlUserId") is not None)
+        if len(items) < count:
+            break
+    return profile_ids
+
+
+def stored_match_ids(destination_folder=defaults["destination_folder"], seen_file=defaults["seen_file"]):
+    '''
+    Returns the match IDs that do not need downloading: replays already in the destination folder
+    (zipped or extracted, matched by the match ID in the file name) plus those recorded in the seen file.
+    '''
+    seen = set()
+    if os.path.isdir(destination_folder):
+        for name in os.listdir(destination_folder):
+            if name.endswith((".part", ".tmp")):
+                continue
+            found = _STORED_REPLAY.search(name)
+            if found:
+                seen.add(found.group(1))
+    try:
+        with open(seen_file, "r") as f:
+            seen.update(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        pass
+    return seen
+
+
+class PlayerSchedule:
+    '''
+    Decides when each player's match list is polled next.
+
+    The match list only holds a player's 10 most recent matches, so a poll that finds
+    many new matches means the player is busy and risks matches scrolling out of the
+    list unseen. Each poll adjusts the player's interval by how many of the matches
+    were new: all new halves it, none new doubles it, within [min_interval, max_interval].
+    '''
+
+    def __init__(self, profile_ids, min_interval=defaults["min_poll_interval"], max_interval=defaults["max_poll_interval"]):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.intervals = {}
+        self._heap = []
+        now = time.monotonic()
+        for profile_id in profile_ids:
+            self.add(profile_id, now)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, profile_id, due=None):
+        profile_id = str(profile_id)
+        if profile_id in self.intervals:
+            return
+        self.intervals[profile_id] = self.min_interval
+        heapq.heappush(self._heap, (time.monotonic() if due is None else due, profile_id))
+
+    def next_due(self):
+        '''Returns (due time, profile ID) of the next player to poll, or None if no players are scheduled.'''
+        return self._heap[0] if self._heap else None
+
+    def pop(self):
+        return heapq.heappop(self._heap)[1]
+
+    def retry(self, profile_id, delay=0.0):
+        '''Puts a popped player back without changing their interval, e.g. after a failed poll.'''
+        heapq.heappush(self._heap, (time.monotonic() + delay, profile_id))
+
+    def reschedule(self, profile_id, new_matches, listed_matches):
+        interval = self.intervals[profile_id]
+        if listed_matches and new_matches >= listed_matches:
+            interval /= 2
+        elif new_matches == 0:
+            interval *= 2
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[profile_id] = interval
+        heapq.heappush(self._heap, (time.monotonic() + interval, profile_id))
+        return interval
+
+
+def _record_seen(match_id, seen_file):
+    with open(seen_file, "a") as f:
+        f.write(f"{match_id}\n")
+
+
+def harvest_replays(
+    profile_ids=(),
+    leaderboard_pages=defaults["leaderboard_pages"],
+    region=defaults["region"],
+    match_type=defaults["match_type"],
+    destination_folder=defaults["destination_folder"],
+    request_interval=defaults["request_interval"],
+    min_poll_interval=defaults["min_poll_interval"],
+    max_poll_interval=defaults["max_poll_interval"],
+    download_workers=defaults["download_workers"],
+    back_off_delay=defaults["back_off_delay"],
+    back_off_multiplier=defaults["back_off_multiplier"],
+    max_back_off_delay=defaults["max_back_off_delay"],
+    seen_file=defaults["seen_file"],
+    missing_retries=defaults["missing_retries"],
+    missing_max_age=defaults["missing_max_age"],
+    unzip=defaults["unzip_replays"],
+    remove_zip=defaults["remove_zip"],
+    resumable=defaults["resumable"],
+    once=False,
+    duration=None,
+    quiet=False,
+):
+    '''
+    Downloads the replays of a set of players by polling their match lists.
+
+    Players come from profile_ids and/or the first leaderboard_pages leaderboard pages. Match IDs from all
+    match lists are deduplicated against each other and against replays already stored (see stored_match_ids()),
+    and the rest are downloaded concurrently with download_replay(). Players are polled on a PlayerSchedule,
+    so active players are polled more often than inactive ones.
+
+    A replay can 404 for a while after its match is listed, so a 404 is only written to the seen file after
+    missing_retries of them, or missing_max_age seconds after the first. Until then the match is retried the
+    next time a match list shows it.
+
+    :param once: Poll every player once, wait for the downloads, and return.
+    :param duration: Stop after this many seconds. Runs until interrupted if neither once nor duration is set.
+    :return: Dict of counters: "polls", "discovered", "skipped", "downloaded", "missing" (recorded as having no
+             replay), "unavailable" (404s left to retry), "failed".
+    '''
+    profile_ids = [str(profile_id) for profile_id in profile_ids]
+    if leaderboard_pages:
+        profile_ids += leaderboard_profile_ids(pages=leaderboard_pages, region=region, match_type=match_type, quiet=quiet)
+    schedule = PlayerSchedule(profile_ids, min_interval=min_poll_interval, max_interval=max_poll_interval)
+    seen = stored_match_ids(destination_folder, seen_file)
+    counters = {"polls": 0, "discovered": 0, "skipped": 0, "downloaded": 0, "missing": 0, "unavailable": 0, "failed": 0}
+    # match_id -> [404s so far, monotonic time of the first], for matches not yet recorded as missing.
+    not_found = {}
+    if not quiet:
+        print(f"Harvesting replays for {len(schedule)} players ({len(seen)} matches already stored).")
+
+    def download(profile_id, match_id):
+        try:
+            result = aoe2api.download_replay(
+                profile_id=profile_id,
+                match_id=match_id,
+                destination_folder=destination_folder,
+                unzip=unzip,
+                remove_zip=remove_zip,
+                quiet=quiet,
+                resumable=resumable,
+            )
+        except Exception as e:
+            print(f" ! Failed to download replay {match_id}: {e!r}")
+            return match_id, 0
+        return match_id, result["status_code"]
+
+    collect_lock = threading.Lock()
+
+    def collect(future):
+        match_id, status_code = future.result()
+        with collect_lock:
+            _collect(match_id, status_code)
+
+    def _collect(match_id, status_code):
+        if status_code == 200:
+            counters["downloaded"] += 1
+            not_found.pop(match_id, None)
+        elif status_code == 404:
+            attempts = not_found.setdefault(match_id, [0, time.monotonic()])
+            attempts[0] += 1
+            if attempts[0] < missing_retries and time.monotonic() - attempts[1] < missing_max_age:
+                # Forget the match so the next match list that shows it retries the download.
+                counters["unavailable"] += 1
+                seen.discard(match_id)
+                return
+            counters["missing"] += 1
+            del not_found[match_id]
+        else:
+            # Forget the match so a later poll that lists it again retries the download.
+            counters["failed"] += 1
+            seen.discard(match_id)
+            return
+        _record_seen(match_id, seen_file)
+
+    deadline = None if duration is None else time.monotonic() + duration
+    current_back_off_delay = back_off_delay
+    polled_once = set()
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        try:
+            while schedule.next_due() is not None:
+                due, profile_id = schedule.next_due()
+                if once and profile_id in polled_once:
+                    break
+                now = time.monotonic()
+                if deadline is not None and max(now, due) >= deadline:
+                    break
+                if due > now:
+                    time.sleep(due - now)
+                schedule.pop()
+
+                response = aoe2api.fetch_player_match_list(profile_id=profile_id, match_type=match_type, quiet=True)
+                counters["polls"] += 1
+                if response["status_code"] != 200:
+                    print(f" ! BACK OFF, EH! Error {response['status_code']}: {response['message']}. Backing off for {current_back_off_delay}s.")
+                    schedule.retry(profile_id)
+                    time.sleep(current_back_off_delay)
+                    current_back_off_delay = min(current_back_off_delay * back_off_multiplier, max_back_off_delay)
+                    continue
+                current_back_off_delay = back_off_delay
+                polled_once.add(profile_id)
+
+                match_ids = extract_match_ids(response)
+                new_match_ids = [match_id for match_id in match_ids if match_id not in seen]
+                counters["discovered"] += len(new_match_ids)
+                counters["skipped"] += len(match_ids) - len(new_match_ids)
+                for match_id in new_match_ids:
+                    seen.add(match_id)
+                    executor.submit(download, profile_id, match_id).add_done_callback(collect)
+                interval = schedule.reschedule(profile_id, len(new_match_ids), len(match_ids))
+                if not quiet:
+                    print(f" * Player {profile_id}: {len(new_match_ids)}/{len(match_ids)} new matches; next poll in {interval:.0f}s.")
+                time.sleep(request_interval)
+        except KeyboardInterrupt:
+            print("Stopping harvest; waiting for running downloads to finish.")
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    if not quiet:
+        print(f"Harvest finished: {counters}")
+    return counters
+
+
+def main(args):
+    # Kept referenced for the whole run: the lock is released when the election is garbage collected.
+    election = process_guard.lead_or_stand_by(args.leader_lock, quiet=args.quiet) if args.leader_lock else None
+    # Queued behind interactive lookups when requests go through the broker.
+    aoe2api.defaults["broker_priority"] = "bulk"
+    harvest_replays(
+        profile_ids=args.profile_ids,
+        leaderboard_pages=args.leaderboard_pages,
+        region=args.region,
+        match_type=args.match_type,
+        destination_folder=args.output,
+        request_interval=args.request_interval,
+        min_poll_interval=args.min_poll_interval,
+        max_poll_interval=args.max_poll_interval,
+        download_workers=args.workers,
+        back_off_delay=args.back_off_delay,
+        back_off_multiplier=args.back_off_multiplier,
+        max_back_off_delay=args.max_back_off_delay,
+        seen_file=args.seen_file,
+        missing_retries=args.missing_retries,
+        missing_max_age=args.missing_max_age,
+        unzip=args.unzip,
+        remove_zip=args.remove_zip,
+        resumable=args.resumable,
+        once=args.once,
+        duration=args.duration,
+        quiet=args.quiet,
+    )
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Download the replays of selected players by following their match lists.")
+    parser.add_argument("-p", "--profile-ids", type=str, nargs="*", default=[], help="Profile IDs to follow")
+    parser.add_argument("-lb", "--leaderboard-pages", type=int, default=defaults["leaderboard_pages"], help="Also follow the players on the first N leaderboard pages (100 players each)")
+    parser.add_argument("--region", type=int, default=defaults["region"], help="Leaderboard region")
+    parser.add_argument("-mt", "--match-type", type=int, default=defaults["match_type"], help="Match type for the leaderboard and match lists")
+    parser.add_argument("-o", "--output", type=str, default=defaults["destination_folder"], help="Folder where replays are saved")
+    parser.add_argument("-i", "--request-interval", type=float, default=defaults["request_interval"], help="Delay between match list polls in seconds")
+    parser.add_argument("--min-poll-interval", type=float, default=defaults["min_poll_interval"], help="Shortest interval between polls of one player in seconds")
+    parser.add_argument("--max-poll-interval", type=float, default=defaults["max_poll_interval"], help="Longest interval between polls of one player in seconds")
+    parser.add_argument("-w", "--workers", type=int, default=defaults["download_workers"], help="Concurrent replay downloads")
+    parser.add_argument("-bd", "--back-off-delay", type=int, default=defaults["back_off_delay"], help="Base delay (seconds) when rate limited")
+    parser.add_argument("-bm", "--back-off-multiplier", type=int, default=defaults["back_off_multiplier"], help="Exponential backoff multiplier per rate limit hit")
+    parser.add_argument("-bmax", "--max-back-off-delay", type=int, default=defaults["max_back_off_delay"], help="Max backoff delay (seconds) when rate limited")
+    parser.add_argument("-sf", "--seen-file", type=str, default=defaults["seen_file"], help="File recording match IDs already handled")
+    parser.add_argument("--missing-retries", type=int, default=defaults["missing_retries"], help="404s of a match before it is recorded as having no replay")
+    parser.add_argument("--missing-max-age", type=float, default=defaults["missing_max_age"], help="Seconds after a match's first 404 after which it is recorded as having no replay")
+    parser.add_argument("-u", "--unzip", action="store_true", help="Unzip downloaded replays")
+    parser.add_argument("-rm", "--remove_zip", action="store_true", help="Remove zip files after unzipping")
+    parser.add_argument("--resumable", action="store_true", help="Stream replays to disk, resume interrupted downloads, and verify each ZIP")
+    parser.add_argument("--once", action="store_true", help="Poll every player once, then exit")
+    parser.add_argument("--duration", type=float, default=None, help="Stop after this many seconds")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print errors")
+    parser.add_argument("--leader-lock", type=str, default=None, help="Only run while leading this election name; otherwise stand by and take over when the leader exits")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "player_harvester"):
+        main(args)
@@ -0,0 +1,429 @@
+"""Header metadata index over a folder of downloaded replays, built on a process pool."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scraper import replay_store
+from shared import profiling
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import io
+import json
+import re
+import sqlite3
+import struct
+import zipfile
+import zlib
+
+defaults = {
+    "destination_folder": "replays",
+    "database": "replay_index.sqlite",
+    "workers": None,            # Worker processes. None uses the CPU count.
+    "chunksize": 16,            # Replays handed to a worker at a time.
+    "batch_size": 500,          # Parsed replays written per SQLite transaction.
+    "duration": True,           # Scan the body's sync operations for the game duration.
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replays (
+    file TEXT PRIMARY KEY,
+    match_id TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    game_version TEXT,
+    save_version REAL,
+    build INTEGER,
+    played_at INTEGER,
+    map_id INTEGER,
+    map_name TEXT,
+    duration_ms INTEGER,
+    num_players INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS players (
+    file TEXT NOT NULL REFERENCES replays(file) ON DELETE CASCADE,
+    number INTEGER,
+    profile_id INTEGER,
+    name TEXT,
+    civ_id INTEGER,
+    civ_name TEXT,
+    team_id INTEGER,
+    color_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS replays_match_id ON replays(match_id);
+CREATE INDEX IF NOT EXISTS replays_map_name ON replays(map_name);
+CREATE INDEX IF NOT EXISTS replays_build ON replays(build);
+CREATE INDEX IF NOT EXISTS players_file ON players(file);
+CREATE INDEX IF NOT EXISTS players_civ_name ON players(civ_name);
+CREATE INDEX IF NOT EXISTS players_profile_id ON players(profile_id);
+"""
+
+_REPLAY_SUFFIXES = (".zip", ".aoe2record", replay_store.SUFFIX)
+_MATCH_ID = re.compile(r"(\d{6,})")
+_DE_STRING_MARKER = b"\x60\x0a"
+_MAX_PLAYERS = 8
+_SYNC_VALUES = _MAX_PLAYERS * 11
+
+_game_data = None
+
+
+class ReplayParseError(ValueError):
+    pass
+
+
+## ---------------------------- Header parsing ---------------------------- ##
+def _load_game_data():
+    global _game_data
+    if _game_data is None:
+        dataset_path = Path(__file__).resolve().parent.parent / "datasets" / "100.json"
+        with dataset_path.open("r", encoding="utf-8") as f:
+            _game_data = json.load(f)
+    return _game_data
+
+def _unpack(fmt, stream):
+    size = struct.calcsize(fmt)
+    data = stream.read(size)
+    if len(data) != size:
+        raise ReplayParseError("Unexpected end of recording")
+    return struct.unpack(fmt, data)
+
+def _skip(stream, count):
+    if count:
+        stream.seek(count, io.SEEK_CUR)
+
+def _de_string(stream):
+    if stream.read(2) != _DE_STRING_MARKER:
+        raise ReplayParseError("Expected a DE string")
+    length, = _unpack("<h", stream)
+    return stream.read(length).decode("utf-8", errors="replace")
+
+def _read_version(header):
+    game_version, save_version = _unpack("<7sxf", header)
+    if save_version == -1:
+        save_version, = _unpack("<I", header)
+        save_version = 37.0 if save_version == 37 else save_version / (1 << 16)
+    return game_version.decode("ascii", errors="replace"), round(save_version, 2)
+
+def _read_de_header(header, save):
+    '''Reads the DE game settings and player slots, which start right after the version fields.'''
+    build = _unpack("<I", header)[0] if save >= 25.22 else None
+    timestamp = _unpack("<I", header)[0] if save >= 26.16 else None
+    _skip(header, 12)
+    dlc_count, = _unpack("<I", header)
+    _skip(header, 4 * dlc_count + 4 + 4 + 4)   # DLC IDs, dataset, difficulty/map dimension, selected map
+    map_id, = _unpack("<I", header)
+    _skip(header, 4 + 16 + 12 + 12)             # reveal map, victory/resources/starting/ending age, game type, speed/treaty/pop
+    num_players, = _unpack("<I", header)
+    _skip(header, 14 + (1 if save >= 61.5 else 0) + 2 + 1 + 10 + 12)
+    if save >= 25.06:
+        _skip(header, 1)
+    if save > 50:
+        _skip(header, 1)
+
+    players = []
+    for _ in range(num_players if 66.3 > save >= 37 else _MAX_PLAYERS):
+        _skip(header, 4)
+        color_id, = _unpack("<i", header)
+        _skip(header, 2)
+        team_id, = _unpack("<b", header)
+        _skip(header, 9)
+        civ_id, = _unpack("<I", header)
+        if save >= 61.5:
+            custom_civ_count, = _unpack("<I", header)
+            if save >= 63.0:
+                _skip(header, 4 * custom_civ_count)
+        _de_string(header)                      # AI type
+        _skip(header, 1)
+        _de_string(header)                      # AI name
+        if save >= 66.3:
+            _de_string(header)                  # Censored name
+        name = _de_string(header)
+        _skip(header, 4)                        # Player type
+        profile_id, number = _unpack("<I4xi", header)
+        _skip(header, (8 if save < 25.22 else 0) + 2 + (8 if save >= 25.06 else 0) + (4 if save >= 64.3 else 0))
+        # Unused slots (always 8 are stored on some versions) have no name.
+        if name:
+            players.append({
+                "number": number,
+                "profile_id": profile_id or None,
+                "name": name,
+                "civ_id": civ_id,
+                "team_id": team_id,
+                "color_id": color_id,
+            })
+    return build, timestamp, map_id, players
+
+def _read_duration(body):
+    '''Sums the time increments of the body's sync operations, skipping over everything else unparsed.'''
+    first, = _unpack("<I", body)               # Log version; anything but 500 is followed by 4 more bytes.
+    _skip(body, (0 if first == 500 else 4) + 20)
+    a, b, _ = _unpack("<III", body)
+    if a != 0:
+        _skip(body, -12)
+    if b == 2:
+        _skip(body, -8)
+
+    duration = 0
+    while True:
+        op = body.read(4)
+        if len(op) < 4:
+            return duration
+        op_type, = struct.unpack("<I", op)
+        if op_type == 1:                        # Action: length, payload, sequence
+            length, = _unpack("<I", body)
+            action_id = body.read(1)
+            if action_id == b"\xff":            # Postgame data runs to the end of the file.
+                return duration
+            _skip(body, length - 1 + 4)
+        elif op_type == 2:                      # Sync: increment, then an optional checksum block
+            increment, marker = _unpack("<II", body)
+            duration += increment
+            if marker:
+                _skip(body, -4)
+                continue
+            _, is_de = _unpack("<4xI4xI", body)
+            if is_de:
+                _skip(body, -16 + 4 * _SYNC_VALUES + 4)
+            else:
+                _skip(body, 8)
+        elif op_type == 3:                      # Viewlock
+            _skip(body, 12)
+        elif op_type == 4:                      # Chat
+            _, length = _unpack("<II", body)
+            _skip(body, length)
+        else:                                   # Postgame or saved chapter: no more game time follows.
+            return duration
+
+def _split_recording(recording, duration):
+    '''Returns the compressed header and, when the duration is wanted, the body as a stream.'''
+    header_length, _ = _unpack("<II", recording)
+    compressed_header = recording.read(header_length - 8)
+    body = io.BytesIO(recording.read()) if duration else None
+    return compressed_header, body
+
+def _read_recording(path, duration):
+    if str(path).endswith(replay_store.SUFFIX):
+        # Recompressed replays have to be decoded whole; ZIPs and raw files are read only as far as needed.
+        return _split_recording(io.BytesIO(replay_store.read_recording(path)[1]), duration)
+    with open(path, "rb") as f:
+        if not zipfile.is_zipfile(f):
+            f.seek(0)
+            return _split_recording(f, duration)
+        with zipfile.ZipFile(f) as zip_ref:
+            members = [info for info in zip_ref.infolist() if not info.is_dir()]
+            if not members:
+                raise ReplayParseError("Archive is empty")
+            with zip_ref.open(members[0]) as recording:
+                return _split_recording(recording, duration)
+
+def parse_replay_header(path, duration=defaults["duration"]):
+    '''
+    Parses the metadata of a recorded game: version, map, and players with their civilizations.
+    Only the compressed header is inflated. With duration=True the uncompressed body is also walked
+    operation by operation (payloads are skipped, not parsed) to total the game time.
+
+    Supports Definitive Edition recordings as raw .aoe2record files, replay ZIPs saved by
+    aoe2api.download_replay(), or .aoe2z files written by replay_store.
+
+    :return: Dict with game_version, save_version, build, played_at (UNIX time), map_id, map_name,
+        duration_ms, and players (number, profile_id, name, civ_id, civ_name, team_id, color_id).
+    '''
+    compressed_header, body = _read_recording(path, duration)
+
+    try:
+        header = io.BytesIO(zlib.decompress(compressed_header, wbits=-15))
+    except zlib.error as e:
+        raise ReplayParseError(f"Could not inflate header: {e}")
+
+    game_version, save_version = _read_version(header)
+    if game_version != "VER 9.4" or save_version < 12.97:
+        raise ReplayParseError(f"Unsupported game version {game_version} ({save_version}); only Definitive Edition is indexed")
+    build, played_at, map_id, players = _read_de_header(header, save_version)
+
+    game_data = _load_game_data()
+    civilizations = game_data.get("civilizations", {})
+    for player in players:
+        civ = civilizations.get(str(player["civ_id"]))
+        player["civ_name"] = civ.get("name") if civ else None
+
+    return {
+        "game_version": game_version,
+        "save_version": save_version,
+        "build": build,
+        "played_at": played_at,
+        "map_id": map_id,
+        "map_name": game_data.get("maps", {}).get(str(map_id)),
+        "duration_ms": _read_duration(body) if duration else None,
+        "players": players,
+    }
+
+def _index_one(job):
+    path, duration = job
+    try:
+        return path, parse_replay_header(path, duration=duration), None
+    # zlib.error covers corrupt deflate streams in ZIP members; ValueError covers offsets that point outside the data.
+    except (ReplayParseError, replay_store.ReplayStoreError, struct.error, zipfile.BadZipFile, zlib.error, OSError, EOFError, ValueError) as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+## ---------------------------- Index ---------------------------- ##
+def open_index(database=defaults["database"]):
+    connection = sqlite3.connect(database)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+def _match_id(file_name):
+    found = _MATCH_ID.search(file_name)
+    return found.group(1) if found else None
+
+def _write_rows(connection, rows):
+    with connection:
+        connection.executemany("DELETE FROM players WHERE file = ?", [(row[0],) for row in rows])
+        connection.executemany("INSERT OR REPLACE INTO replays VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [row[:13] for row in rows])
+        connection.executemany(
+            "INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [player for row in rows for player in row[13]],
+        )
+
+def _to_row(file_name, stat, parsed, error):
+    if parsed is None:
+        return (file_name, _match_id(file_name), stat.st_size, stat.st_mtime_ns) + (None,) * 8 + (error, [])
+    players = [
+        (file_name, p["number"], p["profile_id"], p["name"], p["civ_id"], p["civ_name"], p["team_id"], p["color_id"])
+        for p in parsed["players"]
+    ]
+    return (
+        file_name, _match_id(file_name), stat.st_size, stat.st_mtime_ns,
+        parsed["game_version"], parsed["save_version"], parsed["build"], parsed["played_at"],
+        parsed["map_id"], parsed["map_name"], parsed["duration_ms"], len(players), None, players,
+    )
+
+def build_index(
+    destination_folder=defaults["destination_folder"],
+    database=defaults["database"],
+    workers=defaults["workers"],
+    duration=defaults["duration"],
+    quiet=False,
+):
+    '''
+    Indexes every replay in destination_folder into a SQLite database, parsing headers on a process pool.
+
+    The index is incremental: a file is parsed again only if it is new or its size or modification time
+    changed, and rows of files no longer in the folder are dropped. Files that fail to parse are stored
+    with their error so they are not retried until they change.
+
+    :return: Dict with "indexed", "unchanged", "failed", and "removed" counts.
+    '''
+    connection = open_index(database)
+    known = {file: (size, mtime_ns) for file, size, mtime_ns in connection.execute("SELECT file, size, mtime_ns FROM replays")}
+    stats = {}
+    if os.path.isdir(destination_folder):
+        with os.scandir(destination_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(_REPLAY_SUFFIXES):
+                    stats[entry.name] = entry.stat()
+
+    pending = [name for name, stat in stats.items() if known.get(name) != (stat.st_size, stat.st_mtime_ns)]
+    removed = [(name,) for name in known if name not in stats]
+    if removed:
+        with connection:
+            connection.executemany("DELETE FROM replays WHERE file = ?", removed)
+
+    counts = {"indexed": 0, "unchanged": len(stats) - len(pending), "failed": 0, "removed": len(removed)}
+    if not quiet:
+        print(f"Indexing {len(pending)} new or changed replays ({counts['unchanged']} unchanged).")
+    jobs = [(os.path.join(destination_folder, name), duration) for name in pending]
+    rows = []
+    try:
+        with profiling.span("index"), ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, parsed, error in executor.map(_index_one, jobs, chunksize=defaults["chunksize"]):
+                file_name = os.path.basename(path)
+                rows.append(_to_row(file_name, stats[file_name], parsed, error))
+                if error is None:
+                    counts["indexed"] += 1
+                else:
+                    counts["failed"] += 1
+                    if not quiet:
+                        print(f" ! {path}: {error}")
+                if len(rows) >= defaults["batch_size"]:
+                    _write_rows(connection, rows)
+                    rows = []
+    finally:
+        # Keep the replays parsed so far even if the pool run is aborted; the rest are retried next run.
+        if rows:
+            _write_rows(connection, rows)
+        connection.close()
+    if not quiet:
+        print(f"Index updated: {counts}")
+    return counts
+
+def query_index(database=defaults["database"], civ_name=None, map_name=None, build=None, profile_id=None):
+    '''
+    Returns the replays matching every given filter, newest first, as dicts of the replays table columns.
+
+    :param civ_name: Civilization any player in the game played, e.g. "Mongols".
+    :param map_name: Map name as in datasets/100.json, e.g. "Arabia".
+    :param build: Game build number (patch).
+    :param profile_id: Profile ID of any player in the game.
+    '''
+    clauses, params = ["error IS NULL"], []
+    if map_name is not None:
+        clauses.append("map_name = ?")
+        params.append(map_name)
+    if build is not None:
+        clauses.append("build = ?")
+        params.append(build)
+    if civ_name is not None:
+        clauses.append("file IN (SELECT file FROM players WHERE civ_name = ?)")
+        params.append(civ_name)
+    if profile_id is not None:
+        clauses.append("file IN (SELECT file FROM players WHERE profile_id = ?)")
+        params.append(profile_id)
+    connection = open_index(database)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(f"SELECT * FROM replays WHERE {' AND '.join(clauses)} ORDER BY played_at DESC", params).fetchall()
+    finally:
+        connection.close()
+    return [dict(row) for row in rows]
+
+
+def main(args):
+    if args.civ or args.map or args.build or args.profile_id:
+        for row in query_index(args.database, civ_name=args.civ, map_name=args.map, build=args.build, profile_id=args.profile_id):
+            print(f"{row['match_id'] or row['file']}\t{row['map_name']}\tbuild {row['build']}\t{(row['duration_ms'] or 0) // 1000}s")
+        return
+    build_index(
+        destination_folder=args.folder,
+        database=args.database,
+        workers=args.workers,
+        duration=not args.no_duration,
+        quiet=args.quiet,
+    )
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Index replay header metadata into SQLite, or query the index.")
+    parser.add_argument("-f", "--folder", type=str, default=defaults["destination_folder"], help="Folder containing replay ZIPs or .aoe2record files")
+    parser.add_argument("-d", "--database", type=str, default=defaults["database"], help="SQLite index file")
+    parser.add_argument("-w", "--workers", type=int, default=defaults["workers"], help="Worker processes (default: CPU count)")
+    parser.add_argument("--no-duration", action="store_true", help="Only read the header; leave duration empty")
+    parser.add_argument("--civ", type=str, default=None, help="Query: civilization played by any player")
+    parser.add_argument("--map", type=str, default=None, help="Query: map name")
+    parser.add_argument("--build", type=int, default=None, help="Query: game build")
+    parser.add_argument("--profile-id", type=int, default=None, help="Query: profile ID of any player")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the summary")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "replay_index"):
+        main(args)
@@ -1,6 +1,15 @@
 """Replay scraping workflow for iterating over match IDs and persisting progress."""
 
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from aoe2api import aoe2api
+from shared import process_guard, profiling
 import time
 import argparse
 
@@ -17,6 +26,11 @@ defaults = {
     "scrape_state_file": "scrape_state.txt",
     "resume": False,
     "count_backwards": False,
+    "resumable": False,
+    "frontier_initial_step": 1024,  # First jump above the known match ID when searching for the newest one.
+    "frontier_window": 64,          # IDs around a probe point checked for live matches, to step over 404 gaps.
+    "frontier_samples": 16,         # Probes spread across each window before it is declared empty.
+    "probe_interval": 1,            # Delay between frontier probes in seconds.
 }
 
 def save_scrape_state(current_id, end_id, filename=defaults["scrape_state_file"]):
@@ -33,6 +47,98 @@ def get_last_scrape_state(filename=defaults["scrape_state_file"]):
     except FileNotFoundError:
         return None, None
 
+def _probe_with_backoff(match_id, probe, probe_interval, back_off_delay, back_off_multiplier, max_back_off_delay):
+    current_back_off_delay = back_off_delay
+    while True:
+        status_code = probe(match_id)
+        if probe_interval:
+            time.sleep(probe_interval)
+        if status_code in (200, 404):
+            return status_code == 200
+        print(f" ! BACK OFF, EH! Probe of {match_id} returned {status_code}. Backing off for {current_back_off_delay}s.")
+        time.sleep(current_back_off_delay)
+        current_back_off_delay = min(current_back_off_delay * back_off_multiplier, max_back_off_delay)
+
+def find_newest_match_id(
+    known_id=defaults["start_id"],
+    probe=None,
+    initial_step=defaults["frontier_initial_step"],
+    window=defaults["frontier_window"],
+    samples=defaults["frontier_samples"],
+    probe_interval=defaults["probe_interval"],
+    back_off_delay=defaults["back_off_delay"],
+    back_off_multiplier=defaults["back_off_multiplier"],
+    max_back_off_delay=defaults["max_back_off_delay"],
+    quiet=False,
+):
+    '''
+    Finds the newest match ID with a downloadable replay in a logarithmic number of requests.
+
+    Starting from known_id (an ID at or below the frontier), the step above it doubles until a region without
+    replays is found, then a binary search narrows the boundary down to one window. Because individual IDs are
+    often missing (404), a point counts as live if any of `samples` probes spread across the `window` IDs starting
+    at it has a replay. The last window is searched with the same probe spacing from the top to find the highest
+    sample with a replay; the IDs above it are then probed one by one from the top of the window down, stopping at
+    the first replay, so no replay between samples is missed. Each ID is probed at most once.
+
+    :param probe: Callable taking a match ID and returning an HTTP status code. Defaults to aoe2api.probe_replay.
+    :return: The newest match ID found to have a replay.
+    '''
+    if probe is None:
+        probe = lambda match_id: aoe2api.probe_replay(match_id=match_id, profile_id=1)
+    probes = 0
+    stride = max(window // samples, 1)
+    probed = {}
+
+    def exists(match_id):
+        nonlocal probes
+        if match_id not in probed:
+            probes += 1
+            probed[match_id] = _probe_with_backoff(match_id, probe, probe_interval, back_off_delay, back_off_multiplier, max_back_off_delay)
+        return probed[match_id]
+
+    def live_near(match_id):
+        return any(exists(candidate) for candidate in range(match_id, match_id + window, stride))
+
+    low = known_id
+    if not live_near(low):
+        # The known ID sits in a dead region; walk back until matches show up again.
+        step = initial_step
+        while not live_near(low - step):
+            step *= 2
+        low -= step
+
+    step = initial_step
+    while live_near(low + step):
+        low += step
+        step *= 2
+        if not quiet:
+            print(f" * Frontier is above {low}; probing {low + step} next.")
+    high = low + step
+
+    while high - low > window:
+        middle = (low + high) // 2
+        if live_near(middle):
+            low = middle
+        else:
+            high = middle
+
+    # low is live and high is not, so the newest replay is in [low, high + window). The samples are aligned
+    # with low's, which live_near(low) has already probed.
+    sampled = next(
+        (candidate for candidate in reversed(range(low, high + window, stride)) if exists(candidate)),
+        low,
+    )
+    # Live IDs between the dead samples above it are only found by probing each one. The samples
+    # themselves are already known, so they cost nothing here.
+    newest = next(
+        (candidate for candidate in range(high + window - 1, sampled, -1) if exists(candidate)),
+        sampled,
+    )
+    if not quiet:
+        print(f" * Newest match ID with a replay: {newest} ({probes} probes).")
+    return newest
+
 def scrape_replays(
     resume=defaults["resume"],
     endpoint_name=defaults["endpoint_name"],
@@ -46,6 +152,7 @@ def scrape_replays(
     remove_zip=defaults["remove_zip"],
     scrape_state_file=defaults["scrape_state_file"],
     count_backwards=defaults["count_backwards"],
+    resumable=defaults["resumable"],
 ):
     current_back_off_delay = back_off_delay
     if resume:
@@ -61,9 +168,13 @@ def scrape_replays(
         return current_id > target_id if count_backwards else current_id < target_id
 
     while n >= end_id if count_backwards else n <= end_id:
-        response = aoe2api.fetch_endpoint(endpoint_name=endpoint_name, match_id=n, profile_id=1)
-        aoe2api.save_replay(response, unzip=unzip, remove_zip=remove_zip)
-        if response["status_code"] == 200 or response["status_code"] == 404:
+        if resumable and endpoint_name == "replay":
+            response = aoe2api.download_replay_resumable(profile_id=1, match_id=n, unzip=unzip, remove_zip=remove_zip)
+        else:
+            response = aoe2api.fetch_endpoint(endpoint_name=endpoint_name, match_id=n, profile_id=1)
+            aoe2api.save_replay(response, unzip=unzip, remove_zip=remove_zip)
+        # 422: the replay downloaded but kept failing ZIP verification; retrying it right away won't help.
+        if response["status_code"] in (200, 404, 422):
             current_back_off_delay = back_off_delay  # Reset backoff delay on success or not found
             save_scrape_state(n, end_id, filename=scrape_state_file)
             if has_more(n, end_id):
@@ -79,10 +190,22 @@ def scrape_replays(
             )
 
 def main(args):
+    # Kept referenced for the whole run: the lock is released when the election is garbage collected.
+    election = process_guard.lead_or_stand_by(args.leader_lock) if args.leader_lock else None
+    # Queued behind interactive lookups when requests go through the broker.
+    aoe2api.defaults["broker_priority"] = "bulk"
+    start_id = args.start_id
+    if start_id == "auto":
+        start_id = find_newest_match_id(
+            probe_interval=args.probe_interval,
+            back_off_delay=args.back_off_delay,
+            back_off_multiplier=args.back_off_multiplier,
+            max_back_off_delay=args.max_back_off_delay,
+        )
     scrape_replays(
         resume=args.resume,
         endpoint_name=args.endpoint_name,
-        start_id=args.start_id,
+        start_id=start_id,
         end_id=args.end_id,
         request_interval=args.request_interval,
         back_off_delay=args.back_off_delay,
@@ -92,8 +215,14 @@ def main(args):
         remove_zip=args.remove_zip,
         scrape_state_file=args.scrape_state_file,
         count_backwards=args.count_backwards,
+        resumable=args.resumable,
     )
 
+def _parse_start_id(value):
+    if value == "auto":
+        return value
+    return int(value)
+
 def _build_arg_parser():
     parser = argparse.ArgumentParser(description="Scrape Age of Empires 2 replays from the API.")
     _add_arg_parser_options(parser)
@@ -101,7 +230,7 @@ def _build_arg_parser():
 
 def _add_arg_parser_options(parser):
     parser.add_argument("-r", "--resume", action="store_true", help="Resume from last scrape state")
-    parser.add_argument("-s", "--start_id", type=int, default=defaults["start_id"], help="Starting match ID")
+    parser.add_argument("-s", "--start_id", "--start-id", type=_parse_start_id, default=defaults["start_id"], help="Starting match ID, or 'auto' to start from the newest match with a replay")
     parser.add_argument("-e", "--end_id", type=int, default=defaults["end_id"], help="Ending match ID")
     parser.add_argument("-i", "--request-interval", type=int, default=defaults["request_interval"], help="Delay between requests in seconds")
     parser.add_argument("-bd", "--back-off-delay", type=int, default=defaults["back_off_delay"], help="Base delay (seconds) when rate limited")
@@ -112,6 +241,10 @@ def _add_arg_parser_options(parser):
     parser.add_argument("-u", "--unzip", action="store_true", help="Unzip downloaded replays")
     parser.add_argument("-rm", "--remove_zip", action="store_true", help="Remove zip files after unzipping")
     parser.add_argument("-cb", "--count-backwards", action="store_true", help="Count down from start_id to end_id")
+    parser.add_argument("--probe-interval", type=float, default=defaults["probe_interval"], help="Delay between probes in seconds when using --start_id auto")
+    parser.add_argument("--resumable", action="store_true", help="Stream replays to disk, resume interrupted downloads, and verify each ZIP")
+    parser.add_argument("--leader-lock", type=str, default=None, help="Only run while leading this election name; otherwise stand by and take over when the leader exits")
+    profiling.add_profiling_args(parser)
 
 def _parse_args():
     parser = _build_arg_parser()
@@ -119,4 +252,5 @@ def _parse_args():
 
 if __name__ == "__main__":
     args = _parse_args()
-    main(args)
+    with profiling.profiling_session(args, "replay_scraper"):
+        main(args)
@@ -0,0 +1,328 @@
+"""Dictionary-compressed replay storage: recompress a replay folder and read replays back on the fly."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import profiling
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import random
+import struct
+import time
+import zipfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional: pip install zstandard. zlib with a preset dictionary is used without it.
+    zstandard = None
+
+defaults = {
+    "destination_folder": "replays",
+    "dictionary_folder": "dictionaries",  # Subfolder of the replay folder holding trained dictionaries.
+    "codec": None,                        # "zstd" or "zlib". None picks zstd when zstandard is installed.
+    "sample_count": 200,                  # Replays sampled to train the dictionary.
+    "sample_bytes": 256 * 1024,           # Bytes taken from the start of each sampled replay.
+    "zstd_dictionary_size": 112 * 1024,
+    "zstd_level": 19,
+    "zlib_level": 9,
+    "workers": None,                      # Worker processes. None uses the CPU count.
+    "benchmark_count": 50,                # Recompressed replays decoded to measure read throughput.
+}
+
+SUFFIX = ".aoe2z"
+_MAGIC = b"AKRZ"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHBxIQH")   # magic, version, codec, dictionary id, original size, member name length
+_CODECS = {"zlib": 1, "zstd": 2}
+_CODEC_NAMES = {value: name for name, value in _CODECS.items()}
+_ZLIB_WINDOW = 32 * 1024               # zlib only looks back this far, so longer dictionaries are wasted.
+_ZLIB_GRAM = 32                        # Substring length counted when building a zlib dictionary.
+_ZLIB_STRIDE = 8
+_ZLIB_GRAM_SAMPLING = 4                 # Only grams whose CRC32 is divisible by this are counted (the same ones in every sample).
+_ZLIB_MAX_GRAMS = 1 << 18               # Distinct grams counted before the rarest are pruned.
+
+_dictionaries: dict[tuple[str, int], bytes] = {}
+
+
+class ReplayStoreError(ValueError):
+    pass
+
+
+## ---------------------------- Reading ---------------------------- ##
+def _dictionary_path(folder, codec, dictionary_id):
+    return Path(folder) / defaults["dictionary_folder"] / f"{codec}-{dictionary_id:08x}.dict"
+
+def _load_dictionary(folder, codec, dictionary_id):
+    key = (str(folder), dictionary_id)
+    dictionary = _dictionaries.get(key)
+    if dictionary is None:
+        path = _dictionary_path(folder, codec, dictionary_id)
+        try:
+            dictionary = path.read_bytes()
+        except FileNotFoundError:
+            raise ReplayStoreError(f"Missing compression dictionary '{path}'")
+        if zlib.crc32(dictionary) != dictionary_id:
+            raise ReplayStoreError(f"Compression dictionary '{path}' is corrupt")
+        _dictionaries[key] = dictionary
+    return dictionary
+
+def _decompress(codec, dictionary, payload, size):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ReplayStoreError("Replay was compressed with zstd; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)).decompress(payload, max_output_size=size)
+    return zlib.decompressobj(zdict=dictionary).decompress(payload)
+
+def read_recording(path):
+    '''
+    Reads a replay's recorded game, whatever form it is stored in.
+
+    :param path: A replay ZIP as saved by aoe2api, a raw .aoe2record file, or a recompressed .aoe2z file.
+    :return: Tuple (member name, recorded game bytes).
+    '''
+    path = Path(path)
+    if path.suffix == SUFFIX:
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                raise ReplayStoreError(f"'{path}' is truncated")
+            magic, version, codec_id, dictionary_id, size, name_length = _HEADER.unpack(header)
+            if magic != _MAGIC or version != _VERSION or codec_id not in _CODEC_NAMES:
+                raise ReplayStoreError(f"'{path}' is not a recompressed replay")
+            name = f.read(name_length).decode("utf-8")
+            payload = f.read()
+        codec = _CODEC_NAMES[codec_id]
+        dictionary = _load_dictionary(path.parent, codec, dictionary_id)
+        with profiling.span("decompress"):
+            data = _decompress(codec, dictionary, payload, size)
+        if len(data) != size:
+            raise ReplayStoreError(f"'{path}' decompressed to {len(data)} bytes, expected {size}")
+        return name, data
+    with open(path, "rb") as f:
+        if not zipfile.is_zipfile(f):
+            f.seek(0)
+            return path.name, f.read()
+        with zipfile.ZipFile(f) as zip_ref:
+            members = [info for info in zip_ref.infolist() if not info.is_dir()]
+            if not members:
+                raise ReplayStoreError(f"'{path}' is an empty archive")
+            return members[0].filename, zip_ref.read(members[0])
+
+def restore_zip(path, destination=None):
+    '''Writes a recompressed replay back out as a replay ZIP. Returns the ZIP path.'''
+    name, data = read_recording(path)
+    destination = destination or str(Path(path).with_suffix(".zip"))
+    with zipfile.ZipFile(destination, "w", compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(name, data)
+    return destination
+
+
+## ---------------------------- Training ---------------------------- ##
+def _train_zlib_dictionary(samples):
+    '''
+    Builds a preset dictionary for zlib from substrings that recur across many samples.
+    The most common substrings go last, where zlib can reach them with the shortest distances.
+
+    Memory is bounded: grams are picked by hash, so a recurring gram is picked in every sample it
+    appears in, and once more than _ZLIB_MAX_GRAMS are counted, those seen least are dropped
+    (lossy counting), so a gram that first appears late can be undercounted by the pruning threshold.
+    '''
+    counts: dict[bytes, int] = {}
+    threshold = 0
+    for sample in samples:
+        seen = set()
+        for i in range(0, len(sample) - _ZLIB_GRAM, _ZLIB_STRIDE):
+            gram = sample[i:i + _ZLIB_GRAM]
+            if zlib.crc32(gram) % _ZLIB_GRAM_SAMPLING == 0:
+                seen.add(gram)
+        for gram in seen:
+            counts[gram] = counts.get(gram, 0) + 1
+        while len(counts) > _ZLIB_MAX_GRAMS:
+            threshold += 1
+            counts = {gram: count for gram, count in counts.items() if count > threshold}
+    common = sorted((gram for gram, count in counts.items() if count > 1), key=counts.get, reverse=True)
+    chosen = common[:_ZLIB_WINDOW // _ZLIB_GRAM]
+    return b"".join(reversed(chosen))
+
+def train_dictionary(paths, codec, sample_bytes=defaults["sample_bytes"], dictionary_size=defaults["zstd_dictionary_size"]):
+    '''Trains a compression dictionary for codec ("zstd" or "zlib") on the start of each replay in paths.'''
+    samples = []
+    for path in paths:
+        try:
+            samples.append(read_recording(path)[1][:sample_bytes])
+        except (ReplayStoreError, zipfile.BadZipFile, OSError) as e:
+            print(f" ! Skipping '{path}' while training: {e}")
+    if not samples:
+        raise ReplayStoreError("No readable replays to train a dictionary on")
+    if codec == "zstd":
+        # Split samples into blocks: the trainer wants many small samples rather than a few large ones.
+        blocks = [sample[i:i + 16 * 1024] for sample in samples for i in range(0, len(sample), 16 * 1024)]
+        try:
+            return zstandard.train_dictionary(dictionary_size, blocks).as_bytes()
+        except zstandard.ZstdError as e:
+            raise ReplayStoreError(f"Could not train a zstd dictionary on {len(samples)} replays: {e}")
+    return _train_zlib_dictionary(samples)
+
+
+## ---------------------------- Recompression ---------------------------- ##
+def _compress(codec, dictionary, data):
+    if codec == "zstd":
+        compressor = zstandard.ZstdCompressor(level=defaults["zstd_level"], dict_data=zstandard.ZstdCompressionDict(dictionary))
+        return compressor.compress(data)
+    compressor = zlib.compressobj(level=defaults["zlib_level"], zdict=dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+def _recompress_one(job):
+    path, codec, dictionary_id, keep_original = job
+    folder = Path(path).parent
+    try:
+        # A .aoe2z file holds one recording, and read_recording() returns only the first ZIP member,
+        # so replacing an archive with more entries would lose the rest.
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zip_ref:
+                member_count = len(zip_ref.infolist())
+            if member_count != 1:
+                return path, None, None, f"Archive has {member_count} entries; only single-replay ZIPs are recompressed"
+        name, data = read_recording(path)
+        dictionary = _load_dictionary(folder, codec, dictionary_id)
+        payload = _compress(codec, dictionary, data)
+        encoded_name = name.encode("utf-8")
+        target = Path(path).with_suffix(SUFFIX)
+        temp_path = target.with_name(target.name + ".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, _CODECS[codec], dictionary_id, len(data), len(encoded_name)))
+            f.write(encoded_name)
+            f.write(payload)
+        os.replace(temp_path, target)
+        # Never drop the original until the new file reads back byte for byte.
+        if read_recording(target) != (name, data):
+            os.remove(target)
+            return path, os.path.getsize(path), None, "Round trip mismatch"
+        original_size = os.path.getsize(path)
+        if not keep_original:
+            os.remove(path)
+        return path, original_size, target.stat().st_size, None
+    except (ReplayStoreError, zipfile.BadZipFile, OSError, zlib.error) as e:
+        return path, None, None, str(e)
+
+def _pick_codec(codec):
+    codec = codec or ("zstd" if zstandard is not None else "zlib")
+    if codec not in _CODECS:
+        raise ValueError(f"Unknown codec '{codec}'. Valid codecs are: {list(_CODECS)}")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("The zstd codec needs the zstandard package")
+    return codec
+
+def measure_read_throughput(paths):
+    '''Decodes the given replays and returns (recorded game bytes, seconds, MB/s).'''
+    total = 0
+    start = time.perf_counter()
+    for path in paths:
+        total += len(read_recording(path)[1])
+    elapsed = time.perf_counter() - start
+    return total, elapsed, (total / elapsed / 1e6) if elapsed > 0 else 0.0
+
+def recompress_store(
+    destination_folder=defaults["destination_folder"],
+    codec=defaults["codec"],
+    sample_count=defaults["sample_count"],
+    workers=defaults["workers"],
+    keep_originals=False,
+    quiet=False,
+):
+    '''
+    Recompresses every replay ZIP in destination_folder into .aoe2z files using a dictionary trained on a
+    sample of the folder. Replays of the same game version share most of their structure, which a shared
+    dictionary captures; per-file deflate cannot. Files are recompressed on a process pool, each new file
+    is verified to decode to the original recording before the ZIP is removed, and read_recording() decodes
+    them transparently afterwards. The dictionary is stored under destination_folder/dictionaries.
+
+    :param codec: "zstd" (needs the zstandard package) or "zlib" (preset dictionary). Defaults to zstd when available.
+    :param keep_originals: Keep the ZIPs next to the recompressed files.
+    :return: Dict with files, failed, bytes_before, bytes_after, saved_bytes, ratio, and read_mb_per_s.
+    '''
+    codec = _pick_codec(codec)
+    paths = sorted(str(p) for p in Path(destination_folder).glob("*.zip"))
+    if not paths:
+        return {"files": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0, "saved_bytes": 0, "ratio": 1.0, "read_mb_per_s": 0.0}
+
+    with profiling.span("train"):
+        sample = random.sample(paths, min(sample_count, len(paths)))
+        dictionary = train_dictionary(sample, codec)
+    dictionary_id = zlib.crc32(dictionary)
+    dictionary_path = _dictionary_path(destination_folder, codec, dictionary_id)
+    dictionary_path.parent.mkdir(parents=True, exist_ok=True)
+    dictionary_path.write_bytes(dictionary)
+    if not quiet:
+        print(f"Trained a {len(dictionary)} byte {codec} dictionary on {len(sample)} replays: '{dictionary_path}'.")
+
+    before = after = failed = 0
+    written = []
+    jobs = [(path, codec, dictionary_id, keep_originals) for path in paths]
+    with profiling.span("recompress"), ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, original_size, new_size, error in executor.map(_recompress_one, jobs, chunksize=8):
+            if error is not None:
+                failed += 1
+                if not quiet:
+                    print(f" ! {path}: {error}")
+                continue
+            before += original_size
+            after += new_size
+            written.append(str(Path(path).with_suffix(SUFFIX)))
+
+    benchmark = written[:defaults["benchmark_count"]]
+    _, _, read_mb_per_s = measure_read_throughput(benchmark) if benchmark else (0, 0.0, 0.0)
+    report = {
+        "files": len(written),
+        "failed": failed,
+        "bytes_before": before,
+        "bytes_after": after,
+        "saved_bytes": before - after,
+        "ratio": (before / after) if after else 1.0,
+        "read_mb_per_s": read_mb_per_s,
+    }
+    if not quiet:
+        print(
+            f"Recompressed {report['files']} replays ({failed} failed): {before:,} -> {after:,} bytes, "
+            f"saved {report['saved_bytes']:,} bytes ({report['ratio']:.2f}x). Read throughput: {read_mb_per_s:.1f} MB/s."
+        )
+    return report
+
+
+def main(args):
+    if args.restore:
+        for path in args.restore:
+            print(restore_zip(path))
+        return
+    recompress_store(
+        destination_folder=args.folder,
+        codec=args.codec,
+        sample_count=args.sample_count,
+        workers=args.workers,
+        keep_originals=args.keep_originals,
+        quiet=args.quiet,
+    )
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Recompress stored replays with a trained dictionary, or restore them to ZIPs.")
+    parser.add_argument("-f", "--folder", type=str, default=defaults["destination_folder"], help="Folder containing replay ZIPs")
+    parser.add_argument("-c", "--codec", type=str, choices=list(_CODECS), default=defaults["codec"], help="Codec (default: zstd if installed, else zlib)")
+    parser.add_argument("-n", "--sample-count", type=int, default=defaults["sample_count"], help="Replays sampled to train the dictionary")
+    parser.add_argument("-w", "--workers", type=int, default=defaults["workers"], help="Worker processes (default: CPU count)")
+    parser.add_argument("-k", "--keep-originals", action="store_true", help="Keep the original ZIPs")
+    parser.add_argument("--restore", type=str, nargs="+", default=None, help="Write these .aoe2z files back out as ZIPs instead")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print errors")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "replay_store"):
+        main(args)
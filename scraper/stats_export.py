@@ -0,0 +1,572 @@
+"""Typed, columnar, append-only export of match details and player stats, readable through mmap."""
+
+import os
+import sys
+
+if not __package__:
+    # Run as a script from its folder: put the repo root first on the path so the
+    # aoe2api, scraper, and shared packages resolve instead of files in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aoe2api import aoe2api
+from shared import codec, profiling
+from array import array
+import argparse
+import mmap
+import re
+import time
+
+defaults = {
+    "export_folder": "stats_export",
+    "batch_size": 1000,                 # Buffered rows, over all tables, before they are appended to disk.
+    "match_block_size": 1_000_000,      # Match IDs per partition of the match tables.
+    "partition_matches_by": "block",    # "block" (match ID block) or "date" (export date).
+}
+
+MATCHES = "matches"
+PLAYER_STATS = "player_stats"
+
+# Column types in promotion order: a column widens to the right when a later value needs it.
+_TYPES = ("bool", "int", "float", "str")
+_TYPECODES = {"bool": "b", "int": "q", "float": "d"}
+_INT64 = (-(1 << 63), (1 << 63) - 1)
+_META = "_meta.json"
+_FORMAT = 1
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+# Keys match details have been seen to use for the match ID, in order of preference.
+_MATCH_ID_KEYS = ("matchId", "gameId", "matchid", "id")
+
+
+## ---------------------------- Flattening ---------------------------- ##
+def flatten(record, prefix=""):
+    '''
+    Splits a JSON object into one flat row and the lists of objects nested in it.
+    Nested objects become dotted column names ("a.b"), and lists of anything but objects
+    are kept as a JSON string column.
+
+    :return: (row, {dotted path: [objects]})
+    '''
+    row, children = {}, {}
+    for key, value in record.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            sub_row, sub_children = flatten(value, f"{name}.")
+            row.update(sub_row)
+            children.update(sub_children)
+        elif isinstance(value, list):
+            if value and all(isinstance(item, dict) for item in value):
+                children[name] = value
+            else:
+                row[name] = codec.dumps(value)
+        else:
+            row[name] = value
+    return row, children
+
+def _kind(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int" if _INT64[0] <= value <= _INT64[1] else "str"
+    if isinstance(value, float):
+        return "float"
+    return "str"
+
+def _to_str(value):
+    return value if isinstance(value, str) else codec.dumps(value)
+
+def _convert(value, kind):
+    if kind == "str":
+        return _to_str(value)
+    if kind == "float":
+        return float(value)
+    return int(value)
+
+
+## ---------------------------- Partition files ---------------------------- ##
+def _column_paths(folder, stem):
+    base = os.path.join(folder, stem)
+    return f"{base}.valid", f"{base}.data", f"{base}.offsets"
+
+def _truncate(path, size):
+    if os.path.getsize(path) > size:
+        with open(path, "r+b") as file:
+            file.truncate(size)
+
+def _read_meta(folder):
+    path = os.path.join(folder, _META)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        meta = codec.loads(file.read())
+    if meta.get("format") != _FORMAT:
+        raise ValueError(f"{folder}: unsupported export format {meta.get('format')!r}")
+    return meta
+
+
+class _PartitionWriter:
+    '''
+    Appends rows to one partition folder: a .valid/.data (and .offsets for strings) file per column,
+    plus _meta.json with the schema and the committed row count. The meta file is replaced last,
+    so readers only ever see whole batches, and bytes past the committed rows (left by an
+    interrupted append) are cut off the next time the partition is opened.
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.meta = _read_meta(folder) or {"format": _FORMAT, "byteorder": sys.byteorder, "rows": 0, "columns": {}}
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"{folder}: written on a {self.meta['byteorder']}-endian machine")
+        self._repair()
+
+    def _repair(self):
+        rows = self.meta["rows"]
+        for info in self.meta["columns"].values():
+            valid_path, data_path, offsets_path = _column_paths(self.folder, info["file"])
+            _truncate(valid_path, rows)
+            if info["type"] == "str":
+                _truncate(offsets_path, rows * 8)
+                offsets = array("q")
+                if rows:
+                    with open(offsets_path, "rb") as file:
+                        file.seek((rows - 1) * 8)
+                        offsets.frombytes(file.read(8))
+                _truncate(data_path, offsets[0] if rows else 0)
+            else:
+                _truncate(data_path, rows * array(_TYPECODES[info["type"]]).itemsize)
+
+    def _save_meta(self):
+        path = os.path.join(self.folder, _META)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(codec.dumps_bytes(self.meta))
+        os.replace(f"{path}.tmp", path)
+
+    def _new_stem(self, name):
+        taken = {info["file"] for info in self.meta["columns"].values()}
+        stem = base = _UNSAFE_NAME.sub("_", name) or "_"
+        number = 1
+        while stem in taken:
+            number += 1
+            stem = f"{base}~{number}"
+        return stem
+
+    def _write_column(self, stem, kind, values, mode):
+        valid_path, data_path, offsets_path = _column_paths(self.folder, stem)
+        with open(valid_path, mode) as file:
+            file.write(bytes(value is not None for value in values))
+        if kind == "str":
+            encoded = [b"" if value is None else value.encode("utf-8") for value in values]
+            end = os.path.getsize(data_path) if mode == "ab" else 0
+            offsets = array("q")
+            for item in encoded:
+                end += len(item)
+                offsets.append(end)
+            with open(data_path, mode) as file:
+                file.write(b"".join(encoded))
+            with open(offsets_path, mode) as file:
+                offsets.tofile(file)
+        else:
+            with open(data_path, mode) as file:
+                array(_TYPECODES[kind], (0 if value is None else value for value in values)).tofile(file)
+
+    def _add_column(self, name, kind):
+        stem = self._new_stem(name)
+        self._write_column(stem, kind, [None] * self.meta["rows"], "wb")
+        self.meta["columns"][name] = {"type": kind, "file": stem}
+
+    def _promote(self, name, kind):
+        # Rewritten under a new file name and switched over by the meta file, so a crash
+        # mid-rewrite leaves the old column intact.
+        old = self.meta["columns"][name]
+        column = Column(self.folder, name, old, self.meta["rows"])
+        try:
+            values = [None if value is None else _convert(value, kind) for value in column]
+        finally:
+            column.close()
+        stem = self._new_stem(name)
+        self._write_column(stem, kind, values, "wb")
+        self.meta["columns"][name] = {"type": kind, "file": stem}
+        self._save_meta()
+        for path in _column_paths(self.folder, old["file"]):
+            try:
+                os.remove(path)
+            except OSError:  # Missing (numeric column), or still mapped by a reader on Windows.
+                pass
+
+    def append(self, rows):
+        '''Appends rows (flat dicts) as one batch, adding and widening columns as needed.'''
+        if not rows:
+            return
+        columns = self.meta["columns"]
+        batch_types = {}
+        for row in rows:
+            for name, value in row.items():
+                kind = _kind(value)
+                if kind is not None:
+                    current = batch_types.get(name)
+                    if current is None or _TYPES.index(kind) > _TYPES.index(current):
+                        batch_types[name] = kind
+        for name, kind in batch_types.items():
+            if name not in columns:
+                self._add_column(name, kind)
+            elif _TYPES.index(kind) > _TYPES.index(columns[name]["type"]):
+                self._promote(name, kind)
+        for name, info in columns.items():
+            values = [row.get(name) for row in rows]
+            values = [None if value is None else _convert(value, info["type"]) for value in values]
+            self._write_column(info["file"], info["type"], values, "ab")
+        self.meta["rows"] += len(rows)
+        self._save_meta()
+
+
+## ---------------------------- Reading ---------------------------- ##
+class Column:
+    '''
+    A read-only column of one partition, memory-mapped.
+
+    values is a memoryview of the fixed-width values ("b" bool, "q" int64, "d" float64; nulls read as 0)
+    and valid a memoryview with one byte per row, 0 for null. String columns expose offsets (the end of
+    each row's UTF-8 bytes in data) instead of values. Indexing and iteration return Python values,
+    with None for nulls. Call close() (or use as a context manager) once every view is released.
+    '''
+
+    def __init__(self, folder, name, info, rows):
+        self.name = name
+        self.type = info["type"]
+        self.rows = rows
+        self._maps = []
+        valid_path, data_path, offsets_path = _column_paths(folder, info["file"])
+        self.valid = self._map(valid_path, rows)
+        if self.type == "str":
+            self.offsets = self._map(offsets_path, rows * 8).cast("q")
+            self.data = self._map(data_path, self.offsets[-1] if rows else 0)
+            self.values = None
+        else:
+            typecode = _TYPECODES[self.type]
+            self.values = self._map(data_path, rows * array(typecode).itemsize).cast(typecode)
+
+    def _map(self, path, length):
+        if not length:
+            return memoryview(b"")
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.rows
+        if not 0 <= index < self.rows:
+            raise IndexError(index)
+        if not self.valid[index]:
+            return None
+        if self.type == "str":
+            start = self.offsets[index - 1] if index else 0
+            return str(self.data[start:self.offsets[index]], "utf-8")
+        value = self.values[index]
+        return bool(value) if self.type == "bool" else value
+
+    def __iter__(self):
+        for index in range(self.rows):
+            yield self[index]
+
+    def close(self):
+        for view in (self.valid, self.values, getattr(self, "offsets", None), getattr(self, "data", None)):
+            if view is not None:
+                view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def list_tables(folder=defaults["export_folder"]):
+    '''Returns the names of the exported tables, e.g. "matches" and "matches.players".'''
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder) if os.path.isdir(os.path.join(folder, name)))
+
+def list_partitions(table, folder=defaults["export_folder"]):
+    '''Returns a table's partition names in order, e.g. "match_block=000453000000" or "date=2026-10-18".'''
+    table_folder = os.path.join(folder, table)
+    if not os.path.isdir(table_folder):
+        return []
+    return sorted(name for name in os.listdir(table_folder) if os.path.exists(os.path.join(table_folder, name, _META)))
+
+def read_schema(table, partition, folder=defaults["export_folder"]):
+    '''Returns ({column: type}, committed rows) of one partition.'''
+    meta = _read_meta(os.path.join(folder, table, partition))
+    if meta is None:
+        return {}, 0
+    return {name: info["type"] for name, info in meta["columns"].items()}, meta["rows"]
+
+def read_partition(table, partition, columns=None, folder=defaults["export_folder"]):
+    '''
+    Memory-maps the columns of one partition, without parsing any JSON but the meta file.
+    Columns the partition does not have yet (added to the schema later) are left out.
+
+    :param columns: Column names to map, or None for all.
+    :return: {column name: Column}. Close each Column when done.
+    '''
+    partition_folder = os.path.join(folder, table, partition)
+    meta = _read_meta(partition_folder)
+    if meta is None:
+        return {}
+    if meta["byteorder"] != sys.byteorder:
+        raise ValueError(f"{partition_folder}: written on a {meta['byteorder']}-endian machine")
+    names = meta["columns"] if columns is None else [name for name in columns if name in meta["columns"]]
+    return {name: Column(partition_folder, name, meta["columns"][name], meta["rows"]) for name in names}
+
+def scan(table, columns=None, folder=defaults["export_folder"]):
+    '''
+    Yields (partition, {column name: Column}) for every partition of a table, in order,
+    closing each partition's columns before moving on to the next.
+    '''
+    for partition in list_partitions(table, folder):
+        mapped = read_partition(table, partition, columns, folder)
+        try:
+            yield partition, mapped
+        finally:
+            for column in mapped.values():
+                column.close()
+
+
+## ---------------------------- Exporting ---------------------------- ##
+def _content(response):
+    # Accepts a fetch_endpoint() result or its content.
+    if isinstance(response, dict) and "status_code" in response and "content" in response:
+        if response["status_code"] != 200:
+            return None
+        response = response["content"]
+    if isinstance(response, dict):
+        return [response]
+    if isinstance(response, list):
+        return [item for item in response if isinstance(item, dict)]
+    return None
+
+def _match_id_of(record):
+    for key in _MATCH_ID_KEYS:
+        value = record.get(key)
+        if value is not None and str(value).isdigit():
+            return int(value)
+    return None
+
+
+class StatsExporter:
+    '''
+    Flattens match details and player stats into typed columnar tables under folder:
+
+    - matches, one row per match, and matches.<list> (e.g. matches.players) for each list of
+      objects in it, partitioned by match ID block or export date;
+    - player_stats and player_stats.<list>, partitioned by export date.
+
+    Rows are buffered and appended in batches; new fields add columns (null for earlier rows) and a
+    field that changes type widens its column (bool -> int -> float -> str). Child rows carry the
+    keys of their parent (match_id, or profile_id and match_type), exported_at, and their index in
+    the list (and parent_index for lists nested a level deeper). Use as a context manager, or call flush() when done. Only one exporter may write to a
+    folder at a time.
+    '''
+
+    def __init__(self, folder=defaults["export_folder"], batch_size=defaults["batch_size"],
+                 match_block_size=defaults["match_block_size"], partition_matches_by=defaults["partition_matches_by"]):
+        if partition_matches_by not in ("block", "date"):
+            raise ValueError(f"partition_matches_by must be 'block' or 'date', not {partition_matches_by!r}")
+        self.folder = folder
+        self.batch_size = batch_size
+        self.match_block_size = match_block_size
+        self.partition_matches_by = partition_matches_by
+        self.rows_written = 0
+        self._buffers = {}
+        self._buffered = 0
+        self._writers = {}
+
+    def _date_partition(self, exported_at):
+        return time.strftime("date=%Y-%m-%d", time.gmtime(exported_at))
+
+    def _add_record(self, table, partition, keys, record):
+        row, children = flatten(record)
+        row.update(keys)
+        self._buffers.setdefault((table, partition), []).append(row)
+        self._buffered += 1
+        child_keys = dict(keys)
+        if "index" in child_keys:
+            child_keys["parent_index"] = child_keys.pop("index")
+        for path, items in children.items():
+            for index, item in enumerate(items):
+                self._add_record(f"{table}.{path}", partition, {**child_keys, "index": index}, item)
+
+    def add_match_details(self, response, match_id=None, exported_at=None):
+        '''
+        Buffers a fetch_match_details() result (or its content) for export.
+
+        :param match_id: Match ID, if the response does not name it.
+        :param exported_at: Unix time stored with the rows and used for date partitions. Defaults to now.
+        :return: Number of match records buffered (0 for a failed request).
+        '''
+        records = _content(response)
+        if not records:
+            return 0
+        exported_at = int(time.time()) if exported_at is None else int(exported_at)
+        for record in records:
+            record_id = _match_id_of(record)
+            if record_id is None and match_id is not None:
+                record_id = int(match_id)
+            if self.partition_matches_by == "date":
+                partition = self._date_partition(exported_at)
+            elif record_id is None:
+                partition = "match_block=unknown"
+            else:
+                partition = f"match_block={record_id // self.match_block_size * self.match_block_size:012d}"
+            self._add_record(MATCHES, partition, {"match_id": record_id, "exported_at": exported_at}, record)
+        self._maybe_flush()
+        return len(records)
+
+    def add_player_stats(self, response, profile_id, match_type=None, exported_at=None):
+        '''
+        Buffers a fetch_player_stats() result (or its content) for export.
+
+        :param profile_id: Profile ID the stats were fetched for.
+        :param match_type: Match type the stats were fetched for.
+        :param exported_at: Unix time stored with the rows and used for the date partition. Defaults to now.
+        :return: Number of stats records buffered (0 for a failed request).
+        '''
+        records = _content(response)
+        if not records:
+            return 0
+        exported_at = int(time.time()) if exported_at is None else int(exported_at)
+        keys = {"profile_id": int(profile_id), "match_type": match_type, "exported_at": exported_at}
+        for record in records:
+            self._add_record(PLAYER_STATS, self._date_partition(exported_at), keys, record)
+        self._maybe_flush()
+        return len(records)
+
+    def _maybe_flush(self):
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Appends every buffered row to its partition. Returns the number of rows written.'''
+        written = 0
+        with profiling.span("export"):
+            for (table, partition), rows in self._buffers.items():
+                writer = self._writers.get((table, partition))
+                if writer is None:
+                    writer = self._writers[(table, partition)] = _PartitionWriter(os.path.join(self.folder, table, partition))
+                writer.append(rows)
+                written += len(rows)
+        self._buffers = {}
+        self._buffered = 0
+        self.rows_written += written
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def _load_dump(path):
+    with open(path, "rb") as file:
+        return codec.loads(file.read())
+
+def _dump_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".json"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def export_dumps(paths, kind, folder=defaults["export_folder"], profile_id=None, match_type=None, quiet=False):
+    '''
+    Exports saved JSON responses (files, or folders of *.json files) into the columnar tables.
+    A match ID or profile ID missing from a response is taken from the first run of digits in its file name.
+
+    :param kind: "match_details" or "player_stats".
+    :return: Number of responses exported.
+    '''
+    exported = 0
+    with StatsExporter(folder) as exporter:
+        for path in _dump_paths(paths):
+            try:
+                response = _load_dump(path)
+            except (OSError, codec.DecodeError) as e:
+                if not quiet:
+                    print(f" ! {path}: {e}")
+                continue
+            digits = re.search(r"\d+", os.path.basename(path))
+            file_id = int(digits.group()) if digits else None
+            exported_at = int(os.path.getmtime(path))
+            if kind == "match_details":
+                added = exporter.add_match_details(response, match_id=file_id, exported_at=exported_at)
+            else:
+                owner = profile_id if profile_id is not None else file_id
+                if owner is None:
+                    if not quiet:
+                        print(f" ! {path}: no profile ID")
+                    continue
+                added = exporter.add_player_stats(response, owner, match_type=match_type, exported_at=exported_at)
+            exported += bool(added)
+    if not quiet:
+        print(f" * Exported {exported} responses ({exporter.rows_written} rows) to {folder}")
+    return exported
+
+
+def main(args):
+    if args.summary:
+        for table in list_tables(args.folder):
+            partitions = list_partitions(table, args.folder)
+            columns, rows = set(), 0
+            for partition in partitions:
+                schema, partition_rows = read_schema(table, partition, args.folder)
+                columns.update(schema)
+                rows += partition_rows
+            print(f"{table}\t{len(partitions)} partitions\t{rows} rows\t{len(columns)} columns")
+        return
+    if args.input:
+        export_dumps(args.input, args.kind, folder=args.folder, profile_id=args.profile_id, match_type=args.match_type, quiet=args.quiet)
+        return
+    with StatsExporter(args.folder, batch_size=args.batch_size, match_block_size=args.match_block_size,
+                       partition_matches_by=args.partition_matches_by) as exporter:
+        profile_id = args.profile_id if args.profile_id is not None else aoe2api.defaults["profile_id"]
+        for match_id in args.match_id or []:
+            exporter.add_match_details(aoe2api.fetch_match_details(profile_id=profile_id, match_id=match_id, quiet=args.quiet), match_id=match_id)
+        for profile_id in args.stats_profile_id or []:
+            exporter.add_player_stats(aoe2api.fetch_player_stats(profile_id=profile_id, match_type=args.match_type, quiet=args.quiet), profile_id, match_type=args.match_type)
+    if not args.quiet:
+        print(f" * Exported {exporter.rows_written} rows to {args.folder}")
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(description="Export match details and player stats to typed, memory-mappable columnar files.")
+    parser.add_argument("-f", "--folder", type=str, default=defaults["export_folder"], help="Export folder")
+    parser.add_argument("-i", "--input", type=str, nargs="+", default=None, help="Saved JSON responses (files or folders) to export")
+    parser.add_argument("--kind", choices=("match_details", "player_stats"), default="match_details", help="What the --input files hold")
+    parser.add_argument("-m", "--match-id", type=int, nargs="+", default=None, help="Fetch and export these matches")
+    parser.add_argument("-s", "--stats-profile-id", type=int, nargs="+", default=None, help="Fetch and export these players' stats")
+    parser.add_argument("-p", "--profile-id", type=int, default=None, help="Profile ID to fetch match details with, or the owner of --input player stats")
+    parser.add_argument("-mt", "--match-type", type=int, default=aoe2api.defaults["match_type"], help="Match type of the player stats")
+    parser.add_argument("--batch-size", type=int, default=defaults["batch_size"], help="Rows buffered before each append")
+    parser.add_argument("--match-block-size", type=int, default=defaults["match_block_size"], help="Match IDs per match partition")
+    parser.add_argument("--partition-matches-by", choices=("block", "date"), default=defaults["partition_matches_by"], help="Partition the match tables by match ID block or export date")
+    parser.add_argument("--summary", action="store_true", help="Print the tables, partitions, and row counts and exit")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the summary")
+    profiling.add_profiling_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = _build_arg_parser().parse_args()
+    with profiling.profiling_session(args, "stats_export"):
+        main(args)
@@ -0,0 +1,204 @@
+"""JSON codec shared by aoe2api and lobby: orjson when installed, stdlib json otherwise.
+
+Use loads()/dumps() instead of the json module directly. decode_body() picks the
+decoding from an HTTP content type so binary bodies are never parsed as JSON, and
+lazy_loads() defers parsing a JSON object until it is first accessed while still
+exposing its first key (e.g. the response type of a lobby event).
+"""
+
+import json
+import re
+import time
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # Optional: pip install orjson.
+    orjson = None
+
+backend = "orjson" if orjson is not None else "json"
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so this catches decode errors from either backend.
+DecodeError = json.JSONDecodeError
+
+_FIRST_KEY = re.compile(r'\s*\{\s*"((?:[^"\\]|\\.)*)"\s*:')
+_FIRST_KEY_BYTES = re.compile(rb'\s*\{\s*"((?:[^"\\]|\\.)*)"\s*:')
+
+
+## ---------------------------- Encoding ---------------------------- ##
+def _default(obj):
+    # Called for types the backend does not serialize natively; with orjson's
+    # OPT_PASSTHROUGH_SUBCLASS that includes subclasses such as LazyJSON.
+    if isinstance(obj, LazyJSON):
+        return dict(obj.items())
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return list(obj)
+    if isinstance(obj, str):
+        return str(obj)
+    if isinstance(obj, int):
+        return int(obj)
+    if isinstance(obj, float):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS
+
+    def dumps_bytes(obj: Any) -> bytes:
+        '''Serialize obj to compact UTF-8 JSON.'''
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def dumps(obj: Any) -> str:
+        '''Serialize obj to a compact JSON string.'''
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode("utf-8")
+
+    def dumps_canonical(obj: Any) -> str:
+        '''Serialize obj with sorted keys, so equal objects always give the same string.'''
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS | orjson.OPT_SORT_KEYS).decode("utf-8")
+
+    def loads(data) -> Any:
+        '''Parse JSON from str, bytes, bytearray or memoryview.'''
+        return orjson.loads(data)
+else:
+    def dumps_bytes(obj: Any) -> bytes:
+        '''Serialize obj to compact UTF-8 JSON.'''
+        return dumps(obj).encode("utf-8")
+
+    def dumps(obj: Any) -> str:
+        '''Serialize obj to a compact JSON string.'''
+        if isinstance(obj, LazyJSON):
+            obj.load()
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default)
+
+    def dumps_canonical(obj: Any) -> str:
+        '''Serialize obj with sorted keys, so equal objects always give the same string.'''
+        if isinstance(obj, LazyJSON):
+            obj.load()
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default, sort_keys=True)
+
+    def loads(data) -> Any:
+        '''Parse JSON from str, bytes, bytearray or memoryview.'''
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+## ---------------------------- Content types ---------------------------- ##
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    '''True for application/json, text/json and +json types such as application/problem+json.'''
+    if not content_type:
+        return False
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type in ("application/json", "text/json") or media_type.endswith("+json")
+
+def decode_body(content: bytes, content_type: Optional[str] = None) -> Any:
+    '''
+    Decode an HTTP response body according to its content type.
+
+    JSON types are parsed, other text/* types are returned as str, and everything else
+    (e.g. replay ZIPs) is returned as the raw bytes. Without a content type, the body is
+    parsed only if it looks like a JSON object or array.
+
+    :return: The decoded body, or None for an empty body.
+    '''
+    if not content:
+        return None
+    if is_json_content_type(content_type):
+        return loads(content)
+    if content_type:
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        if media_type.startswith("text/"):
+            return content.decode("utf-8", errors="replace")
+        return content
+    if content.lstrip()[:1] in (b"{", b"["):
+        try:
+            return loads(content)
+        except DecodeError:
+            pass
+    return content
+
+
+## ---------------------------- Lazy decoding ---------------------------- ##
+def peek_first_key(data) -> Optional[str]:
+    '''Return the first key of a JSON object without parsing the rest of it, or None if data is not an object.'''
+    if isinstance(data, str):
+        found = _FIRST_KEY.match(data)
+        key = found.group(1) if found else None
+    else:
+        found = _FIRST_KEY_BYTES.match(data)
+        key = found.group(1).decode("utf-8") if found else None
+    if key is not None and "\\" in key:
+        key = loads(f'"{key}"')
+    return key
+
+
+class LazyJSON(dict):
+    '''
+    A dict holding a JSON object that is parsed on first access.
+
+    first_key is available without parsing. Any other use (lookups, iteration, len,
+    comparison, mutation) parses the JSON once and then behaves as a plain dict.
+    A malformed document raises DecodeError on first access instead of up front.
+    load_seconds is how long that parse took, or None until it happens.
+
+    C code that reads dicts directly, such as the stdlib json encoder, sees an unparsed
+    LazyJSON as empty: serialize with dumps() from this module, or call load() first.
+    '''
+
+    __slots__ = ("_raw", "first_key", "load_seconds")
+
+    def __init__(self, raw, first_key: Optional[str] = None):
+        super().__init__()
+        self._raw = raw
+        self.load_seconds = None
+        self.first_key = peek_first_key(raw) if first_key is None else first_key
+
+    @property
+    def loaded(self) -> bool:
+        return self._raw is None
+
+    def load(self) -> "LazyJSON":
+        raw = self._raw
+        if raw is not None:
+            started = time.perf_counter()
+            dict.update(self, loads(raw))
+            self.load_seconds = time.perf_counter() - started
+            self._raw = None
+        return self
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+
+def _loading(name: str):
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        if self._raw is not None:
+            self.load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+for _name in (
+    "__getitem__", "__contains__", "__iter__", "__len__", "__eq__", "__ne__", "__repr__",
+    "__or__", "__ror__", "__ior__", "__setitem__", "__delitem__", "__reversed__",
+    "get", "keys", "values", "items", "pop", "popitem", "setdefault", "update", "copy", "clear",
+):
+    setattr(LazyJSON, _name, _loading(_name))
+del _name
+
+
+def lazy_loads(data) -> Any:
+    '''
+    Parse JSON lazily: a JSON object becomes a LazyJSON that is parsed on first access.
+    Anything else (arrays, scalars, empty objects) is parsed immediately.
+    '''
+    first_key = peek_first_key(data)
+    if first_key is None:
+        return loads(data)
+    return LazyJSON(data, first_key)
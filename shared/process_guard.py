@@ -1,34 +1,102 @@
-"""Single-process startup guard for long-running AgeKeeper modules (Windows)."""
+"""Single-instance guard and leader election for long-running AgeKeeper modules.
+
+acquire_single_instance_lock() refuses a second instance: a named mutex on Windows, an
+flock()ed lock file elsewhere. LeaderElection lets every instance start instead: one holds
+the lock file as leader and the others wait as standbys. The OS drops a lock when its
+process exits, however it exits, so a standby is elected within one poll interval of the
+leader dying, with no lease to expire.
+"""
 
 import atexit
-import ctypes
-from ctypes import wintypes
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+
+from shared import codec
+
+if sys.platform == "win32":
+    import ctypes
+    import msvcrt
+    from ctypes import wintypes
+
+    ERROR_ALREADY_EXISTS = 183
+
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _CreateMutexW = _kernel32.CreateMutexW
+    _CreateMutexW.argtypes = [wintypes.LPVOID, wintypes.BOOL, wintypes.LPCWSTR]
+    _CreateMutexW.restype = wintypes.HANDLE
+
+    _CloseHandle = _kernel32.CloseHandle
+    _CloseHandle.argtypes = [wintypes.HANDLE]
+    _CloseHandle.restype = wintypes.BOOL
+else:
+    import fcntl
 
-ERROR_ALREADY_EXISTS = 183
 _MUTEX_HANDLE = None
+_LOCK_FILE = None
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
 
-_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
-_CreateMutexW = _kernel32.CreateMutexW
-_CreateMutexW.argtypes = [wintypes.LPVOID, wintypes.BOOL, wintypes.LPCWSTR]
-_CreateMutexW.restype = wintypes.HANDLE
+## ---------------------------- Lock files ---------------------------- ##
+def lock_path(name: str, lock_dir: Optional[str] = None) -> str:
+    """Path of the lock file for name, in lock_dir or the system temp folder."""
+    return os.path.join(lock_dir or tempfile.gettempdir(), f"{_UNSAFE_NAME.sub('_', name)}.lock")
 
-_CloseHandle = _kernel32.CloseHandle
-_CloseHandle.argtypes = [wintypes.HANDLE]
-_CloseHandle.restype = wintypes.BOOL
 
+def _try_lock(file) -> bool:
+    try:
+        if sys.platform == "win32":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
 
+
+def _open_locked(path: str):
+    """Open path and lock it exclusively without blocking. Returns the open file, or None if another holder has it."""
+    file = open(path, "a+b")
+    if _try_lock(file):
+        return file
+    file.close()
+    return None
+
+
+def _unlock(file) -> None:
+    # Closing the file releases the lock on every platform.
+    file.close()
+
+
+## ---------------------------- Single instance ---------------------------- ##
 def release_single_instance_lock() -> None:
     """Release the process-wide instance lock if currently held."""
-    global _MUTEX_HANDLE
+    global _MUTEX_HANDLE, _LOCK_FILE
     if _MUTEX_HANDLE:
         _CloseHandle(_MUTEX_HANDLE)
         _MUTEX_HANDLE = None
+    if _LOCK_FILE is not None:
+        _unlock(_LOCK_FILE)
+        _LOCK_FILE = None
 
 
 def acquire_single_instance_lock(name: str = "AgeKeeper.Instance") -> bool:
     """Return True if this process acquired the single-instance lock."""
-    global _MUTEX_HANDLE
-    if _MUTEX_HANDLE:
+    global _MUTEX_HANDLE, _LOCK_FILE
+    if _MUTEX_HANDLE or _LOCK_FILE is not None:
+        return True
+
+    if sys.platform != "win32":
+        _LOCK_FILE = _open_locked(lock_path(name))
+        if _LOCK_FILE is None:
+            return False
+        atexit.register(release_single_instance_lock)
         return True
 
     handle = _CreateMutexW(None, False, name)
@@ -43,3 +111,127 @@ def acquire_single_instance_lock(name: str = "AgeKeeper.Instance") -> bool:
     atexit.register(release_single_instance_lock)
     return True
 
+
+## ---------------------------- Leader election ---------------------------- ##
+class LeaderElection:
+    """
+    Leader election between the processes of one host (or of hosts sharing a lock_dir on a
+    filesystem with working flock()) through an exclusive lock on a lock file.
+
+        election = LeaderElection("lobby")
+        if election.wait_for_leadership(on_poll=refresh_warm_state):
+            ...  # Leader until release() or exit.
+
+    The leader also writes "<lock file>.leader" with its pid, host, and election time, for
+    leader() and for operators.
+    """
+
+    def __init__(self, name: str = "AgeKeeper.Leader", lock_dir: Optional[str] = None, poll_interval: float = 1.0):
+        """
+        :param name: Election name; instances with the same name and lock_dir compete.
+        :param lock_dir: Folder of the lock file. Defaults to the system temp folder.
+        :param poll_interval: Seconds between a standby's attempts to take the lock.
+        """
+        self.name = name
+        self.path = lock_path(name, lock_dir)
+        self.poll_interval = poll_interval
+        self.elected_at: Optional[float] = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._atexit_registered = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        """Take leadership if nobody holds it. Never blocks; returns True while this instance is leader."""
+        with self._lock:
+            if self._file is not None:
+                return True
+            file = _open_locked(self.path)
+            if file is None:
+                return False
+            self._file = file
+            self.elected_at = time.time()
+            if not self._atexit_registered:
+                atexit.register(self.release)
+                self._atexit_registered = True
+        info = {"pid": os.getpid(), "host": socket.gethostname(), "elected_at": self.elected_at}
+        try:
+            with open(f"{self.path}.leader.tmp", "wb") as f:
+                f.write(codec.dumps_bytes(info))
+            os.replace(f"{self.path}.leader.tmp", f"{self.path}.leader")
+        except OSError:
+            pass  # Informational only; leadership is the lock.
+        return True
+
+    def wait_for_leadership(
+        self,
+        stop: Optional[threading.Event] = None,
+        timeout: Optional[float] = None,
+        on_poll: Optional[Callable[[], None]] = None,
+    ) -> bool:
+        """
+        Wait as a standby until elected.
+
+        :param stop: Event that ends the wait early.
+        :param timeout: Seconds to wait at most, or None to wait until elected or stopped.
+        :param on_poll: Called between attempts while standing by, e.g. to refresh warm state from the leader's snapshots.
+        :return: True once elected, False if stopped or timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire():
+            if on_poll is not None:
+                on_poll()
+            delay = self.poll_interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return False
+            if stop is not None:
+                if stop.wait(delay):
+                    return False
+            else:
+                time.sleep(delay)
+        return True
+
+    def release(self) -> None:
+        """Give up leadership so a standby can take over."""
+        with self._lock:
+            if self._file is None:
+                return
+            _unlock(self._file)
+            self._file = None
+            self.elected_at = None
+
+    def leader(self) -> Optional[dict]:
+        """The last leader's {"pid", "host", "elected_at"}, or None if no leader was ever recorded."""
+        try:
+            with open(f"{self.path}.leader", "rb") as f:
+                return codec.loads(f.read())
+        except (OSError, codec.DecodeError):
+            return None
+
+    def __enter__(self) -> "LeaderElection":
+        self.wait_for_leadership()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+def lead_or_stand_by(name: str, lock_dir: Optional[str] = None, poll_interval: float = 1.0, quiet: bool = False) -> LeaderElection:
+    """
+    Block until this process leads the election name, reporting when it has to stand by first.
+    Used by CLIs that must run on only one host at a time but should fail over to a waiting copy.
+    """
+    election = LeaderElection(name, lock_dir=lock_dir, poll_interval=poll_interval)
+    if not election.try_acquire():
+        if not quiet:
+            leader = election.leader() or {}
+            print(f" * Standing by: '{name}' is led by pid {leader.get('pid')} on {leader.get('host')}.")
+        election.wait_for_leadership()
+    if not quiet:
+        print(f" * Elected leader of '{name}'.")
+    return election
@@ -0,0 +1,162 @@
+"""Opt-in profiling, allocation tracing, and stage timing for AgeKeeper entry points.
+
+Entry points add the CLI switches with add_profiling_args() and wrap their
+work in profiling_session(). Code on hot paths marks stages with span(),
+which costs one flag check while profiling is off.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+defaults = {
+    "profile_output": "profiles",
+    "trace_alloc_interval": 60.0,   # Seconds between tracemalloc snapshots.
+    "profile_top": 50,              # Functions listed in the text cProfile summary.
+}
+
+_enabled = False
+_spans: dict[str, dict] = {}
+_spans_lock = threading.Lock()
+
+
+## ---------------------------- Stage timing ---------------------------- ##
+@contextmanager
+def span(name: str):
+    '''Time a stage (e.g. "fetch", "decode", "save") when a profiling session is active.'''
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def record_span(name: str, seconds: float) -> None:
+    if not _enabled:
+        return
+    with _spans_lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        stats["count"] += 1
+        stats["total"] += seconds
+        if seconds > stats["max"]:
+            stats["max"] = seconds
+
+
+def span_summary() -> dict[str, dict]:
+    with _spans_lock:
+        return {
+            name: {**stats, "mean": stats["total"] / stats["count"] if stats["count"] else 0.0}
+            for name, stats in _spans.items()
+        }
+
+
+## ---------------------------- CLI ---------------------------- ##
+def add_profiling_args(parser) -> None:
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile and record per-stage timings")
+    parser.add_argument(
+        "--trace-alloc",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Trace allocations with tracemalloc and write the top N sites at intervals",
+    )
+    parser.add_argument(
+        "--trace-alloc-interval",
+        type=float,
+        default=defaults["trace_alloc_interval"],
+        help="Seconds between allocation snapshots when --trace-alloc is set",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=str,
+        default=defaults["profile_output"],
+        help="Folder where profiling output files are written",
+    )
+
+
+## ---------------------------- Session ---------------------------- ##
+def _write_alloc_snapshot(output: Path, name: str, top: int, suffix: str) -> None:
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"# {time.strftime('%Y-%m-%d %H:%M:%S')} current={current} peak={peak}"]
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+    (output / f"{name}-alloc-{suffix}.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def _alloc_snapshot_loop(stop: threading.Event, output: Path, name: str, top: int, interval: float) -> None:
+    index = 0
+    while not stop.wait(interval):
+        _write_alloc_snapshot(output, name, top, f"{index:04d}")
+        index += 1
+
+
+@contextmanager
+def profiling_session(args, name: str):
+    '''
+    Run the enclosed block under the profilers selected by add_profiling_args() switches.
+
+    Writes, to args.profile_output:
+    - <name>.pstats and <name>-profile.txt (cProfile, --profile)
+    - <name>-spans.json (per-stage timings, --profile)
+    - <name>-alloc-NNNN.txt every interval and <name>-alloc-final.txt (--trace-alloc N)
+    '''
+    global _enabled
+    profile = getattr(args, "profile", False)
+    trace_alloc = getattr(args, "trace_alloc", 0)
+    if not profile and not trace_alloc:
+        yield
+        return
+
+    output = Path(getattr(args, "profile_output", defaults["profile_output"]))
+    os.makedirs(output, exist_ok=True)
+    profiler: Optional[cProfile.Profile] = None
+    stop_alloc = threading.Event()
+    alloc_thread = None
+
+    if trace_alloc:
+        tracemalloc.start()
+        alloc_thread = threading.Thread(
+            target=_alloc_snapshot_loop,
+            args=(stop_alloc, output, name, trace_alloc, getattr(args, "trace_alloc_interval", defaults["trace_alloc_interval"])),
+            name="AllocSnapshots",
+            daemon=True,
+        )
+        alloc_thread.start()
+    if profile:
+        with _spans_lock:
+            _spans.clear()
+        _enabled = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _enabled = False
+            profiler.dump_stats(output / f"{name}.pstats")
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(defaults["profile_top"])
+            (output / f"{name}-profile.txt").write_text(summary.getvalue(), encoding="utf-8")
+            with open(output / f"{name}-spans.json", "w", encoding="utf-8") as f:
+                json.dump(span_summary(), f, indent=2)
+        if trace_alloc:
+            stop_alloc.set()
+            alloc_thread.join()
+            _write_alloc_snapshot(output, name, trace_alloc, "final")
+            tracemalloc.stop()
+        print(f"Profiling output written to '{output}'.")